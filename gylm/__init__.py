@@ -1,5 +1,9 @@
 from .gnlylm import *
 from .soapgto import *
+from .pool import DescriptorPool
+from .state import GylmState
+from .store import DescriptorStore
+from .cache import DescriptorCache
 from .logger import log
 from . import readwrite as io
 from . import transformations as tf
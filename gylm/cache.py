@@ -0,0 +1,141 @@
+import numpy as np
+import collections
+import hashlib
+import os
+from . import connectivity
+
+def hash_value(h, value):
+    if isinstance(value, np.ndarray):
+        h.update(repr((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    else:
+        h.update(repr(value).encode())
+
+def get_key(calc, system, positions=None):
+    # Hash of everything the descriptors of a calc.evaluate(system, positions)
+    # call depend on: The calculator settings (all attributes except for the
+    # thread count and non-value objects such as the cache itself), the
+    # centres, positions, atomic numbers and periodic cell of the system
+    h = hashlib.sha1()
+    h.update(type(calc).__name__.encode())
+    for key, value in sorted(calc.__dict__.items()):
+        if key in ("n_threads", "cache"): continue
+        if not isinstance(value, (np.ndarray, np.dtype, np.generic, str,
+                int, float, bool, list, tuple, type(None))):
+            continue
+        h.update(key.encode())
+        hash_value(h, value)
+    pos = np.asarray(system.get_positions(), dtype=np.float64).reshape((-1,3))
+    centres = pos if positions is None else \
+        np.asarray(positions, dtype=np.float64).reshape((-1,3))
+    cell, pbc = connectivity.get_cell_args(system)
+    for value in [ pos, np.asarray(system.get_atomic_numbers(), dtype=np.int32),
+            cell, pbc, centres ]:
+        hash_value(h, value)
+    return h.hexdigest()
+
+class DescriptorCache(object):
+    # Descriptors keyed by get_key, with an in-memory LRU tier of at most
+    # max_bytes and an optional on-disk tier (one .npy per key under path) of
+    # at most max_disk_bytes. Disk entries are evicted by last access (file
+    # mtime), hits on disk are promoted to memory. Pass as cache=... to a
+    # calculator to turn repeated evaluate calls into lookups.
+    def __init__(self, max_bytes=256*1024**2, path=None, max_disk_bytes=4*1024**3):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+        self.clear()
+        self.disk_bytes = 0
+        if path is not None:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.evictDisk()
+    def __getstate__(self):
+        # Workers (see DescriptorPool) start with an empty memory tier
+        state = self.__dict__.copy()
+        state["entries"] = collections.OrderedDict()
+        state["bytes"] = 0
+        return state
+    def __len__(self):
+        return len(self.entries)
+    def clear(self):
+        # Empties the memory tier
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+    def getPath(self, key):
+        return os.path.join(self.path, key + ".npy")
+    def listDisk(self):
+        # (mtime, file, size) of the disk entries
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".npy"): continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        return entries
+    def get(self, key):
+        X = self.entries.get(key)
+        if X is not None:
+            self.entries.move_to_end(key)
+        elif self.path is not None and os.path.exists(self.getPath(key)):
+            try:
+                X = np.load(self.getPath(key))
+                os.utime(self.getPath(key))
+            except (IOError, OSError, ValueError):
+                X = None
+            if X is not None:
+                self.putMemory(key, X)
+        if X is None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return np.copy(X)
+    def put(self, key, X):
+        X = np.copy(X)
+        self.putMemory(key, X)
+        if self.path is not None:
+            self.putDisk(key, X)
+    def putMemory(self, key, X):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key).nbytes
+        if X.nbytes > self.max_bytes: return
+        self.entries[key] = X
+        self.bytes += X.nbytes
+        while self.bytes > self.max_bytes:
+            _, Y = self.entries.popitem(last=False)
+            self.bytes -= Y.nbytes
+    def putDisk(self, key, X):
+        path = self.getPath(key)
+        if os.path.exists(path): return
+        tmp = path[:-4] + ".%d.tmp" % os.getpid()
+        with open(tmp, "wb") as ofs:
+            np.save(ofs, X)
+        os.replace(tmp, path)
+        self.disk_bytes += os.path.getsize(path)
+        if self.disk_bytes > self.max_disk_bytes:
+            self.evictDisk()
+    def evictDisk(self):
+        # Drops the least recently used files, the size is recounted since
+        # other processes may share the directory
+        entries = sorted(self.listDisk())
+        self.disk_bytes = sum(size for _, _, size in entries)
+        for _, name, size in entries:
+            if self.disk_bytes <= self.max_disk_bytes: break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            self.disk_bytes -= size
+    def evaluate(self, calc, system, positions, evaluate):
+        # Descriptors of calc for (system, positions), from the cache or
+        # otherwise via evaluate() and stored
+        key = get_key(calc, system, positions)
+        X = self.get(key)
+        if X is None:
+            X = evaluate()
+            self.put(key, X)
+        return X
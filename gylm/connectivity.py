@@ -9,26 +9,107 @@ def calculate_dmat(R, P):
         R[:,1], P[:,1])**2 + np.subtract.outer(
         R[:,2], P[:,2])**2)
 
+def get_covalent_radius(t):
+    # Covalent radius from COVRAD_TABLE of a symbol or atomic number, with
+    # the ptable radius for elements missing from the table
+    from . import ptable
+    symbol = t if isinstance(t, str) else ptable.z_to_symbol(t)
+    if symbol in COVRAD_TABLE:
+        return COVRAD_TABLE[symbol]
+    return ptable.lookup[symbol].covrad
+
+def get_covalent_radii(type_vec):
+    # Covalent radii for atomic numbers or symbols, looked up per distinct type
+    types, inverse = np.unique(np.asarray(type_vec), return_inverse=True)
+    cr = np.array([ get_covalent_radius(t.item()) for t in types ], dtype=np.float64)
+    return cr[inverse.reshape((-1,))]
+
 def calculate_lmat(
         distance_mat, 
         type_vec, 
         cutoff=None, 
         cutoff_scale=1.15):
-    dim = distance_mat.shape[0]
     if cutoff != None:
-        connectivity_mat = np.zeros((dim,dim), dtype=bool)
-        for i in range(dim):
-            for j in range(dim):
-                if distance_mat[i,j] < constant:
-                    connectivity_mat[i,j] = True
-                else:
-                    connectivity_mat[i,j] = False
+        connectivity_mat = (distance_mat < cutoff)
     else:
-        cr = np.array([ COVRAD_TABLE[t] for t in type_vec ])
+        cr = get_covalent_radii(type_vec)
         rrcut = cutoff_scale*np.add.outer(cr,cr)
         connectivity_mat = (np.heaviside(-distance_mat+rrcut, 0)).astype(bool)
     return connectivity_mat
 
+def calculate_lmat_sparse(
+        positions,
+        type_vec,
+        cutoff=None,
+        cutoff_scale=1.15,
+        cell=None,
+        pbc=None,
+        distances=False,
+        n_threads=1):
+    # Bonded pairs as in calculate_lmat (without the diagonal), as an (n,n)
+    # scipy.sparse CSR matrix. Candidates come from a GridSearch within the
+    # largest possible bond length, such that time and memory scale linearly
+    # with the number of atoms. With a periodic cell, pairs are bonded if any
+    # image is, at the distance of the closest one. With distances, the CSR
+    # distance matrix on the same pattern is returned as well.
+    import scipy.sparse
+    from ._gylm import GridSearch
+    positions = np.ascontiguousarray(positions, dtype=np.float64).reshape((-1,3))
+    n = positions.shape[0]
+    if cutoff is None:
+        cr = get_covalent_radii(type_vec)
+        r_cut = cutoff_scale*2*np.max(cr) if n > 0 else 0.
+    else:
+        r_cut = cutoff
+    if n == 0 or r_cut <= 0.:
+        rows = cols = np.zeros((0,), dtype=np.int64)
+        d = np.zeros((0,), dtype=np.float64)
+    else:
+        if cell is not None and pbc is not None and np.any(pbc):
+            grid = GridSearch(positions, r_cut,
+                np.ascontiguousarray(cell, dtype=np.float64).reshape((3,3)),
+                np.ascontiguousarray(pbc, dtype=bool).reshape((3,)))
+        else:
+            grid = GridSearch(positions, r_cut)
+        # Half list: each pair (or pair of images) once, with i <= j
+        offsets, cols, d, _ = grid.getNeighbours(half=True, n_threads=n_threads)
+        rows = np.repeat(np.arange(n), np.diff(offsets))
+        if cutoff is None:
+            bonded = (d < cutoff_scale*(cr[rows] + cr[cols]))
+        else:
+            bonded = (d < cutoff)
+        bonded &= (rows != cols)
+        rows, cols, d = rows[bonded], cols[bonded].astype(np.int64), d[bonded]
+        # Closest image per pair
+        order = np.lexsort((d, cols, rows))
+        rows, cols, d = rows[order], cols[order], d[order]
+        first = np.ones(rows.shape[0], dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, d = rows[first], cols[first], d[first]
+    # Both triangles, sorted by row and column
+    rows, cols = np.concatenate([ rows, cols ]), np.concatenate([ cols, rows ])
+    d = np.concatenate([ d, d ])
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros((n+1,), dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    lmat = scipy.sparse.csr_matrix(
+        (np.ones(order.shape[0], dtype=bool), cols[order], indptr), shape=(n,n))
+    if not distances:
+        return lmat
+    dmat = scipy.sparse.csr_matrix((d[order], cols[order], indptr), shape=(n,n))
+    return lmat, dmat
+
+def get_cell_args(config):
+    # Cell and pbc flags as passed to the engines, which search periodic
+    # images natively. An empty cell means no periodicity.
+    if np.any(config.pbc) and config.get_cell() is not None:
+        cell = np.ascontiguousarray(config.get_cell(), dtype=np.float64).reshape((3,3))
+        pbc = np.ascontiguousarray(config.pbc, dtype=bool).reshape((3,))
+    else:
+        cell = np.zeros((0,), dtype=np.float64)
+        pbc = np.zeros((3,), dtype=bool)
+    return cell, pbc
+
 def pad_cell_to_cutoff(config, r_cut):
     cell = np.array(config.get_cell())
     if cell is None: return config
@@ -44,7 +125,7 @@ def pad_cell_to_cutoff(config, r_cut):
     nkl = np.ceil(r_cut/proj).astype('int')
     # Replicate
     n_atoms = len(config)
-    n_images = np.product(2*nkl + 1) 
+    n_images = np.prod(2*nkl + 1) 
     positions_padded = np.tile(config.positions, (n_images, 1))
     offset = 0
     for i in np.append(np.arange(0, nkl[0]+1), np.arange(-nkl[0], 0)):
@@ -59,6 +140,68 @@ def pad_cell_to_cutoff(config, r_cut):
         symbols=symbols_padded)
     return config_padded
 
+def get_neighbour_list(config, r_cut, centres=None, n_threads=1, bins_per_cutoff=0):
+    # Neighbour list that can be shared between calculators (see their
+    # getCutoff): r_cut should be the largest of the required cutoffs.
+    # Centres default to the atom positions. The cell-list resolution
+    # bins_per_cutoff is chosen from the density with 0.
+    from ._gylm import NeighbourList
+    if centres is None:
+        centres = config.get_positions()
+    cell, pbc = get_cell_args(config)
+    return NeighbourList(
+        np.ascontiguousarray(centres, dtype=np.float64).reshape((-1,3)),
+        np.ascontiguousarray(config.get_positions(), dtype=np.float64),
+        np.ascontiguousarray(config.get_atomic_numbers(), dtype=np.int32),
+        r_cut, n_threads, cell, pbc, bins_per_cutoff)
+
+class VerletList(object):
+    # Neighbour list for trajectories: Pairs are searched within r_cut+skin
+    # and reused (with refreshed deltas) until some pair may have entered 
+    # r_cut, that is, until the largest displacement of a centre plus that
+    # of an atom since the last search exceeds the skin. 
+    def __init__(self, r_cut, skin=0.5, n_threads=1):
+        self.r_cut = r_cut
+        self.skin = skin
+        self.n_threads = n_threads
+        self.n_builds = 0
+        self._nl = None
+        self._centres = None
+        self._positions = None
+        self._types = None
+        self._cell = None
+        self._pbc = None
+    def needsRebuild(self, centres, positions, types, cell, pbc):
+        if self._nl is None: return True
+        if centres.shape != self._centres.shape \
+                or positions.shape != self._positions.shape: return True
+        if not np.array_equal(types, self._types) \
+                or not np.array_equal(cell, self._cell) \
+                or not np.array_equal(pbc, self._pbc): return True
+        if len(positions) == 0 or len(centres) == 0: return False
+        dc = np.max(np.sum((centres - self._centres)**2, axis=1))**0.5
+        dp = np.max(np.sum((positions - self._positions)**2, axis=1))**0.5
+        return dc + dp > self.skin
+    def get(self, config, centres=None):
+        # Returns a NeighbourList of the current frame, cutoff r_cut
+        positions = np.ascontiguousarray(config.get_positions(), dtype=np.float64)
+        if centres is None:
+            centres = positions
+        centres = np.ascontiguousarray(centres, dtype=np.float64).reshape((-1,3))
+        types = np.ascontiguousarray(config.get_atomic_numbers(), dtype=np.int32)
+        cell, pbc = get_cell_args(config)
+        if self.needsRebuild(centres, positions, types, cell, pbc):
+            from ._gylm import NeighbourList
+            self._nl = NeighbourList(centres, positions, types, 
+                self.r_cut + self.skin, self.n_threads, cell, pbc)
+            self._centres = np.copy(centres)
+            self._positions = np.copy(positions)
+            self._types = types
+            self._cell = cell
+            self._pbc = pbc
+            self.n_builds += 1
+        return self._nl.refresh(centres, positions, self.r_cut)
+
 # COVALENT RADII (from Cambridge Structural Database
 # (see http://en.wikipedia.org/wiki/Covalent_radius)
 COVRAD_TABLE = {}
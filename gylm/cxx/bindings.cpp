@@ -2,27 +2,99 @@
 #include <pybind11/numpy.h>  
 #include <pybind11/stl.h>    
 #include "gridsearch.hpp"
+#include "neighbourlist.hpp"
+#include "pooling.hpp"
 #include "soapgto.hpp"
 #include "kernel.hpp"
 #include "gylm.hpp"
 #include "ylm.hpp"
+#include "xyz.hpp"
 
 namespace py = pybind11;
 using namespace std;
 
+template<typename T>
+py::array_t<T> _py_copy(const vector<T> &v, long n_cols=1) {
+    if (n_cols == 1) return py::array_t<T>(v.size(), v.data());
+    return py::array_t<T>({ (long) v.size()/n_cols, n_cols }, v.data());
+}
+
 PYBIND11_MODULE(_gylm, m) {
+    m.attr("POOL_NONE") = (int) POOL_NONE;
+    m.attr("POOL_SUM") = (int) POOL_SUM;
+    m.attr("POOL_AVERAGE") = (int) POOL_AVERAGE;
     m.def("evaluate_power", &_py_evaluate_xtunkl, "Power spectra for tnlm-type tensors");
     m.def("evaluate_gylm", &evaluate_gylm, "Gnl-Ylm frequency-damped convolutions");
+    m.def("build_gylm_radial_table", &build_gylm_radial_table, "Tabulated Gnl's for spline interpolation");
+    m.def("evaluate_gylm_grad", &evaluate_gylm_grad, "Gnl-Ylm convolutions with position gradients");
+    m.def("evaluate_gylm_neighbours", &evaluate_gylm_neighbours, "Gnl-Ylm convolutions on a prebuilt neighbour list");
+    m.def("evaluate_gylm_batch", &evaluate_gylm_batch, "Gnl-Ylm convolutions for a packed batch of structures");
     m.def("evaluate_soapgto", &soapGTO, "SOAP with gaussian type orbital radial basis set");
+    m.def("build_soapgto_radial_table", &buildSoapGTORadialTable, "Tabulated SOAP-GTO gaussians for spline interpolation");
+    m.def("evaluate_soapgto_batch", &soapGTOBatch, "SOAP-GTO for a packed batch of structures");
+    m.def("evaluate_soapgto_neighbours", &soapGTONeighbours, "SOAP-GTO on a prebuilt neighbour list");
     m.def("smooth_match", &smooth_match, "Smooth best-match assignment");
     m.def("ylm", &_py_ylm, "Spherical harmonic series");
+    m.def("parse_xyz", &parse_xyz, "Bulk parser for frames of (extended) xyz text",
+        py::arg("buffer"), py::arg("final")=true);
+    m.def("index_xyz", &index_xyz, "Byte offsets of the frames of (extended) xyz text",
+        py::arg("buffer"), py::arg("final")=true);
     py::class_<GridSearch>(m, "GridSearch")
-        .def(py::init<py::array_t<double>, double>())
-        .def("getNeighboursForIndex", &GridSearch::getNeighboursForIndex)
-        .def("getNeighboursForPosition", &GridSearch::getNeighboursForPosition);
+        .def(py::init<py::array_t<double>, double, int>(),
+            py::arg("positions"), py::arg("cutoff"), py::arg("bins_per_cutoff")=1)
+        .def(py::init<py::array_t<double>, double, py::array_t<double>, py::array_t<bool>, int>(),
+            py::arg("positions"), py::arg("cutoff"), py::arg("cell"), py::arg("pbc"),
+            py::arg("bins_per_cutoff")=1)
+        .def("isPeriodic", &GridSearch::isPeriodic)
+        .def("isSparse", &GridSearch::isSparse)
+        .def("getNeighboursForIndex", &GridSearch::getNeighboursForIndex,
+            py::call_guard<py::gil_scoped_release>())
+        .def("getNeighbours", (py::tuple (GridSearch::*)(py::array_t<double>, 
+                bool, int) const) &GridSearch::getNeighbours,
+            py::arg("queries")=py::array_t<double>(0), py::arg("half")=false,
+            py::arg("n_threads")=1)
+        .def("getNeighboursForPosition", (GridSearchResult (GridSearch::*)(
+                const double, const double, const double) const) &GridSearch::getNeighboursForPosition,
+            py::call_guard<py::gil_scoped_release>());
     py::class_<GridSearchResult>(m, "GridSearchResult")
         .def(py::init<>())
         .def_readonly("indices", &GridSearchResult::indices)
         .def_readonly("distances", &GridSearchResult::distances)
-        .def_readonly("distances_squared", &GridSearchResult::distancesSquared);
+        .def_readonly("distances_squared", &GridSearchResult::distancesSquared)
+        .def_readonly("shifts", &GridSearchResult::shifts);
+    py::class_<NeighbourList>(m, "NeighbourList")
+        .def(py::init<py::array_t<double>, py::array_t<double>, py::array_t<int>, double, int,
+                py::array_t<double>, py::array_t<bool>, int>(),
+            py::arg("centres"), py::arg("positions"), py::arg("types"), 
+            py::arg("cutoff"), py::arg("n_threads")=1, 
+            py::arg("cell")=py::array_t<double>(0), py::arg("pbc")=py::array_t<bool>(0),
+            py::arg("bins_per_cutoff")=0)
+        .def("filter", &NeighbourList::filter, py::arg("cutoff"),
+            py::call_guard<py::gil_scoped_release>())
+        .def("refresh", (NeighbourList (NeighbourList::*)(py::array_t<double>, 
+                py::array_t<double>, double) const) &NeighbourList::refresh,
+            py::arg("centres"), py::arg("positions"), py::arg("cutoff"))
+        .def("__len__", &NeighbourList::getNumberOfEntries)
+        .def_readonly("cutoff", &NeighbourList::cutoff)
+        .def_readonly("bins_per_cutoff", &NeighbourList::binsPerCutoff)
+        .def_readonly("n_centres", &NeighbourList::nCentres)
+        .def_readonly("n_positions", &NeighbourList::nPositions)
+        .def_property_readonly("centres", [](const NeighbourList &nl) { 
+            return _py_copy(nl.centres, 3); })
+        .def_property_readonly("offsets", [](const NeighbourList &nl) { 
+            return _py_copy(nl.offsets); })
+        .def_property_readonly("centre_groups", [](const NeighbourList &nl) { 
+            return _py_copy(nl.centreGroups); })
+        .def_property_readonly("group_offsets", [](const NeighbourList &nl) { 
+            return _py_copy(nl.groupOffsets); })
+        .def_property_readonly("group_types", [](const NeighbourList &nl) { 
+            return _py_copy(nl.groupTypes); })
+        .def_property_readonly("indices", [](const NeighbourList &nl) { 
+            return _py_copy(nl.indices); })
+        .def_property_readonly("deltas", [](const NeighbourList &nl) { 
+            return _py_copy(nl.deltas, 3); })
+        .def_property_readonly("shifts", [](const NeighbourList &nl) { 
+            return _py_copy(nl.shifts, 3); })
+        .def_property_readonly("distances", [](const NeighbourList &nl) { 
+            return _py_copy(nl.distances); });
 }
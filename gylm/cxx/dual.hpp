@@ -0,0 +1,45 @@
+#ifndef DUAL_EXT_HPP 
+#define DUAL_EXT_HPP 
+
+#include <math.h>
+
+// Forward-mode dual number carrying a value and its gradient with
+// respect to three (Cartesian) seed variables
+struct Dual3 {
+    double v;
+    double d[3];
+    Dual3() : v(0.) { d[0] = d[1] = d[2] = 0.; }
+    Dual3(double a) : v(a) { d[0] = d[1] = d[2] = 0.; }
+    Dual3(double a, double dx, double dy, double dz) : v(a) {
+        d[0] = dx; d[1] = dy; d[2] = dz;
+    }
+};
+
+inline Dual3 operator+(const Dual3 &a, const Dual3 &b) {
+    return Dual3(a.v+b.v, a.d[0]+b.d[0], a.d[1]+b.d[1], a.d[2]+b.d[2]);
+}
+inline Dual3 operator-(const Dual3 &a, const Dual3 &b) {
+    return Dual3(a.v-b.v, a.d[0]-b.d[0], a.d[1]-b.d[1], a.d[2]-b.d[2]);
+}
+inline Dual3 operator-(const Dual3 &a) {
+    return Dual3(-a.v, -a.d[0], -a.d[1], -a.d[2]);
+}
+inline Dual3 operator*(const Dual3 &a, const Dual3 &b) {
+    return Dual3(a.v*b.v, 
+        a.d[0]*b.v + a.v*b.d[0], 
+        a.d[1]*b.v + a.v*b.d[1], 
+        a.d[2]*b.v + a.v*b.d[2]);
+}
+inline Dual3 operator/(const Dual3 &a, const Dual3 &b) {
+    double inv = 1./b.v;
+    double q = a.v*inv;
+    return Dual3(q, 
+        (a.d[0] - q*b.d[0])*inv, 
+        (a.d[1] - q*b.d[1])*inv, 
+        (a.d[2] - q*b.d[2])*inv);
+}
+inline bool operator<(const Dual3 &a, const Dual3 &b) {
+    return a.v < b.v;
+}
+
+#endif
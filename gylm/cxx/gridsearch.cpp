@@ -16,149 +16,547 @@ limitations under the License.
 #include "gridsearch.hpp"
 #include <algorithm>
 #include <utility>
-#include <map>
-#include <utility>
 #include <math.h>
+#include <stdexcept>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 using namespace std;
 
-GridSearch::GridSearch(py::array_t<double> positions, double cutoff)
-    : positions(positions.unchecked<2>())
+// Bins per axis are capped (the bins get wider instead), such that bin ids
+// fit into a long however far apart the atoms are
+static const int MAX_BINS_PER_AXIS = 1 << 20;
+// Bins are hashed (sparse mode) if there are more bins than this per atom
+static const int SPARSE_BINS_PER_ATOM = 8;
+
+GridSearch::GridSearch(py::array_t<double> positions, double cutoff, int binsPerCutoff)
+    : periodic(false)
+    , cutoff(cutoff)
+    , cutoffSquared(cutoff*cutoff)
+{
+    auto pos = positions.unchecked<2>();
+    this->nPositions = pos.shape(0);
+    this->positions.resize(3*this->nPositions);
+    for (int i = 0; i < this->nPositions; i++) {
+        this->positions[3*i] = pos(i, 0);
+        this->positions[3*i+1] = pos(i, 1);
+        this->positions[3*i+2] = pos(i, 2);
+    }
+    this->init(binsPerCutoff);
+}
+
+GridSearch::GridSearch(py::array_t<double> positions, double cutoff, 
+        py::array_t<double> cell, py::array_t<bool> pbc, int binsPerCutoff)
+    : periodic(false)
+    , cutoff(cutoff)
+    , cutoffSquared(cutoff*cutoff)
+{
+    auto pos = positions.unchecked<2>();
+    py::buffer_info cell_buf = cell.request();
+    py::buffer_info pbc_buf = pbc.request();
+    if (cell_buf.size != 9 || pbc_buf.size != 3) {
+        throw std::invalid_argument("Expected a (3,3) cell and 3 pbc flags");
+    }
+    this->nPositions = pos.shape(0);
+    this->positions.resize(3*this->nPositions);
+    for (int i = 0; i < this->nPositions; i++) {
+        this->positions[3*i] = pos(i, 0);
+        this->positions[3*i+1] = pos(i, 1);
+        this->positions[3*i+2] = pos(i, 2);
+    }
+    this->initPeriodic((const double*) cell_buf.ptr, (const bool*) pbc_buf.ptr, binsPerCutoff);
+}
+
+GridSearch::GridSearch(const double *positions, int n_positions, double cutoff,
+        int binsPerCutoff)
+    : positions(positions, positions+3*n_positions)
+    , nPositions(n_positions)
+    , periodic(false)
+    , cutoff(cutoff)
+    , cutoffSquared(cutoff*cutoff)
+{
+    this->init(binsPerCutoff);
+}
+
+GridSearch::GridSearch(const double *positions, int n_positions, double cutoff,
+        const double *cell, const bool *pbc, int binsPerCutoff)
+    : positions(positions, positions+3*n_positions)
+    , nPositions(n_positions)
+    , periodic(false)
     , cutoff(cutoff)
     , cutoffSquared(cutoff*cutoff)
 {
-    this->init();
+    this->initPeriodic(cell, pbc, binsPerCutoff);
 }
 
-void GridSearch::init() {
+void GridSearch::init(int binsPerCutoff) {
     // Find cell limits
-    this->xmin = this->xmax = this->positions(0, 0);
-    this->ymin = this->ymax = this->positions(0, 1);
-    this->zmin = this->zmax = this->positions(0, 2);
-    for (ssize_t i = 0; i < this->positions.shape(0); i++) {
-        double x = this->positions(i, 0);
-        double y = this->positions(i, 1);
-        double z = this->positions(i, 2);
-        if (x < this->xmin) {
-            this->xmin = x;
-        };
-        if (x > this->xmax) {
-            this->xmax = x;
-        };
-        if (y < this->ymin) {
-            this->ymin = y;
-        };
-        if (y > this->ymax) {
-            this->ymax = y;
-        };
-        if (z < this->zmin) {
-            this->zmin = z;
-        };
-        if (z > this->zmax) {
-            this->zmax = z;
-        };
-    };
-
-    // Add small padding to avoid floating point precision problems at the boundary
+    double xmin[3] = { 0., 0., 0. };
+    double xmax[3] = { 0., 0., 0. };
+    for (int i = 0; i < this->nPositions; i++) {
+        for (int a = 0; a < 3; a++) {
+            double x = this->positions[3*i+a];
+            if (i == 0 || x < xmin[a]) xmin[a] = x;
+            if (i == 0 || x > xmax[a]) xmax[a] = x;
+        }
+    }
+
+    // Add small padding to avoid floating point precision problems at the
+    // boundary. The bins are made to be always of equal size, at least
+    // cutoff/binsPerCutoff wide.
     double padding = 0.0001;
-    this->xmin -= padding;
-    this->xmax += padding;
-    this->ymin -= padding;
-    this->ymax += padding;
-    this->zmin -= padding;
-    this->zmax += padding;
-
-    // Determine amount and size of bins. The bins are made to be always of equal size.
-    this->nx = max(1, int((this->xmax - this->xmin)/this->cutoff));
-    this->ny = max(1, int((this->ymax - this->ymin)/this->cutoff));
-    this->nz = max(1, int((this->zmax - this->zmin)/this->cutoff));
-    this->dx = max(this->cutoff, (this->xmax - this->xmin)/this->nx);
-    this->dy = max(this->cutoff, (this->ymax - this->ymin)/this->ny);
-    this->dz = max(this->cutoff, (this->zmax - this->zmin)/this->nz);
-
-    // Initialize the bin data structure. It is a 4D vector.
-    this->bins = vector<vector<vector<vector<int>>>>(
-        this->nx, vector<vector<vector<int>>>(
-            this->ny, vector<vector<int>>(
-                this->nz, vector<int>())));
-
-    // Assign atoms to bins
-    for (ssize_t idx = 0; idx < this->positions.shape(0); idx++) {
-        double x = this->positions(idx, 0);
-        double y = this->positions(idx, 1);
-        double z = this->positions(idx, 2);
-
-        // Get bin index
-        int i = (x - this->xmin)/this->dx;
-        int j = (y - this->ymin)/this->dy;
-        int k = (z - this->zmin)/this->dz;
-
-        // Add atom index to the bin
-        this->bins[i][j][k].push_back(idx);
-    };
+    double bin_min = this->cutoff/binsPerCutoff;
+    for (int a = 0; a < 3; a++) {
+        xmin[a] -= padding;
+        xmax[a] += padding;
+        this->origin[a] = xmin[a];
+        this->nbins[a] = max(1, (int) min((xmax[a] - xmin[a])/bin_min, 
+            (double) MAX_BINS_PER_AXIS));
+        this->width[a] = max(bin_min, (xmax[a] - xmin[a])/this->nbins[a]);
+        for (int b = 0; b < 3; b++) {
+            this->binVectors[3*a+b] = (a == b) ? this->width[a] : 0.;
+        }
+    }
+    this->initBins(this->positions);
 }
 
-GridSearchResult GridSearch::getNeighboursForPosition(const double x, const double y, const double z) const
+void GridSearch::initPeriodic(const double *cell, const bool *pbc, int binsPerCutoff) {
+    if (cell == NULL || pbc == NULL || !(pbc[0] || pbc[1] || pbc[2])) {
+        this->init(binsPerCutoff);
+        return;
+    }
+    this->periodic = true;
+    for (int a = 0; a < 9; a++) this->cell[a] = cell[a];
+    for (int a = 0; a < 3; a++) this->pbc[a] = pbc[a];
+
+    // Fractional coordinates s = x.invCell, where the columns of invCell
+    // are the reciprocal vectors b_a (without the 2pi)
+    const double *c = this->cell;
+    double det = c[0]*(c[4]*c[8] - c[5]*c[7]) 
+        - c[1]*(c[3]*c[8] - c[5]*c[6]) 
+        + c[2]*(c[3]*c[7] - c[4]*c[6]);
+    if (fabs(det) < 1e-12) {
+        throw std::invalid_argument("Periodic cell must have a nonzero volume");
+    }
+    double *inv = this->invCell;
+    inv[0] =  (c[4]*c[8] - c[5]*c[7])/det;
+    inv[1] = -(c[1]*c[8] - c[2]*c[7])/det;
+    inv[2] =  (c[1]*c[5] - c[2]*c[4])/det;
+    inv[3] = -(c[3]*c[8] - c[5]*c[6])/det;
+    inv[4] =  (c[0]*c[8] - c[2]*c[6])/det;
+    inv[5] = -(c[0]*c[5] - c[2]*c[3])/det;
+    inv[6] =  (c[3]*c[7] - c[4]*c[6])/det;
+    inv[7] = -(c[0]*c[7] - c[1]*c[6])/det;
+    inv[8] =  (c[0]*c[4] - c[1]*c[3])/det;
+
+    // Wrap along periodic axes, record the fractional extent of the others
+    vector<double> frac(3*this->nPositions);
+    this->wraps.assign(3*this->nPositions, 0.);
+    double smax[3];
+    for (int a = 0; a < 3; a++) {
+        this->origin[a] = smax[a] = 0.;
+    }
+    for (int i = 0; i < this->nPositions; i++) {
+        double *x = &this->positions[3*i];
+        double *s = &frac[3*i];
+        for (int a = 0; a < 3; a++) {
+            s[a] = x[0]*inv[a] + x[1]*inv[3+a] + x[2]*inv[6+a];
+        }
+        for (int a = 0; a < 3; a++) {
+            if (this->pbc[a]) {
+                double n = floor(s[a]);
+                s[a] -= n;
+                for (int k = 0; k < 3; k++) this->wraps[3*i+k] -= n*c[3*a+k];
+            } else {
+                if (i == 0 || s[a] < this->origin[a]) this->origin[a] = s[a];
+                if (i == 0 || s[a] > smax[a]) smax[a] = s[a];
+            }
+        }
+        for (int k = 0; k < 3; k++) x[k] += this->wraps[3*i+k];
+    }
+
+    // Bins are at least cutoff/binsPerCutoff wide in the direction normal
+    // to the opposite faces (the cell height along a is 1/|b_a|)
+    for (int a = 0; a < 3; a++) {
+        double b_norm = sqrt(inv[a]*inv[a] + inv[3+a]*inv[3+a] + inv[6+a]*inv[6+a]);
+        double extent = 1.;
+        if (!this->pbc[a]) {
+            double padding = 0.0001*b_norm;
+            this->origin[a] -= padding;
+            extent = smax[a] + padding - this->origin[a];
+        }
+        this->nbins[a] = max(1, (int) min(extent*binsPerCutoff/(this->cutoff*b_norm), 
+            (double) MAX_BINS_PER_AXIS));
+        this->width[a] = extent/this->nbins[a];
+        for (int b = 0; b < 3; b++) {
+            this->binVectors[3*a+b] = this->width[a]*c[3*a+b];
+        }
+    }
+    this->initBins(frac);
+}
+
+static double minBinDistanceSquared(const double *G, const int *d) {
+    // Smallest |sum_a c_a u_a|^2 over c_a in [d_a-1, d_a+1], that is, the
+    // closest approach of points in two bins d apart, where G is the Gram
+    // matrix of the bin vectors u_a. Exact: Each combination of free and
+    // lower/upper-bounded coordinates is solved for its stationary point.
+    double best = -1.;
+    for (int code = 0; code < 27; code++) {
+        int state[3] = { code % 3, (code/3) % 3, code/9 };
+        double c[3] = { 0., 0., 0. };
+        int free_axes[3];
+        int n_free = 0;
+        for (int a = 0; a < 3; a++) {
+            if (state[a] == 0) free_axes[n_free++] = a;
+            else c[a] = (state[a] == 1) ? d[a] - 1. : d[a] + 1.;
+        }
+        // Gaussian elimination on G_FF c_F = -G_FB c_B
+        double A[3][4];
+        for (int i = 0; i < n_free; i++) {
+            int a = free_axes[i];
+            A[i][n_free] = 0.;
+            for (int b = 0; b < 3; b++) {
+                if (state[b] != 0) A[i][n_free] -= G[3*a+b]*c[b];
+            }
+            for (int j = 0; j < n_free; j++) A[i][j] = G[3*a+free_axes[j]];
+        }
+        bool solved = true;
+        for (int i = 0; i < n_free && solved; i++) {
+            int piv = i;
+            for (int k = i+1; k < n_free; k++) {
+                if (fabs(A[k][i]) > fabs(A[piv][i])) piv = k;
+            }
+            if (fabs(A[piv][i]) < 1e-300) { solved = false; break; }
+            for (int j = 0; j <= n_free; j++) swap(A[i][j], A[piv][j]);
+            for (int k = 0; k < n_free; k++) {
+                if (k == i) continue;
+                double f = A[k][i]/A[i][i];
+                for (int j = i; j <= n_free; j++) A[k][j] -= f*A[i][j];
+            }
+        }
+        if (!solved) continue;
+        bool feasible = true;
+        for (int i = 0; i < n_free; i++) {
+            int a = free_axes[i];
+            c[a] = A[i][n_free]/A[i][i];
+            if (c[a] < d[a] - 1. - 1e-12 || c[a] > d[a] + 1. + 1e-12) feasible = false;
+        }
+        if (!feasible) continue;
+        double f = 0.;
+        for (int a = 0; a < 3; a++) {
+            for (int b = 0; b < 3; b++) f += c[a]*G[3*a+b]*c[b];
+        }
+        if (best < 0. || f < best) best = f;
+    }
+    return max(best, 0.);
+}
+
+void GridSearch::initBins(const vector<double> &coords) {
+    // Bin id per atom
+    long n_bins = (long) this->nbins[0]*this->nbins[1]*this->nbins[2];
+    vector<long> atom_bins(this->nPositions);
+    for (int idx = 0; idx < this->nPositions; idx++) {
+        long b[3];
+        for (int a = 0; a < 3; a++) {
+            b[a] = (long) ((coords[3*idx+a] - this->origin[a])/this->width[a]);
+            b[a] = min(max(b[a], 0L), (long) this->nbins[a]-1);
+        }
+        atom_bins[idx] = (b[0]*this->nbins[1] + b[1])*this->nbins[2] + b[2];
+    }
+
+    // Slot per atom: The bin id itself (dense), or the rank of the bin 
+    // among the occupied ones (sparse)
+    this->sparse = (n_bins > (long) SPARSE_BINS_PER_ATOM*max(this->nPositions, 1));
+    this->binSlots.clear();
+    long n_slots = n_bins;
+    vector<int> atom_slots(this->nPositions);
+    if (this->sparse) {
+        vector<long> occupied(atom_bins);
+        sort(occupied.begin(), occupied.end());
+        occupied.erase(unique(occupied.begin(), occupied.end()), occupied.end());
+        n_slots = occupied.size();
+        this->binSlots.reserve(n_slots);
+        for (int c = 0; c < (int) n_slots; c++) this->binSlots[occupied[c]] = c;
+        for (int idx = 0; idx < this->nPositions; idx++) {
+            atom_slots[idx] = this->binSlots[atom_bins[idx]];
+        }
+    } else {
+        for (int idx = 0; idx < this->nPositions; idx++) atom_slots[idx] = atom_bins[idx];
+    }
+
+    // Stable counting sort into CSR layout
+    this->binStart.assign(n_slots+1, 0);
+    for (int idx = 0; idx < this->nPositions; idx++) this->binStart[atom_slots[idx]+1]++;
+    for (long c = 0; c < n_slots; c++) this->binStart[c+1] += this->binStart[c];
+    vector<int> fill(this->binStart.begin(), this->binStart.end()-1);
+    this->binAtoms.resize(this->nPositions);
+    this->binPositions.resize(3*this->nPositions);
+    for (int idx = 0; idx < this->nPositions; idx++) {
+        int k = fill[atom_slots[idx]]++;
+        this->binAtoms[k] = idx;
+        for (int a = 0; a < 3; a++) this->binPositions[3*k+a] = this->positions[3*idx+a];
+    }
+
+    // Stencil: Offsets within the bins that span the cutoff along each
+    // axis (bin height along a = volume/|u_b x u_c|), pruned to the bins
+    // that can hold points within the cutoff of the central bin
+    const double *u = this->binVectors;
+    double G[9];
+    for (int a = 0; a < 3; a++) {
+        for (int b = 0; b < 3; b++) {
+            G[3*a+b] = u[3*a]*u[3*b] + u[3*a+1]*u[3*b+1] + u[3*a+2]*u[3*b+2];
+        }
+    }
+    double vol = fabs(u[0]*(u[4]*u[8] - u[5]*u[7]) 
+        - u[1]*(u[3]*u[8] - u[5]*u[6]) 
+        + u[2]*(u[3]*u[7] - u[4]*u[6]));
+    for (int a = 0; a < 3; a++) {
+        const double *v = u + 3*((a+1) % 3);
+        const double *w = u + 3*((a+2) % 3);
+        double cx = v[1]*w[2] - v[2]*w[1];
+        double cy = v[2]*w[0] - v[0]*w[2];
+        double cz = v[0]*w[1] - v[1]*w[0];
+        double height = vol/sqrt(cx*cx + cy*cy + cz*cz);
+        this->stencilRadius[a] = max(1, int(ceil(this->cutoff/height)));
+    }
+    this->stencil.clear();
+    int d[3];
+    for (d[0] = -this->stencilRadius[0]; d[0] <= this->stencilRadius[0]; d[0]++) {
+        for (d[1] = -this->stencilRadius[1]; d[1] <= this->stencilRadius[1]; d[1]++) {
+            for (d[2] = -this->stencilRadius[2]; d[2] <= this->stencilRadius[2]; d[2]++) {
+                if (minBinDistanceSquared(G, d) > this->cutoffSquared*(1.+1e-9)) continue;
+                this->stencil.insert(this->stencil.end(), d, d+3);
+            }
+        }
+    }
+}
+
+void GridSearch::getNeighboursForPosition(const double x, const double y, const double z,
+        vector<int> &indices, vector<double> &distancesSquared, 
+        vector<double> *shifts, vector<double> *deltas) const
 {
-    // The indices of the neighbouring atoms
-    vector<int> neighbours;
-    vector<double> distances;
-    vector<double> distancesSquared;
-
-    // Find bin for the given position
-    int i0 = (x - this->xmin)/this->dx;
-    int j0 = (y - this->ymin)/this->dy;
-    int k0 = (z - this->zmin)/this->dz;
-
-    // Get the bin ranges to check for each dimension.
-    int istart = max(i0-1, 0);
-    int iend = min(i0+1, this->nx-1);
-    int jstart = max(j0-1, 0);
-    int jend = min(j0+1, this->ny-1);
-    int kstart = max(k0-1, 0);
-    int kend = min(k0+1, this->nz-1);
-
-    // Loop over neighbouring bins
-    for (int i = istart; i <= iend; i++){
-        for (int j = jstart; j <= jend; j++){
-            for (int k = kstart; k <= kend; k++){
-                // For each atom in the current bin, calculate the actual distance
-                vector<int> binIndices = this->bins[i][j][k];
-                for (auto &idx : binIndices) {
-                    double ix = this->positions(idx, 0);
-                    double iy = this->positions(idx, 1);
-                    double iz = this->positions(idx, 2);
-                    double deltax = x - ix;
-                    double deltay = y - iy;
-                    double deltaz = z - iz;
-                    double distanceSquared = deltax*deltax + deltay*deltay + deltaz*deltaz;
-                    if (distanceSquared <= this->cutoffSquared) {
-                        neighbours.push_back(idx);
-                        distancesSquared.push_back(distanceSquared);
-                        distances.push_back(sqrt(distanceSquared));
+    indices.clear();
+    distancesSquared.clear();
+    if (shifts != NULL) shifts->clear();
+    if (deltas != NULL) deltas->clear();
+    if (this->nPositions == 0) return;
+
+    // Bin of the query point. Periodic: The query is first wrapped into
+    // the cell by the translation tq.
+    double q[3] = { x, y, z };
+    double tq[3] = { 0., 0., 0. };
+    int b0[3];
+    for (int a = 0; a < 3; a++) {
+        double s = q[a];
+        if (this->periodic) {
+            s = x*this->invCell[a] + y*this->invCell[3+a] + z*this->invCell[6+a];
+            if (this->pbc[a]) {
+                double n = floor(s);
+                s -= n;
+                for (int k = 0; k < 3; k++) tq[k] += n*this->cell[3*a+k];
+            }
+        }
+        double f = floor((s - this->origin[a])/this->width[a]);
+        // Far outside along an open axis, no bin is within reach
+        if (f < -this->stencilRadius[a]-1.) f = -this->stencilRadius[a]-1.;
+        if (f > this->nbins[a]+this->stencilRadius[a]) f = this->nbins[a]+this->stencilRadius[a];
+        b0[a] = int(f);
+    }
+    for (int k = 0; k < 3; k++) q[k] -= tq[k];
+
+    // Loop over the stencil
+    int n_stencil = this->stencil.size()/3;
+    for (int e = 0; e < n_stencil; e++) {
+        int b[3];
+        double t[3] = { 0., 0., 0. };
+        bool inside = true;
+        for (int a = 0; a < 3; a++) {
+            b[a] = b0[a] + this->stencil[3*e+a];
+            if (this->periodic && this->pbc[a]) {
+                int n = this->nbins[a];
+                int bw = ((b[a] % n) + n) % n;
+                int image = (b[a] - bw)/n;
+                b[a] = bw;
+                for (int k = 0; k < 3; k++) t[k] += image*this->cell[3*a+k];
+            } else if (b[a] < 0 || b[a] >= this->nbins[a]) {
+                inside = false;
+            }
+        }
+        if (!inside) continue;
+        long c = ((long) b[0]*this->nbins[1] + b[1])*this->nbins[2] + b[2];
+        if (this->sparse) {
+            unordered_map<long, int>::const_iterator slot = this->binSlots.find(c);
+            if (slot == this->binSlots.end()) continue;
+            c = slot->second;
+        }
+        int k1 = this->binStart[c+1];
+        for (int k = this->binStart[c]; k < k1; k++) {
+            const double *p = &this->binPositions[3*k];
+            double deltax = q[0] - (p[0] + t[0]);
+            double deltay = q[1] - (p[1] + t[1]);
+            double deltaz = q[2] - (p[2] + t[2]);
+            double distanceSquared = deltax*deltax + deltay*deltay + deltaz*deltaz;
+            if (distanceSquared <= this->cutoffSquared) {
+                int idx = this->binAtoms[k];
+                indices.push_back(idx);
+                distancesSquared.push_back(distanceSquared);
+                if (this->periodic && shifts != NULL) {
+                    for (int a = 0; a < 3; a++) {
+                        shifts->push_back(this->wraps[3*idx+a] + t[a] + tq[a]);
                     }
                 }
+                if (deltas != NULL) {
+                    deltas->push_back(-deltax);
+                    deltas->push_back(-deltay);
+                    deltas->push_back(-deltaz);
+                }
             }
         }
     }
-    return GridSearchResult{neighbours, distances, distancesSquared};
+}
+
+GridSearchResult GridSearch::getNeighboursForPosition(const double x, const double y, const double z) const
+{
+    GridSearchResult result;
+    this->getNeighboursForPosition(x, y, z, result.indices, result.distancesSquared, 
+        &result.shifts);
+    result.distances.resize(result.distancesSquared.size());
+    for (int i = 0; i < (int) result.distancesSquared.size(); i++) {
+        result.distances[i] = sqrt(result.distancesSquared[i]);
+    }
+    return result;
 }
 
 GridSearchResult GridSearch::getNeighboursForIndex(const int idx) const
 {
-    double x = this->positions(idx, 0);
-    double y = this->positions(idx, 1);
-    double z = this->positions(idx, 2);
+    double x = this->positions[3*idx];
+    double y = this->positions[3*idx+1];
+    double z = this->positions[3*idx+2];
     GridSearchResult result = this->getNeighboursForPosition(x, y, z);
 
-    // Remove self from neighbours
-    for (int i=0; i < result.indices.size(); ++i) {
-        if (result.indices[i] == idx) {
+    // Remove self from neighbours (periodic images of self are kept)
+    for (size_t i=0; i < result.indices.size(); ++i) {
+        if (result.indices[i] == idx && result.distancesSquared[i] == 0.) {
             result.indices.erase(result.indices.begin() + i);
             result.distances.erase(result.distances.begin() + i);
             result.distancesSquared.erase(result.distancesSquared.begin() + i);
+            if (this->periodic) {
+                result.shifts.erase(result.shifts.begin() + 3*i, result.shifts.begin() + 3*i+3);
+            }
             break;
         }
     }
+    // Shifts relative to the (unwrapped) input position of idx
+    if (this->periodic) {
+        for (size_t j=0; j < result.indices.size(); ++j) {
+            for (int a=0; a<3; ++a) result.shifts[3*j+a] -= this->wraps[3*idx+a];
+        }
+    }
     return result;
 }
+
+void GridSearch::getNeighbours(const double *queries, int n_queries, bool half, 
+        int n_threads, vector<long> &offsets, vector<int> &indices, 
+        vector<double> &distances, vector<double> &deltas) const
+{
+#ifdef _OPENMP
+    if (n_threads < 1) n_threads = omp_get_max_threads();
+#else
+    n_threads = 1;
+#endif
+    bool self = (queries == NULL);
+    if (self) {
+        queries = this->positions.data();
+        n_queries = this->nPositions;
+    } else if (half) {
+        throw std::invalid_argument("Half lists require the atoms as queries");
+    }
+    n_threads = max(1, min(n_threads, n_queries));
+
+    // Each thread searches a contiguous range of queries into its own
+    // buffers, which are then concatenated in order
+    vector<vector<int> > thread_indices(n_threads);
+    vector<vector<double> > thread_distances(n_threads);
+    vector<vector<double> > thread_deltas(n_threads);
+    vector<long> counts(n_queries, 0);
+    #pragma omp parallel num_threads(n_threads)
+    {
+        int tid = 0;
+#ifdef _OPENMP
+        tid = omp_get_thread_num();
+#endif
+        int i0 = (long) n_queries*tid/n_threads;
+        int i1 = (long) n_queries*(tid+1)/n_threads;
+        vector<int> idcs;
+        vector<double> d2;
+        vector<double> nb_shifts;
+        vector<double> nb_deltas;
+        bool with_shifts = (self && half && this->periodic);
+        for (int i = i0; i < i1; i++) {
+            const double *q = queries + 3*i;
+            this->getNeighboursForPosition(q[0], q[1], q[2], idcs, d2, 
+                with_shifts ? &nb_shifts : NULL, &nb_deltas);
+            for (int k = 0; k < (int) idcs.size(); k++) {
+                int j = idcs[k];
+                if (self && j == i) {
+                    if (d2[k] == 0.) continue;
+                    if (half) {
+                        // Image of self: Keep the lexicographically positive
+                        // of the two images +/- t
+                        const double *t = &nb_shifts[3*k];
+                        double t_self[3];
+                        for (int a = 0; a < 3; a++) t_self[a] = t[a] - this->wraps[3*i+a];
+                        if (t_self[0] < 0. || (t_self[0] == 0. && (t_self[1] < 0.
+                                || (t_self[1] == 0. && t_self[2] < 0.)))) continue;
+                    }
+                } else if (self && half && j < i) {
+                    continue;
+                }
+                thread_indices[tid].push_back(j);
+                thread_distances[tid].push_back(sqrt(d2[k]));
+                thread_deltas[tid].insert(thread_deltas[tid].end(), 
+                    &nb_deltas[3*k], &nb_deltas[3*k]+3);
+                counts[i]++;
+            }
+        }
+    }
+    offsets.assign(n_queries+1, 0);
+    for (int i = 0; i < n_queries; i++) offsets[i+1] = offsets[i] + counts[i];
+    indices.clear();
+    distances.clear();
+    deltas.clear();
+    indices.reserve(offsets[n_queries]);
+    distances.reserve(offsets[n_queries]);
+    deltas.reserve(3*offsets[n_queries]);
+    for (int tid = 0; tid < n_threads; tid++) {
+        indices.insert(indices.end(), thread_indices[tid].begin(), thread_indices[tid].end());
+        distances.insert(distances.end(), thread_distances[tid].begin(), 
+            thread_distances[tid].end());
+        deltas.insert(deltas.end(), thread_deltas[tid].begin(), thread_deltas[tid].end());
+    }
+}
+
+py::tuple GridSearch::getNeighbours(py::array_t<double> queries, bool half, 
+        int n_threads) const
+{
+    py::buffer_info queries_buf = queries.request();
+    if (queries_buf.size % 3 != 0) {
+        throw std::invalid_argument("Expected (n,3) queries");
+    }
+    const double *q = (queries_buf.size > 0) ? (const double*) queries_buf.ptr : NULL;
+    vector<long> offsets;
+    vector<int> indices;
+    vector<double> distances;
+    vector<double> deltas;
+    {
+        py::gil_scoped_release release;
+        this->getNeighbours(q, queries_buf.size/3, half, n_threads, 
+            offsets, indices, distances, deltas);
+    }
+    return py::make_tuple(
+        py::array_t<long>(offsets.size(), offsets.data()),
+        py::array_t<int>(indices.size(), indices.data()),
+        py::array_t<double>(distances.size(), distances.data()),
+        py::array_t<double>({ (long) deltas.size()/3, 3L }, deltas.data()));
+}
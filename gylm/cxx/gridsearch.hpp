@@ -19,40 +19,99 @@ limitations under the License.
 
 #include <pybind11/numpy.h>
 #include <vector>
+#include <unordered_map>
 
 namespace py = pybind11;
 using namespace std;
 
+// For periodic searches, shifts holds the lattice translation (3 per
+// neighbour) that maps the input position onto the neighbouring image, 
+// that is, image = positions[idx] + shift (for getNeighboursForIndex 
+// relative to the query atom at its input position). Empty for 
+// non-periodic searches.
 struct GridSearchResult {
     vector<int> indices;
     vector<double> distances;
     vector<double> distancesSquared;
+    vector<double> shifts;
 };
 
+// Cell list in a flat CSR layout: Atoms (and a copy of their positions)
+// are sorted by bin, the atoms of bin c are [binStart[c], binStart[c+1]).
+// Bins may be finer than the cutoff (binsPerCutoff per cutoff length),
+// queries then visit a precomputed stencil of the bins that can
+// intersect the cutoff sphere around any point of the central bin.
+// Sparse mode (chosen when most bins would be empty, e.g. for molecules
+// far apart or slabs with vacuum): Only occupied bins are stored, c then
+// indexes the occupied bins and is looked up by bin id in a hash map, 
+// such that memory stays O(N) however far apart the atoms are.
 class GridSearch {
     public:
-        GridSearch(py::array_t<double> positions, double cutoff);
+        GridSearch(py::array_t<double> positions, double cutoff, int binsPerCutoff);
+        GridSearch(py::array_t<double> positions, double cutoff, 
+            py::array_t<double> cell, py::array_t<bool> pbc, int binsPerCutoff);
+        GridSearch(const double *positions, int n_positions, double cutoff,
+            int binsPerCutoff=1);
+        // Cell vectors are the rows of cell (3 x 3), periodic images are
+        // searched along the axes with pbc set, without replicating the cell
+        GridSearch(const double *positions, int n_positions, double cutoff,
+            const double *cell, const bool *pbc, int binsPerCutoff=1);
         GridSearchResult getNeighboursForPosition(const double x, const double y, const double z) const;
         GridSearchResult getNeighboursForIndex(const int i) const;
+        // As above, into caller-provided buffers (cleared first), which 
+        // can be reused across queries. Shifts are only written for 
+        // periodic searches, and only if non-NULL, deltas (neighbour image
+        // - query, 3 per neighbour) only if non-NULL.
+        void getNeighboursForPosition(const double x, const double y, const double z,
+            vector<int> &indices, vector<double> &distancesSquared, 
+            vector<double> *shifts, vector<double> *deltas=NULL) const;
+        // Neighbours of many query points at once, in CSR layout (the
+        // entries of query i are [offsets[i], offsets[i+1])). Without 
+        // queries (NULL), the queries are all atoms, excluding self, and
+        // with half set each pair is listed once (only j >= i, and of the 
+        // periodic images of self only one out of each +/- pair).
+        void getNeighbours(const double *queries, int n_queries, bool half, 
+            int n_threads, vector<long> &offsets, vector<int> &indices, 
+            vector<double> &distances, vector<double> &deltas) const;
+        // As above, returns (offsets, indices, distances, deltas) arrays,
+        // an empty queries array means all atoms
+        py::tuple getNeighbours(py::array_t<double> queries, bool half, 
+            int n_threads) const;
+        bool isPeriodic() const { return this->periodic; }
+        bool isSparse() const { return this->sparse; }
 
     private:
-        void init();
-        const py::detail::unchecked_reference<double, 2> positions;
-        vector<vector<vector<vector<int>>>> bins;
+        void init(int binsPerCutoff);
+        void initPeriodic(const double *cell, const bool *pbc, int binsPerCutoff);
+        void initBins(const vector<double> &coords);
+        // Owned (n x 3) copy, so that the search is safe to share across
+        // threads and outlives the array it was constructed from
+        vector<double> positions;
+        int nPositions;
+        // Periodic mode: Positions above are wrapped into the cell by the 
+        // lattice translations in wraps, bins span fractional coordinates
+        bool periodic;
+        bool pbc[3];
+        double cell[9];
+        double invCell[9];
+        vector<double> wraps;
+        // Bins along the three (cartesian or cell) axes: origin, width,
+        // count and the bin vectors (rows) spanned by one bin
+        double origin[3];
+        double width[3];
+        int nbins[3];
+        double binVectors[9];
+        bool sparse;
+        unordered_map<long, int> binSlots;
+        vector<int> binStart;
+        vector<int> binAtoms;
+        vector<double> binPositions;
+        // Bin offsets (3 per entry) of the search stencil, within
+        // stencilRadius bins along each axis
+        vector<int> stencil;
+        int stencilRadius[3];
         const double cutoff;
         const double cutoffSquared;
-        double xmin;
-        double xmax;
-        double ymin;
-        double ymax;
-        double zmin;
-        double zmax;
-        int nx;
-        int ny;
-        int nz;
-        double dx;
-        double dy;
-        double dz;
 };
 
 #endif
@@ -8,9 +8,17 @@
 #include <set>
 #include <iostream>
 #include <iomanip>
+#include <stdexcept>
 #include "gylm.hpp"
 #include "ylm.hpp"
+#include "radial.hpp"
+#include "linalg.hpp"
+#include "pooling.hpp"
 #include "gridsearch.hpp"
+#include "neighbourlist.hpp"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 // Unfortunately icc forbids use of math functions in constexpr
 constexpr double radial_epsilon  = +1.00000000000e-10; // constexpr double radial_epsilon = 1e-10;
@@ -27,19 +35,20 @@ constexpr double lnorm_9         = +2.29415733871e-01; // constexpr double lnorm
 constexpr double lnorm_10        = +2.18217890236e-01; // constexpr double lnorm_10 = 1./sqrt(21.);
 constexpr double lnorm_11        = +2.08514414057e-01; // constexpr double lnorm_11 = 1./sqrt(23.);
 
+template<typename T>
 void evaluate_deltas(
-        double xi, double yi, double zi, 
-        double *tpos,
-        double *dx, double *dy, double *dz,
-        double *dr, double *dr2,
-        const vector<int> &nbs) {
+        const NeighbourList &nl, long begin, long end,
+        T *dx, T *dy, T *dz,
+        T *dr, T *dr2) {
+    // Deltas and distances of the entries [begin, end) of a neighbour list
     int jj = 0;
-    for (const int &j : nbs) {
-        double dx_jj = tpos[3*j] - xi;
-        double dy_jj = tpos[3*j+1] - yi;
-        double dz_jj = tpos[3*j+2] - zi;
-        dr2[jj] = dx_jj*dx_jj + dy_jj*dy_jj + dz_jj*dz_jj;
-        dr[jj] = sqrt(dr2[jj]);
+    for (long e=begin; e<end; ++e) {
+        double dx_jj = nl.deltas[3*e];
+        double dy_jj = nl.deltas[3*e+1];
+        double dz_jj = nl.deltas[3*e+2];
+        double dr2_jj = dx_jj*dx_jj + dy_jj*dy_jj + dz_jj*dz_jj;
+        dr2[jj] = dr2_jj;
+        dr[jj] = sqrt(dr2_jj);
         dx[jj] = dx_jj;
         dy[jj] = dy_jj;
         dz[jj] = dz_jj;
@@ -47,10 +56,11 @@ void evaluate_deltas(
     }
 }
 
+template<typename T>
 void evaluate_weights(
-        double *dr, int n_parts, 
+        T *dr, int n_parts, 
         double r_cut, double r_cut_width, 
-        double *w) {
+        T *w) {
     for (int j=0; j<n_parts; ++j) {
         if (dr[j] <= r_cut-r_cut_width) w[j] = 1.;
         else if (dr[j] >= r_cut) w[j] = 0.;
@@ -60,44 +70,111 @@ void evaluate_weights(
     }
 }
 
+template<typename T>
 void evaluate_gnl(
+        T *dr, T *dr2, int n_parts, 
+        double *centres, double *alphas, 
+        int nmax, int lmax, 
+        T *gn, T *hl, T *gnl,
+        double part_sigma,
+        double wconstant,
+        double wscale,
+        double wcentre,
+        double ldamp) {
+    // Arithmetic runs in the precision T of the scratch arrays
+    T invs_wscale2 = 1./(wscale*wscale);
+    T s_4pi = sqrt(4.*M_PI);
+    T eps = radial_epsilon;
+    int c_gnl = -1;
+    for (int j=0; j<n_parts; ++j) {
+        T w = 1.;
+        if (wconstant || dr[j] < radial_epsilon) w = wcentre;
+        else {
+            T r2eff = dr2[j]*invs_wscale2;
+            T t = exp(-r2eff);
+            w = (T(1.)-t)/r2eff + t*T(wcentre-1.);
+        }
+        for (int n=0; n<nmax; ++n) {
+            T a = alphas[n];
+            T c = centres[n];
+            gn[n] = w*exp(-a*(c-dr[j])*(c-dr[j]));
+        }
+        for (int l=0; l<lmax+1; ++l) {
+            T k = sqrt(2*l)*ldamp*part_sigma;
+            hl[l] = exp(-k / (s_4pi*dr[j] + eps));
+        }
+        for (int n=0; n<nmax; ++n) {
+            for (int l=0; l<lmax+1; ++l) {
+                gnl[++c_gnl] = gn[n]*hl[l];
+            }
+        }
+    }
+}
+
+void evaluate_weights_grad(
+        double *dr, int n_parts, 
+        double r_cut, double r_cut_width, 
+        double *w, double *dw) {
+    for (int j=0; j<n_parts; ++j) {
+        if (dr[j] <= r_cut-r_cut_width) { w[j] = 1.; dw[j] = 0.; }
+        else if (dr[j] >= r_cut) { w[j] = 0.; dw[j] = 0.; }
+        else {
+            double phi = M_PI*(dr[j]-r_cut+r_cut_width)/r_cut_width;
+            w[j] = 0.5*(1+cos(phi));
+            dw[j] = -0.5*M_PI/r_cut_width*sin(phi);
+        }
+    }
+}
+
+void evaluate_gnl_grad(
         double *dr, double *dr2, int n_parts, 
         double *centres, double *alphas, 
         int nmax, int lmax, 
-        double *gn, double *hl, double *gnl,
+        double *gn, double *dgn, double *hl, double *dhl, 
+        double *gnl, double *dgnl,
         double part_sigma,
         double wconstant,
         double wscale,
         double wcentre,
         double ldamp) {
+    // As evaluate_gnl, plus the radial derivatives dgnl = d(gnl)/dr
     double invs_wscale2 = 1./(wscale*wscale);
+    double s_4pi = sqrt(4.*M_PI);
     int c_gnl = -1;
     for (int j=0; j<n_parts; ++j) {
         double w = 1.;
+        double dw = 0.;
         if (wconstant || dr[j] < radial_epsilon) w = wcentre;
         else {
             double r2eff = dr2[j]*invs_wscale2;
             double t = exp(-r2eff);
             w = (1.-t)/r2eff + t*(wcentre-1.);
+            double dw_dr2eff = (t*r2eff - (1.-t))/(r2eff*r2eff) - t*(wcentre-1.);
+            dw = dw_dr2eff*2.*dr[j]*invs_wscale2;
         }
         for (int n=0; n<nmax; ++n) {
-            gn[n] = w*exp(-alphas[n]*(centres[n]-dr[j])*(centres[n]-dr[j]));
+            double e = exp(-alphas[n]*(centres[n]-dr[j])*(centres[n]-dr[j]));
+            gn[n] = w*e;
+            dgn[n] = dw*e + w*e*2.*alphas[n]*(centres[n]-dr[j]);
         }
         for (int l=0; l<lmax+1; ++l) {
-            hl[l] = exp(-
-                sqrt(2*l)*ldamp*part_sigma /
-                (sqrt(4.*M_PI)*dr[j] + radial_epsilon)
-            );
+            double k = sqrt(2*l)*ldamp*part_sigma;
+            double den = s_4pi*dr[j] + radial_epsilon;
+            hl[l] = exp(-k/den);
+            dhl[l] = hl[l]*k*s_4pi/(den*den);
         }
         for (int n=0; n<nmax; ++n) {
             for (int l=0; l<lmax+1; ++l) {
-                gnl[++c_gnl] = gn[n]*hl[l];
+                ++c_gnl;
+                gnl[c_gnl] = gn[n]*hl[l];
+                dgnl[c_gnl] = dgn[n]*hl[l] + gn[n]*dhl[l];
             }
         }
     }
 }
 
-void evaluate_qitnlm(double *jw, double *jgnl, double *jylm, int n_nbs, 
+template<typename T>
+void evaluate_qitnlm(T *jw, T *jgnl, T *jylm, int n_nbs, 
         int nmax, int lmax, int offset_idx, int dim_nlm, int dim_nl, int dim_lm,
         double *qitnlm) {
     // >>> # NOTE Array layout:
@@ -114,6 +191,7 @@ void evaluate_qitnlm(double *jw, double *jgnl, double *jylm, int n_nbs,
     // >>> # The offset index takes into account source 
     // >>> # (= centre) and nb type index
     // >>> offset = src_idx*dim_tnlm + type_idx*dim_nlm
+    // The sum over neighbours is accumulated in double for any T
     int c_itnlm = offset_idx;
     for (int nlm=0; nlm<dim_nlm; ++nlm) qitnlm[c_itnlm++] = 0.;
     int c_gnl = 0;
@@ -133,26 +211,37 @@ void evaluate_qitnlm(double *jw, double *jgnl, double *jylm, int n_nbs,
     }
 }
 
-void evaluate_xtunkl(double *xitunkl, double *qitnlm, vector<double> &lnorm,
-        int n_src, int n_types, int nmax, int lmax, 
-        int dim_tnlm, int dim_nlm, int dim_lm) {
-    int itunkl = 0;
-    for (int i=0; i<n_src; ++i) {
-        for (int t=0; t<n_types; ++t) {
-            int tnlm_off = i*dim_tnlm + t*dim_nlm;
-            for (int u=t; u<n_types; ++u) {
-                int uklm_off = i*dim_tnlm + u*dim_nlm;
+template<typename T>
+void evaluate_xtunkl_centre(T *xtunkl, double *qtnlm, vector<double> &lnorm,
+        const vector<int> &types, int n_types, int nmax, int lmax,
+        int dim_nkl, int dim_nlm, int dim_lm, 
+        T *a_buf, T *g_buf) {
+    // Per l, the coefficients of the given types form a (T*nmax) x (2l+1)
+    // matrix A_l with rows (t,n), such that X(t,u,n,k,l) = lnorm_l (A_l A_l^T).
+    // Only the row blocks t <= u of the product are evaluated.
+    int n_sel = types.size();
+    int n_rows = n_sel*nmax;
+    for (int l=0; l<lmax+1; ++l) {
+        int K = 2*l+1;
+        for (int ti=0; ti<n_sel; ++ti) {
+            for (int n=0; n<nmax; ++n) {
+                double *q = qtnlm + types[ti]*dim_nlm + n*dim_lm + l*l;
+                T *a = a_buf + (ti*nmax+n)*K;
+                for (int m=0; m<K; ++m) a[m] = q[m];
+            }
+        }
+        for (int ti=0; ti<n_sel; ++ti) {
+            int t = types[ti];
+            int n_cols = n_rows - ti*nmax;
+            T *a_t = a_buf + ti*nmax*K;
+            gemm_nt(nmax, n_cols, K, a_t, K, a_t, K, g_buf, n_cols);
+            for (int ui=ti; ui<n_sel; ++ui) {
+                int u = types[ui];
+                T *x = xtunkl + (t*n_types - t*(t+1)/2 + u)*dim_nkl + l;
+                T *g = g_buf + (ui-ti)*nmax;
                 for (int n=0; n<nmax; ++n) {
                     for (int k=0; k<nmax; ++k) {
-                        int tnlm = tnlm_off + n*dim_lm;
-                        int uklm = uklm_off + k*dim_lm;
-                        for (int l=0; l<lmax+1; ++l) {
-                            double x = 0.;
-                            for (int m=-l; m<l+1; ++m) {
-                                x += qitnlm[tnlm++]*qitnlm[uklm++];
-                            }
-                            xitunkl[itunkl++] = lnorm[l]*x;
-                        }
+                        x[(n*nmax+k)*(lmax+1)] = lnorm[l]*g[n*n_cols+k];
                     }
                 }
             }
@@ -160,34 +249,94 @@ void evaluate_xtunkl(double *xitunkl, double *qitnlm, vector<double> &lnorm,
     }
 }
 
-void evaluate_xtunkl(double *xitunkl, double *qitnlm, vector<double> &lnorm, 
+void evaluate_xtunkl(double *xitunkl, double *qitnlm, vector<double> &lnorm,
+        int n_src, int n_types, int nmax, int lmax, 
+        int dim_tnlm, int dim_nlm, int dim_lm) {
+    int dim_nkl = nmax*nmax*(lmax+1);
+    int dim_tunkl = n_types*(n_types+1)/2*dim_nkl;
+    double *a_buf = (double*) malloc(sizeof(double)*n_types*nmax*(2*lmax+1));
+    double *g_buf = (double*) malloc(sizeof(double)*n_types*nmax*n_types*nmax);
+    vector<int> types(n_types);
+    for (int t=0; t<n_types; ++t) types[t] = t;
+    for (int i=0; i<n_src; ++i) {
+        evaluate_xtunkl_centre(xitunkl + i*dim_tunkl, qitnlm + i*dim_tnlm, lnorm,
+            types, n_types, nmax, lmax, dim_nkl, dim_nlm, dim_lm, a_buf, g_buf);
+    }
+    free(a_buf);
+    free(g_buf);
+}
+
+template<typename T>
+void evaluate_xtunkl(T *xitunkl, double *qitnlm, vector<double> &lnorm, 
     int src_idx, set<int> &nb_type_indices, int n_types, int nmax, int lmax,
-    int dim_tunkl, int dim_nkl, int dim_tnlm, int dim_nlm, int dim_lm) {
-    int itunkl_off = src_idx*dim_tunkl;
-    int itunkl = 0;
-    for (auto t_it=nb_type_indices.begin(); t_it!=nb_type_indices.end(); ++t_it) {
-        int t = *t_it;
-        int tnlm_off = src_idx*dim_tnlm + t*dim_nlm;
-        for (auto u_it=t_it; u_it!=nb_type_indices.end(); ++u_it) {
-            int u = *u_it;
-            int uklm_off = src_idx*dim_tnlm + u*dim_nlm;
-            itunkl = itunkl_off + (
-                t*n_types - t*(t+1)/2 + u)*dim_nkl;
-            for (int n=0; n<nmax; ++n) {
-                for (int k=0; k<nmax; ++k) {
-                    int tnlm = tnlm_off + n*dim_lm;
-                    int uklm = uklm_off + k*dim_lm;
-                    for (int l=0; l<lmax+1; ++l) {
-                        double x = 0.;
-                        for (int m=-l; m<l+1; ++m) {
-                            x += qitnlm[tnlm++]*qitnlm[uklm++];
-                        }
-                        xitunkl[itunkl++] = lnorm[l]*x;
-                    }
-                }
-            }
+    int dim_tunkl, int dim_nkl, int dim_tnlm, int dim_nlm, int dim_lm,
+    T *a_buf, T *g_buf) {
+    // Contracts the types present in the environment of src_idx only,
+    // the scratch buffers hold n_types*nmax*(2*lmax+1) and 
+    // (n_types*nmax)^2 elements
+    vector<int> types(nb_type_indices.begin(), nb_type_indices.end());
+    evaluate_xtunkl_centre(xitunkl + src_idx*dim_tunkl, 
+        qitnlm + src_idx*dim_tnlm, lnorm, types, n_types, nmax, lmax,
+        dim_nkl, dim_nlm, dim_lm, a_buf, g_buf);
+}
+
+void get_channel_offsets(const int *channels, int n_channels, 
+        int n_types, int nmax, int lmax, 
+        vector<int> &a_off, vector<int> &b_off, vector<int> &l_sel) {
+    // Decodes power-spectrum indices (t,u,n,k,l) into the offsets of 
+    // the two coefficient rows (t,n,l) and (u,k,l) in a qtnlm block
+    int dim_lm = (lmax+1)*(lmax+1);
+    int dim_nlm = nmax*dim_lm;
+    int dim_nkl = nmax*nmax*(lmax+1);
+    vector<int> tu_t, tu_u;
+    for (int t=0; t<n_types; ++t) {
+        for (int u=t; u<n_types; ++u) {
+            tu_t.push_back(t);
+            tu_u.push_back(u);
+        }
+    }
+    a_off.resize(n_channels);
+    b_off.resize(n_channels);
+    l_sel.resize(n_channels);
+    for (int c=0; c<n_channels; ++c) {
+        int idx = channels[c];
+        int tu = idx/dim_nkl;
+        int nkl = idx%dim_nkl;
+        int n = nkl/(nmax*(lmax+1));
+        int k = (nkl/(lmax+1))%nmax;
+        int l = nkl%(lmax+1);
+        a_off[c] = tu_t[tu]*dim_nlm + n*dim_lm + l*l;
+        b_off[c] = tu_u[tu]*dim_nlm + k*dim_lm + l*l;
+        l_sel[c] = l;
+    }
+}
+
+int *get_channels(py::buffer_info &buf, int n_types, int nmax, int lmax) {
+    // An empty index list selects all channels
+    if (buf.size == 0) return NULL;
+    int *channels = (int*) buf.ptr;
+    int dim_tunkl = n_types*(n_types+1)/2*nmax*nmax*(lmax+1);
+    for (int c=0; c<buf.size; ++c) {
+        if (channels[c] < 0 || channels[c] >= dim_tunkl) {
+            throw std::invalid_argument("Channel index out of range");
         }
     }
+    return channels;
+}
+
+template<typename T>
+void evaluate_xtunkl_selected(T *x, double *qtnlm, vector<double> &lnorm,
+        const vector<int> &a_off, const vector<int> &b_off, const vector<int> &l_sel) {
+    // Selected power-spectrum entries of one centre, written compactly
+    int n_channels = a_off.size();
+    for (int c=0; c<n_channels; ++c) {
+        int l = l_sel[c];
+        double *qa = qtnlm + a_off[c];
+        double *qb = qtnlm + b_off[c];
+        double xc = 0.;
+        for (int m=0; m<2*l+1; ++m) xc += qa[m]*qb[m];
+        x[c] = lnorm[l]*xc;
+    }
 }
 
 void _py_evaluate_xtunkl(
@@ -197,8 +346,11 @@ void _py_evaluate_xtunkl(
     int n_types,
     int nmax,
     int lmax) {
-    double *xitunkl = (double*) _xitunkl.request().ptr;
-    double *qitnlm = (double*) _qitnlm.request().ptr;
+    py::buffer_info xitunkl_buf = _xitunkl.request();
+    py::buffer_info qitnlm_buf = _qitnlm.request();
+    double *xitunkl = (double*) xitunkl_buf.ptr;
+    double *qitnlm = (double*) qitnlm_buf.ptr;
+    py::gil_scoped_release release;
     int dim_lm = (lmax+1)*(lmax+1);
     int dim_nlm = nmax*dim_lm;
     int dim_tnlm = n_types*dim_nlm;
@@ -211,18 +363,100 @@ void _py_evaluate_xtunkl(
         dim_tnlm, dim_nlm, dim_lm);
 }
 
-void evaluate_gylm(
-        py::array_t<double> coeffs, 
-        py::array_t<double> src_pos, 
-        py::array_t<double> tgt_pos, 
+map<int, int> get_type_index_map(int *all_types, int n_types, bool verbose) {
+    // Type mapping
+    map<int, int> type_index_map;
+    set<int> type_set;
+    for (int i=0; i<n_types; ++i) {
+        if (verbose) std::cout << "Register type " 
+            << all_types[i] << std::endl;
+        type_set.insert(all_types[i]);
+    }
+    int type_index = 0;
+    for (auto it=type_set.begin(); it!=type_set.end(); ++it) {
+        if (verbose) std::cout << "Place type " 
+            << *it << " at index " << type_index << std::endl;
+        type_index_map[*it] = type_index++;
+    }
+
+    return type_index_map;
+}
+
+void get_radial_table_layout(py::buffer_info &buf, int n_fct, int n_in, 
+        double *&table, int &n_out) {
+    // An empty table selects the analytic radial functions
+    table = NULL;
+    n_out = 0;
+    if (buf.size == 0) return;
+    int n_nodes = buf.size/(2*n_fct);
+    if (n_nodes*2*n_fct != buf.size || n_nodes < 2 || n_nodes < n_in+1) {
+        throw std::invalid_argument("Radial table inconsistent with nmax, lmax");
+    }
+    table = (double*) buf.ptr;
+    n_out = n_nodes-1-n_in;
+}
+
+py::tuple build_gylm_radial_table(
         py::array_t<double> gnl_centres_py, 
         py::array_t<double> gnl_alphas_py, 
-        py::array_t<int> tgt_types, 
-        py::array_t<int> all_types, 
+        int nmax, 
+        int lmax,
+        double r_cut, 
+        double r_cut_width, 
+        double part_sigma,
+        bool wconstant,
+        double wscale,
+        double wcentre,
+        double ldamp,
+        double tol) {
+    // Tabulates w(r)*Gnl(r), with w the cutoff weight, for the 
+    // interpolation in evaluate_gylm. Returns the table and the 
+    // number of intervals below the cutoff band.
+    py::buffer_info gnl_centres_buf = gnl_centres_py.request();
+    py::buffer_info gnl_alphas_buf = gnl_alphas_py.request();
+    double *gnl_centres = (double*) gnl_centres_buf.ptr;
+    double *gnl_alphas = (double*) gnl_alphas_buf.ptr;
+    int dim_nl = nmax*(lmax+1);
+    int n_in, n_out;
+    vector<double> table;
+    {
+        py::gil_scoped_release release;
+        vector<double> gn(nmax), dgn(nmax), hl(lmax+1), dhl(lmax+1);
+        vector<double> gnl(dim_nl), dgnl(dim_nl);
+        radial_fct_t fct = [&](double r, double *f, double *df) {
+            double r2 = r*r;
+            double w, dw;
+            evaluate_weights_grad(&r, 1, r_cut, r_cut_width, &w, &dw);
+            evaluate_gnl_grad(&r, &r2, 1, gnl_centres, gnl_alphas, nmax, lmax,
+                gn.data(), dgn.data(), hl.data(), dhl.data(), 
+                gnl.data(), dgnl.data(),
+                part_sigma, wconstant, wscale, wcentre, ldamp);
+            for (int nl=0; nl<dim_nl; ++nl) {
+                f[nl] = w*gnl[nl];
+                df[nl] = dw*gnl[nl] + w*dgnl[nl];
+            }
+        };
+        table = build_radial_table(fct, dim_nl, 
+            r_cut-r_cut_width, r_cut, tol, n_in, n_out);
+    }
+    py::array_t<double> table_py({ (long) (n_in+n_out+1), (long) 2, (long) dim_nl });
+    std::copy(table.begin(), table.end(), (double*) table_py.request().ptr);
+    return py::make_tuple(table_py, n_in);
+}
+
+// Output rows can hold the double expansion coefficients in place
+inline double *coeffs_as_double(double *x) { return x; }
+inline double *coeffs_as_double(float *x) { return NULL; }
+
+template<typename T>
+void evaluate_gylm_system(
+        T *xitunkl, 
+        const NeighbourList &nl,
+        double *gnl_centres, 
+        double *gnl_alphas, 
+        const map<int, int> &type_index_map, 
         double r_cut, 
         double r_cut_width, 
-        int n_src, 
-        int n_tgt, 
         int n_types, 
         int nmax, 
         int lmax,
@@ -231,18 +465,24 @@ void evaluate_gylm(
         double wscale,
         double wcentre,
         double ldamp,
+        const double *radial_table,
+        int radial_n_in,
+        int radial_n_out,
+        const int *channels,
+        int n_channels,
         bool power,
-        bool verbose) {
+        bool verbose,
+        int n_threads,
+        int pooling=POOL_NONE,
+        bool normalize=false,
+        double epsilon=0.) {
 
-    // Get array pointers
-    double *xitunkl = (double*) coeffs.request().ptr;
-    double *gnl_centres = (double*) gnl_centres_py.request().ptr;
-    double *gnl_alphas = (double*) gnl_alphas_py.request().ptr;
-    double *spos = (double*) src_pos.request().ptr;
-    double *tpos = (double*) tgt_pos.request().ptr;
-    int *ttypes = (int*) tgt_types.request().ptr;
-
-    // System info
+    // System info: Neighbours (of the types in type_index_map only)
+    // come from nl, which has been built with a cutoff of r_cut
+    int n_src = nl.nCentres;
+    int n_tgt = nl.nPositions;
+    int n_nbs_max = nl.getMaxNeighbours();
+    const double *spos = nl.centres.data();
     if (verbose) {
         std::cout << "# targets, sources =" << n_tgt 
             << "," << n_src << std::endl;
@@ -250,36 +490,12 @@ void evaluate_gylm(
             std::cout << "src @ " << spos[3*i] << " " 
                 << spos[3*i+1] << " " << spos[3*i+2] << std::endl;
         }
-        for (int i=0; i<n_tgt; ++i) {
-            std::cout << ttypes[i] << " @ " << tpos[3*i] 
-                << " " << tpos[3*i+1] << " " << tpos[3*i+2] << std::endl;
-        }
         for (int i=0; i<nmax; ++i) {
             std::cout << "G of width " << gnl_alphas[i] 
                 << " @ " << gnl_centres[i] << std::endl;
         }
     }
 
-    // Cell list
-    GridSearch cell_list(tgt_pos, r_cut);
-
-    // Type mapping
-    auto tgt_types_list = tgt_types.unchecked<1>();
-    auto all_types_list = all_types.unchecked<1>();
-    map<int, int> type_index_map;
-    set<int> type_set;
-    for (int i=0; i<n_types; ++i) {
-        if (verbose) std::cout << "Register type " 
-            << all_types_list(i) << std::endl;
-        type_set.insert(all_types_list(i));
-    }
-    int type_index = 0;
-    for (auto it=type_set.begin(); it!=type_set.end(); ++it) {
-        if (verbose) std::cout << "Place type " 
-            << *it << " at index " << type_index << std::endl;
-        type_index_map[*it] = type_index++;
-    }
-
     // Ancillary arrays
     int dim_nl = nmax*(lmax+1);
     int dim_lm = (lmax+1)*(lmax+1);
@@ -293,83 +509,165 @@ void evaluate_gylm(
         lnorm_0, lnorm_1, lnorm_2,  lnorm_3,
         lnorm_4, lnorm_5, lnorm_6,  lnorm_7,
         lnorm_8, lnorm_9, lnorm_10, lnorm_11 };
-    // Deltas
-    double *dx   = (double*) malloc(sizeof(double)*n_tgt);
-    double *dy   = (double*) malloc(sizeof(double)*n_tgt);
-    double *dz   = (double*) malloc(sizeof(double)*n_tgt);
-    double *dr   = (double*) malloc(sizeof(double)*n_tgt);
-    double *dr2  = (double*) malloc(sizeof(double)*n_tgt);
-    // Weights, Gnl's, Ylm's
-    double *jw   = (double*) malloc(sizeof(double)*n_tgt);
-    double *jgnl = (double*) malloc(sizeof(double)*n_tgt*dim_nl);
-    double *jgn  = (double*) malloc(sizeof(double)*nmax);
-    double *jhl  = (double*) malloc(sizeof(double)*(lmax+1));
-    double *jylm = (double*) malloc(sizeof(double)*n_tgt*dim_lm);
-    // Qtnlm's
+    // Selected channels (power spectrum only), compact output rows
+    vector<int> chan_a, chan_b, chan_l;
+    bool selected = (power && channels != NULL);
+    if (selected) get_channel_offsets(channels, n_channels, n_types, nmax, lmax,
+        chan_a, chan_b, chan_l);
+    // Pooling: Rows of one centre at a time are (normalized and) added 
+    // to the accumulator of its block of centres, xitunkl then holds a 
+    // single row
+    bool pooled = (pooling != POOL_NONE);
+    int dim_out = (selected) ? n_channels : ((power) ? dim_tunkl : dim_tnlm);
+    vector<vector<double> > pool_accs;
+    // Qtnlm's: Always accumulated in double, in single precision 
+    // mode they are cast to T only in the contractions or on output
     double *qitnlm = NULL;
-    if (power) {
+    if (!power && !pooled) qitnlm = coeffs_as_double(xitunkl);
+    bool own_qitnlm = (qitnlm == NULL && !pooled);
+    if (own_qitnlm) {
         qitnlm = (double*) malloc(sizeof(double)*dim_itnlm);
         for (int i=0; i<dim_itnlm; ++i) qitnlm[i] = 0.;
     }
-    else {
-        qitnlm = xitunkl;
-    }
+
+    // Threads: Blocks of centres are distributed dynamically, each thread 
+    // owns its scratch and writes to disjoint slices of qitnlm, xitunkl
+#ifdef _OPENMP
+    if (n_threads < 1) n_threads = omp_get_max_threads();
+    if (verbose) n_threads = 1;
+#else
+    n_threads = 1;
+#endif
+    int block_size = (pooled) ? pool_block_size(n_src) : 4;
+    int n_blocks = (n_src + block_size - 1)/block_size;
+    if (pooled) pool_accs.assign(n_blocks, vector<double>(dim_out, 0.));
 
     // Expansion loop
-    int src_pos_idx = -1;
-    for (int src_idx=0; src_idx<n_src; ++src_idx) {
-        double xi = spos[++src_pos_idx];
-        double yi = spos[++src_pos_idx];
-        double zi = spos[++src_pos_idx];
-        if (verbose) {
-            std::cout << std::endl;
-            std::cout << "Src @ " << xi << " " << yi << " " << zi << std::endl;
-        }
-        GridSearchResult nbs = cell_list.getNeighboursForPosition(xi, yi, zi);
-        map<int, vector<int>> nb_type_map;
-        for (const int &j : nbs.indices) {
-            int t = tgt_types_list(j);
-            nb_type_map[t].push_back(j);
-        }
-        set<int> nb_type_indices;
-        for (const auto &nbs_of_type : nb_type_map) {
-            int type_index = type_index_map[nbs_of_type.first];
-            int n_nbs_of_type = nbs_of_type.second.size();
-            nb_type_indices.insert(type_index);
+    #pragma omp parallel num_threads(n_threads)
+    {
+    // Pooling: Rows of the current centre and the block's accumulator
+    double *q_row = NULL;
+    T *x_row = NULL;
+    double *pool_acc = NULL;
+    if (pooled) {
+        q_row = (double*) malloc(sizeof(double)*dim_tnlm);
+        x_row = (T*) malloc(sizeof(T)*dim_out);
+    }
+    // Deltas
+    T *dx   = (T*) malloc(sizeof(T)*n_nbs_max);
+    T *dy   = (T*) malloc(sizeof(T)*n_nbs_max);
+    T *dz   = (T*) malloc(sizeof(T)*n_nbs_max);
+    T *dr   = (T*) malloc(sizeof(T)*n_nbs_max);
+    T *dr2  = (T*) malloc(sizeof(T)*n_nbs_max);
+    // Weights, Gnl's, Ylm's
+    T *jw   = (T*) malloc(sizeof(T)*n_nbs_max);
+    T *jgnl = (T*) malloc(sizeof(T)*n_nbs_max*dim_nl);
+    T *jgn  = (T*) malloc(sizeof(T)*nmax);
+    T *jhl  = (T*) malloc(sizeof(T)*(lmax+1));
+    T *jylm = (T*) malloc(sizeof(T)*n_nbs_max*dim_lm);
+    // Contraction scratch
+    T *xa_buf = (T*) malloc(sizeof(T)*n_types*nmax*(2*lmax+1));
+    T *xg_buf = (T*) malloc(sizeof(T)*n_types*nmax*n_types*nmax);
+
+    #pragma omp for schedule(dynamic, 1)
+    for (int block=0; block<n_blocks; ++block) {
+        if (pooled) pool_acc = pool_accs[block].data();
+        int src_end = min(n_src, (block+1)*block_size);
+        for (int src_idx=block*block_size; src_idx<src_end; ++src_idx) {
+            double xi = spos[3*src_idx];
+            double yi = spos[3*src_idx+1];
+            double zi = spos[3*src_idx+2];
             if (verbose) {
-                std::cout << "Src " << src_idx << " : " << n_nbs_of_type 
-                    << " nbs of type " << type_index << std::endl;
+                std::cout << std::endl;
+                std::cout << "Src @ " << xi << " " << yi << " " << zi << std::endl;
             }
-            evaluate_deltas(xi, yi, zi, tpos, 
-                dx, dy, dz, dr, dr2, 
-                nbs_of_type.second);
-            if (verbose) {
-                for (int j=0; j<n_nbs_of_type; ++j) {
-                    std::cout << "  " << dx[j] << " " << dy[j] << " " << dz[j] 
-                        << " r=" << dr[j] << std::endl;
+            set<int> nb_type_indices;
+            if (pooled) {
+                for (int i=0; i<dim_tnlm; ++i) q_row[i] = 0.;
+            }
+            for (long g=nl.centreGroups[src_idx]; g<nl.centreGroups[src_idx+1]; ++g) {
+                int type_index = type_index_map.at(nl.groupTypes[g]);
+                int n_nbs_of_type = nl.groupOffsets[g+1] - nl.groupOffsets[g];
+                nb_type_indices.insert(type_index);
+                if (verbose) {
+                    std::cout << "Src " << src_idx << " : " << n_nbs_of_type 
+                        << " nbs of type " << type_index << std::endl;
+                }
+                evaluate_deltas(nl, nl.groupOffsets[g], nl.groupOffsets[g+1],
+                    dx, dy, dz, dr, dr2);
+                if (verbose) {
+                    for (int j=0; j<n_nbs_of_type; ++j) {
+                        std::cout << "  " << dx[j] << " " << dy[j] << " " << dz[j] 
+                            << " r=" << dr[j] << std::endl;
+                    }
+                }
+                // Weight coefficients, Gnl's, Ylm's
+                if (radial_table) {
+                    // Tabulated product of cutoff weight and Gnl's
+                    for (int j=0; j<n_nbs_of_type; ++j) jw[j] = 1.;
+                    interpolate_radial_table(radial_table, dim_nl, 
+                        radial_n_in, radial_n_out, r_cut-r_cut_width, r_cut,
+                        dr, n_nbs_of_type, jgnl);
+                } else {
+                    evaluate_weights(dr, n_nbs_of_type, 
+                        r_cut, r_cut_width, jw);
+                    evaluate_gnl(dr, dr2, n_nbs_of_type, 
+                        gnl_centres, gnl_alphas, nmax, lmax, jgn, jhl, jgnl,
+                        part_sigma, wconstant, wscale, wcentre, ldamp);
+                }
+                evaluate_ylm(dx, dy, dz, dr,
+                    n_nbs_of_type, lmax, jylm);
+                // Expansion coefficients Qnlm's
+                int offset_idx = ((pooled) ? 0 : src_idx*dim_tnlm) + type_index*dim_nlm;
+                if (verbose) {
+                    std::cout << "  Store @ " << offset_idx 
+                        << ", length = " << dim_nlm << std::endl;
                 }
+                evaluate_qitnlm(jw, jgnl, jylm, n_nbs_of_type, 
+                    nmax, lmax, offset_idx, dim_nlm, dim_nl, dim_lm,
+                    (pooled) ? q_row : qitnlm);
             }
-            // Weight coefficients, Gnl's, Ylm's
-            evaluate_weights(dr, n_nbs_of_type, 
-                r_cut, r_cut_width, jw);
-            evaluate_gnl(dr, dr2, n_nbs_of_type, 
-                gnl_centres, gnl_alphas, nmax, lmax, jgn, jhl, jgnl,
-                part_sigma, wconstant, wscale, wcentre, ldamp);
-            evaluate_ylm(dx, dy, dz, dr,
-                n_nbs_of_type, lmax, jylm);
-            // Expansion coefficients Qnlm's
-            int offset_idx = src_idx*dim_tnlm + type_index*dim_nlm;
-            if (verbose) {
-                std::cout << "  Store @ " << offset_idx 
-                    << ", length = " << dim_nlm << std::endl;
+            // Contractions for this source
+            if (pooled) {
+                if (selected) evaluate_xtunkl_selected(x_row, q_row, 
+                    lnorm, chan_a, chan_b, chan_l);
+                else if (power) {
+                    for (int i=0; i<dim_out; ++i) x_row[i] = 0.;
+                    evaluate_xtunkl(x_row, q_row, lnorm, 0, nb_type_indices,
+                        n_types, nmax, lmax, dim_tunkl, dim_nkl, dim_tnlm, dim_nlm, dim_lm,
+                        xa_buf, xg_buf);
+                }
+                if (power) pool_row(pool_acc, x_row, dim_out, normalize, epsilon);
+                else pool_row(pool_acc, q_row, dim_out, normalize, epsilon);
             }
-            evaluate_qitnlm(jw, jgnl, jylm, n_nbs_of_type, 
-                nmax, lmax, offset_idx, dim_nlm, dim_nl, dim_lm,
-                qitnlm);
+            else if (selected) evaluate_xtunkl_selected(xitunkl + src_idx*n_channels, 
+                qitnlm + src_idx*dim_tnlm, lnorm, chan_a, chan_b, chan_l);
+            else if (power) evaluate_xtunkl(xitunkl, qitnlm, lnorm, src_idx, nb_type_indices,
+                n_types, nmax, lmax, dim_tunkl, dim_nkl, dim_tnlm, dim_nlm, dim_lm,
+                xa_buf, xg_buf);
         }
-        // Contractions for this source
-        if (power) evaluate_xtunkl(xitunkl, qitnlm, lnorm, src_idx, nb_type_indices,
-            n_types, nmax, lmax, dim_tunkl, dim_nkl, dim_tnlm, dim_nlm, dim_lm);
+    }
+
+    free(dx);
+    free(dy);
+    free(dz);
+    free(dr);
+    free(dr2);
+    free(jw);
+    free(jgnl);
+    free(jgn);
+    free(jhl);
+    free(jylm);
+    free(xa_buf);
+    free(xg_buf);
+    if (pooled) {
+        free(q_row);
+        free(x_row);
+    }
+    }
+    if (pooled) {
+        pool_reduce(xitunkl, pool_accs, dim_out, pooling, n_src);
+        return;
     }
 
     // Contractions
@@ -385,20 +683,542 @@ void evaluate_gylm(
     // >>>         nmax, lmax, dim_tnlm, dim_nlm, dim_lm);
     // >>> }
 
+    if (own_qitnlm) {
+        if (!power) {
+            for (int i=0; i<dim_itnlm; ++i) xitunkl[i] = qitnlm[i];
+        }
+        free(qitnlm);
+    }
+    return;
+}
+
+
+
+bool is_single_precision(py::buffer_info &buf) {
+    // The precision of the evaluation follows the output array
+    if (buf.format == py::format_descriptor<float>::format()) return true;
+    if (buf.format == py::format_descriptor<double>::format()) return false;
+    throw std::invalid_argument("Output array must be of type float32 or float64");
+}
+
+void evaluate_gylm(
+        py::array coeffs, 
+        py::array_t<double> src_pos, 
+        py::array_t<double> tgt_pos, 
+        py::array_t<double> gnl_centres_py, 
+        py::array_t<double> gnl_alphas_py, 
+        py::array_t<int> tgt_types, 
+        py::array_t<int> all_types, 
+        py::array_t<double> cell, 
+        py::array_t<bool> pbc, 
+        double r_cut, 
+        double r_cut_width, 
+        int n_src, 
+        int n_tgt, 
+        int n_types, 
+        int nmax, 
+        int lmax,
+        double part_sigma,
+        bool wconstant,
+        double wscale,
+        double wcentre,
+        double ldamp,
+        py::array_t<double> radial_table_py,
+        int radial_n_in,
+        py::array_t<int> channels_py,
+        bool power,
+        bool verbose,
+        int n_threads,
+        int pooling,
+        bool normalize,
+        double epsilon) {
+
+    // Pin array buffers: The numeric part below runs without the GIL
+    py::buffer_info coeffs_buf = coeffs.request();
+    py::buffer_info gnl_centres_buf = gnl_centres_py.request();
+    py::buffer_info gnl_alphas_buf = gnl_alphas_py.request();
+    py::buffer_info spos_buf = src_pos.request();
+    py::buffer_info tpos_buf = tgt_pos.request();
+    py::buffer_info ttypes_buf = tgt_types.request();
+    py::buffer_info all_types_buf = all_types.request();
+    py::buffer_info cell_buf = cell.request();
+    py::buffer_info pbc_buf = pbc.request();
+    const double *cell_ptr = NULL;
+    const bool *pbc_ptr = NULL;
+    getPeriodicCell(cell_buf, pbc_buf, cell_ptr, pbc_ptr);
+    bool single = is_single_precision(coeffs_buf);
+    double *gnl_centres = (double*) gnl_centres_buf.ptr;
+    double *gnl_alphas = (double*) gnl_alphas_buf.ptr;
+    double *spos = (double*) spos_buf.ptr;
+    double *tpos = (double*) tpos_buf.ptr;
+    int *ttypes = (int*) ttypes_buf.ptr;
+    int *atypes = (int*) all_types_buf.ptr;
+    py::buffer_info radial_table_buf = radial_table_py.request();
+    double *radial_table = NULL;
+    int radial_n_out = 0;
+    get_radial_table_layout(radial_table_buf, nmax*(lmax+1), radial_n_in,
+        radial_table, radial_n_out);
+    py::buffer_info channels_buf = channels_py.request();
+    int n_channels = channels_buf.size;
+    int *channels = get_channels(channels_buf, n_types, nmax, lmax);
+    // Unknown types are rejected here: Exceptions cannot leave the 
+    // parallel region of evaluate_gylm_system
+    map<int, int> type_index_map = get_type_index_map(atypes, n_types, verbose);
+    for (int j=0; j<n_tgt; ++j) {
+        if (type_index_map.count(ttypes[j]) == 0) {
+            throw std::invalid_argument("Targets contain unknown types");
+        }
+    }
+    py::gil_scoped_release release;
+
+    NeighbourList nl(spos, n_src, tpos, ttypes, n_tgt, r_cut, n_threads, cell_ptr, pbc_ptr);
+    if (single) evaluate_gylm_system((float*) coeffs_buf.ptr, 
+        nl, gnl_centres, gnl_alphas, 
+        type_index_map, r_cut, r_cut_width, 
+        n_types, nmax, lmax,
+        part_sigma, wconstant, wscale, wcentre, ldamp,
+        radial_table, radial_n_in, radial_n_out, channels, n_channels,
+        power, verbose, n_threads, pooling, normalize, epsilon);
+    else evaluate_gylm_system((double*) coeffs_buf.ptr, 
+        nl, gnl_centres, gnl_alphas, 
+        type_index_map, r_cut, r_cut_width, 
+        n_types, nmax, lmax,
+        part_sigma, wconstant, wscale, wcentre, ldamp,
+        radial_table, radial_n_in, radial_n_out, channels, n_channels,
+        power, verbose, n_threads, pooling, normalize, epsilon);
+}
+
+void evaluate_gylm_neighbours(
+        py::array coeffs, 
+        const NeighbourList &nl_in,
+        py::array_t<double> gnl_centres_py, 
+        py::array_t<double> gnl_alphas_py, 
+        py::array_t<int> all_types, 
+        double r_cut, 
+        double r_cut_width, 
+        int n_types, 
+        int nmax, 
+        int lmax,
+        double part_sigma,
+        bool wconstant,
+        double wscale,
+        double wcentre,
+        double ldamp,
+        py::array_t<double> radial_table_py,
+        int radial_n_in,
+        py::array_t<int> channels_py,
+        bool power,
+        int n_threads,
+        int pooling,
+        bool normalize,
+        double epsilon) {
+    // As evaluate_gylm, for the centres and neighbours of a prebuilt
+    // neighbour list. A list with a larger cutoff is filtered to r_cut.
+    py::buffer_info coeffs_buf = coeffs.request();
+    py::buffer_info gnl_centres_buf = gnl_centres_py.request();
+    py::buffer_info gnl_alphas_buf = gnl_alphas_py.request();
+    py::buffer_info all_types_buf = all_types.request();
+    bool single = is_single_precision(coeffs_buf);
+    double *gnl_centres = (double*) gnl_centres_buf.ptr;
+    double *gnl_alphas = (double*) gnl_alphas_buf.ptr;
+    int *atypes = (int*) all_types_buf.ptr;
+    py::buffer_info radial_table_buf = radial_table_py.request();
+    double *radial_table = NULL;
+    int radial_n_out = 0;
+    get_radial_table_layout(radial_table_buf, nmax*(lmax+1), radial_n_in,
+        radial_table, radial_n_out);
+    py::buffer_info channels_buf = channels_py.request();
+    int n_channels = channels_buf.size;
+    int *channels = get_channels(channels_buf, n_types, nmax, lmax);
+    if (nl_in.cutoff < r_cut) {
+        throw std::invalid_argument("Neighbour list cutoff smaller than r_cut");
+    }
+    map<int, int> type_index_map = get_type_index_map(atypes, n_types, false);
+    for (const int &t : nl_in.groupTypes) {
+        if (type_index_map.count(t) == 0) {
+            throw std::invalid_argument("Neighbour list contains unknown types");
+        }
+    }
+    py::gil_scoped_release release;
+
+    NeighbourList nl_filtered = (nl_in.cutoff > r_cut) ? nl_in.filter(r_cut) : NeighbourList();
+    const NeighbourList &nl = (nl_in.cutoff > r_cut) ? nl_filtered : nl_in;
+    if (single) evaluate_gylm_system((float*) coeffs_buf.ptr, 
+        nl, gnl_centres, gnl_alphas, 
+        type_index_map, r_cut, r_cut_width, 
+        n_types, nmax, lmax,
+        part_sigma, wconstant, wscale, wcentre, ldamp,
+        radial_table, radial_n_in, radial_n_out, channels, n_channels,
+        power, false, n_threads, pooling, normalize, epsilon);
+    else evaluate_gylm_system((double*) coeffs_buf.ptr, 
+        nl, gnl_centres, gnl_alphas, 
+        type_index_map, r_cut, r_cut_width, 
+        n_types, nmax, lmax,
+        part_sigma, wconstant, wscale, wcentre, ldamp,
+        radial_table, radial_n_in, radial_n_out, channels, n_channels,
+        power, false, n_threads, pooling, normalize, epsilon);
+}
+
+void evaluate_gylm_batch(
+        py::array coeffs, 
+        py::array_t<double> src_pos, 
+        py::array_t<double> tgt_pos, 
+        py::array_t<double> gnl_centres_py, 
+        py::array_t<double> gnl_alphas_py, 
+        py::array_t<int> tgt_types, 
+        py::array_t<int> all_types, 
+        py::array_t<int> n_src_per_struct,
+        py::array_t<int> n_tgt_per_struct,
+        double r_cut, 
+        double r_cut_width, 
+        int n_structs, 
+        int n_types, 
+        int nmax, 
+        int lmax,
+        double part_sigma,
+        bool wconstant,
+        double wscale,
+        double wcentre,
+        double ldamp,
+        py::array_t<double> radial_table_py,
+        int radial_n_in,
+        py::array_t<int> channels_py,
+        bool power,
+        int n_threads,
+        int pooling,
+        bool normalize,
+        double epsilon) {
+
+    py::buffer_info coeffs_buf = coeffs.request();
+    py::buffer_info gnl_centres_buf = gnl_centres_py.request();
+    py::buffer_info gnl_alphas_buf = gnl_alphas_py.request();
+    py::buffer_info spos_buf = src_pos.request();
+    py::buffer_info tpos_buf = tgt_pos.request();
+    py::buffer_info ttypes_buf = tgt_types.request();
+    py::buffer_info all_types_buf = all_types.request();
+    py::buffer_info n_src_buf = n_src_per_struct.request();
+    py::buffer_info n_tgt_buf = n_tgt_per_struct.request();
+    bool single = is_single_precision(coeffs_buf);
+    double *gnl_centres = (double*) gnl_centres_buf.ptr;
+    double *gnl_alphas = (double*) gnl_alphas_buf.ptr;
+    double *spos = (double*) spos_buf.ptr;
+    double *tpos = (double*) tpos_buf.ptr;
+    int *ttypes = (int*) ttypes_buf.ptr;
+    int *atypes = (int*) all_types_buf.ptr;
+    int *n_src = (int*) n_src_buf.ptr;
+    int *n_tgt = (int*) n_tgt_buf.ptr;
+    py::buffer_info radial_table_buf = radial_table_py.request();
+    double *radial_table = NULL;
+    int radial_n_out = 0;
+    get_radial_table_layout(radial_table_buf, nmax*(lmax+1), radial_n_in,
+        radial_table, radial_n_out);
+    py::buffer_info channels_buf = channels_py.request();
+    int n_channels = channels_buf.size;
+    int *channels = get_channels(channels_buf, n_types, nmax, lmax);
+    // Unknown types are rejected here, as in evaluate_gylm
+    map<int, int> type_index_map = get_type_index_map(atypes, n_types, false);
+    long n_tgt_total = 0;
+    for (int s=0; s<n_structs; ++s) n_tgt_total += n_tgt[s];
+    for (long j=0; j<n_tgt_total; ++j) {
+        if (type_index_map.count(ttypes[j]) == 0) {
+            throw std::invalid_argument("Targets contain unknown types");
+        }
+    }
+    py::gil_scoped_release release;
+
+    int dim = (power) ?
+        n_types*(n_types+1)/2*nmax*nmax*(lmax+1) :
+        n_types*nmax*(lmax+1)*(lmax+1);
+    if (power && channels != NULL) dim = n_channels;
+    // Offsets of the packed structures
+    vector<long> src_off(n_structs+1, 0);
+    vector<long> tgt_off(n_structs+1, 0);
+    for (int s=0; s<n_structs; ++s) {
+        src_off[s+1] = src_off[s] + n_src[s];
+        tgt_off[s+1] = tgt_off[s] + n_tgt[s];
+    }
+
+#ifdef _OPENMP
+    if (n_threads < 1) n_threads = omp_get_max_threads();
+#else
+    n_threads = 1;
+#endif
+
+    // Structures are distributed over threads, each structure is 
+    // evaluated serially into its own block of rows, or with pooling
+    // into its single row
+    #pragma omp parallel for num_threads(n_threads) schedule(dynamic, 1)
+    for (int s=0; s<n_structs; ++s) {
+        if (n_src[s] == 0 || n_tgt[s] == 0) continue;
+        long row = (pooling != POOL_NONE) ? s : src_off[s];
+        NeighbourList nl(spos + 3*src_off[s], n_src[s], 
+            tpos + 3*tgt_off[s], ttypes + tgt_off[s], n_tgt[s], r_cut, 1);
+        if (single) evaluate_gylm_system((float*) coeffs_buf.ptr + row*dim, 
+            nl, gnl_centres, gnl_alphas, 
+            type_index_map, r_cut, r_cut_width, 
+            n_types, nmax, lmax,
+            part_sigma, wconstant, wscale, wcentre, ldamp,
+            radial_table, radial_n_in, radial_n_out, channels, n_channels,
+            power, false, 1, pooling, normalize, epsilon);
+        else evaluate_gylm_system((double*) coeffs_buf.ptr + row*dim, 
+            nl, gnl_centres, gnl_alphas, 
+            type_index_map, r_cut, r_cut_width, 
+            n_types, nmax, lmax,
+            part_sigma, wconstant, wscale, wcentre, ldamp,
+            radial_table, radial_n_in, radial_n_out, channels, n_channels,
+            power, false, 1, pooling, normalize, epsilon);
+    }
+}
+
+py::tuple evaluate_gylm_grad(
+        py::array_t<double> coeffs, 
+        py::array_t<double> src_pos, 
+        py::array_t<double> tgt_pos, 
+        py::array_t<double> gnl_centres_py, 
+        py::array_t<double> gnl_alphas_py, 
+        py::array_t<int> tgt_types, 
+        py::array_t<int> all_types, 
+        py::array_t<double> cell, 
+        py::array_t<bool> pbc, 
+        double r_cut, 
+        double r_cut_width, 
+        int n_src, 
+        int n_tgt, 
+        int n_types, 
+        int nmax, 
+        int lmax,
+        double part_sigma,
+        bool wconstant,
+        double wscale,
+        double wcentre,
+        double ldamp,
+        py::array_t<double> radial_table_py,
+        int radial_n_in,
+        bool power,
+        int n_threads) {
+    // Evaluates the descriptors into coeffs and returns their derivatives
+    // with respect to the neighbour positions in a sparse pair layout:
+    // grad[p,a,:] = d coeffs[pair_src[p],:] / d tgt_pos[pair_tgt[p],a].
+    // The centres are held fixed, so that the derivative with respect 
+    // to a centre position is minus the sum over its pairs. With a 
+    // periodic cell, pairs with different images of a target are not merged.
+    py::buffer_info coeffs_buf = coeffs.request();
+    py::buffer_info gnl_centres_buf = gnl_centres_py.request();
+    py::buffer_info gnl_alphas_buf = gnl_alphas_py.request();
+    py::buffer_info spos_buf = src_pos.request();
+    py::buffer_info tpos_buf = tgt_pos.request();
+    py::buffer_info ttypes_buf = tgt_types.request();
+    py::buffer_info all_types_buf = all_types.request();
+    py::buffer_info cell_buf = cell.request();
+    py::buffer_info pbc_buf = pbc.request();
+    const double *cell_ptr = NULL;
+    const bool *pbc_ptr = NULL;
+    getPeriodicCell(cell_buf, pbc_buf, cell_ptr, pbc_ptr);
+    double *xitunkl = (double*) coeffs_buf.ptr;
+    double *gnl_centres = (double*) gnl_centres_buf.ptr;
+    double *gnl_alphas = (double*) gnl_alphas_buf.ptr;
+    double *spos = (double*) spos_buf.ptr;
+    double *tpos = (double*) tpos_buf.ptr;
+    int *ttypes = (int*) ttypes_buf.ptr;
+    int *atypes = (int*) all_types_buf.ptr;
+    // With a radial table, its interpolant and Hermite derivative stand
+    // in for the weighted Gnl's, as in evaluate_gylm
+    py::buffer_info radial_table_buf = radial_table_py.request();
+    double *radial_table = NULL;
+    int radial_n_out = 0;
+    get_radial_table_layout(radial_table_buf, nmax*(lmax+1), radial_n_in,
+        radial_table, radial_n_out);
+
+    int dim_nl = nmax*(lmax+1);
+    int dim_lm = (lmax+1)*(lmax+1);
+    int dim_nlm = nmax*dim_lm;
+    int dim_tnlm = n_types*dim_nlm;
+    int dim_nkl = nmax*nmax*(lmax+1);
+    int dim_tunkl = n_types*(n_types+1)/2*dim_nkl;
+    int dim = (power) ? dim_tunkl : dim_tnlm;
+    vector<double> lnorm = { 
+        lnorm_0, lnorm_1, lnorm_2,  lnorm_3,
+        lnorm_4, lnorm_5, lnorm_6,  lnorm_7,
+        lnorm_8, lnorm_9, lnorm_10, lnorm_11 };
+#ifdef _OPENMP
+    if (n_threads < 1) n_threads = omp_get_max_threads();
+#else
+    n_threads = 1;
+#endif
+
+    // Neighbours per centre, grouped by type as in evaluate_gylm
+    map<int, int> type_index_map;
+    NeighbourList nl;
+    vector<int> nb_types;
+    {
+        py::gil_scoped_release release;
+        type_index_map = get_type_index_map(atypes, n_types, false);
+        nl = NeighbourList(spos, n_src, tpos, ttypes, n_tgt, r_cut, n_threads, 
+            cell_ptr, pbc_ptr);
+        nb_types.resize(nl.getNumberOfEntries());
+        for (long g=0; g<(long) nl.groupTypes.size(); ++g) {
+            int t = type_index_map.at(nl.groupTypes[g]);
+            for (long e=nl.groupOffsets[g]; e<nl.groupOffsets[g+1]; ++e) nb_types[e] = t;
+        }
+    }
+    const vector<long> &pair_off = nl.offsets;
+    int n_nbs_max = nl.getMaxNeighbours();
+    long n_pairs = pair_off[n_src];
+    py::array_t<double> grad_py({(long) n_pairs, (long) 3, (long) dim});
+    py::array_t<int> pair_src_py(n_pairs);
+    py::array_t<int> pair_tgt_py(n_pairs);
+    double *grad = (double*) grad_py.request().ptr;
+    int *pair_src = (int*) pair_src_py.request().ptr;
+    int *pair_tgt = (int*) pair_tgt_py.request().ptr;
+
+    {
+    py::gil_scoped_release release;
+    #pragma omp parallel num_threads(n_threads)
+    {
+    double *dx   = (double*) malloc(sizeof(double)*n_nbs_max);
+    double *dy   = (double*) malloc(sizeof(double)*n_nbs_max);
+    double *dz   = (double*) malloc(sizeof(double)*n_nbs_max);
+    double *dr   = (double*) malloc(sizeof(double)*n_nbs_max);
+    double *dr2  = (double*) malloc(sizeof(double)*n_nbs_max);
+    double *jw   = (double*) malloc(sizeof(double)*n_nbs_max);
+    double *jdw  = (double*) malloc(sizeof(double)*n_nbs_max);
+    double *jgnl = (double*) malloc(sizeof(double)*n_nbs_max*dim_nl);
+    double *jdgnl = (double*) malloc(sizeof(double)*n_nbs_max*dim_nl);
+    double *jgn  = (double*) malloc(sizeof(double)*nmax);
+    double *jdgn = (double*) malloc(sizeof(double)*nmax);
+    double *jhl  = (double*) malloc(sizeof(double)*(lmax+1));
+    double *jdhl = (double*) malloc(sizeof(double)*(lmax+1));
+    double *jylm = (double*) malloc(sizeof(double)*n_nbs_max*dim_lm);
+    double *jdylm = (double*) malloc(sizeof(double)*n_nbs_max*3*dim_lm);
+    double *qtnlm = (double*) malloc(sizeof(double)*dim_tnlm);
+    double *dqnlm = (double*) malloc(sizeof(double)*3*dim_nlm);
+    double *xa_buf = (double*) malloc(sizeof(double)*n_types*nmax*(2*lmax+1));
+    double *xg_buf = (double*) malloc(sizeof(double)*n_types*nmax*n_types*nmax);
+
+    #pragma omp for schedule(dynamic, 4)
+    for (int i=0; i<n_src; ++i) {
+        const int *nbs = nl.indices.data() + pair_off[i];
+        const int *nbs_types = nb_types.data() + pair_off[i];
+        int n_nbs = pair_off[i+1] - pair_off[i];
+        double *xi_out = xitunkl + (long) i*dim;
+        double *qi = (power) ? qtnlm : xi_out;
+        // Deltas, weights, Gnl's, Ylm's and their derivatives
+        evaluate_deltas(nl, pair_off[i], pair_off[i+1], dx, dy, dz, dr, dr2);
+        if (radial_table) {
+            for (int j=0; j<n_nbs; ++j) {
+                jw[j] = 1.;
+                jdw[j] = 0.;
+            }
+            interpolate_radial_table_grad(radial_table, dim_nl, 
+                radial_n_in, radial_n_out, r_cut-r_cut_width, r_cut,
+                dr, n_nbs, jgnl, jdgnl);
+        } else {
+            evaluate_weights_grad(dr, n_nbs, r_cut, r_cut_width, jw, jdw);
+            evaluate_gnl_grad(dr, dr2, n_nbs, 
+                gnl_centres, gnl_alphas, nmax, lmax, 
+                jgn, jdgn, jhl, jdhl, jgnl, jdgnl,
+                part_sigma, wconstant, wscale, wcentre, ldamp);
+        }
+        evaluate_ylm_grad(dx, dy, dz, dr, n_nbs, lmax, jylm, jdylm);
+        // Expansion coefficients by type
+        for (int tnlm=0; tnlm<dim_tnlm; ++tnlm) qi[tnlm] = 0.;
+        set<int> nb_type_indices;
+        int j0 = 0;
+        while (j0 < n_nbs) {
+            int t = nbs_types[j0];
+            int j1 = j0;
+            while (j1 < n_nbs && nbs_types[j1] == t) ++j1;
+            nb_type_indices.insert(t);
+            evaluate_qitnlm(jw+j0, jgnl+j0*dim_nl, jylm+j0*dim_lm, j1-j0, 
+                nmax, lmax, t*dim_nlm, dim_nlm, dim_nl, dim_lm, qi);
+            j0 = j1;
+        }
+        if (power) evaluate_xtunkl(xi_out, qi, lnorm, 0, nb_type_indices,
+            n_types, nmax, lmax, dim_tunkl, dim_nkl, dim_tnlm, dim_nlm, dim_lm,
+            xa_buf, xg_buf);
+        // Derivatives per neighbour
+        for (int jj=0; jj<n_nbs; ++jj) {
+            long p = pair_off[i] + jj;
+            int s = nbs_types[jj];
+            pair_src[p] = i;
+            pair_tgt[p] = nbs[jj];
+            double *gp = grad + p*3*dim;
+            for (int c=0; c<3*dim; ++c) gp[c] = 0.;
+            if (dr[jj] < radial_epsilon) continue;
+            double u[3] = { dx[jj]/dr[jj], dy[jj]/dr[jj], dz[jj]/dr[jj] };
+            double *ylm = jylm + jj*dim_lm;
+            double *dylm = jdylm + jj*3*dim_lm;
+            for (int a=0; a<3; ++a) {
+                double *dq = dqnlm + a*dim_nlm;
+                int c_nl = jj*dim_nl;
+                int c_nlm = 0;
+                for (int n=0; n<nmax; ++n) {
+                    for (int l=0; l<lmax+1; ++l) {
+                        double wg = jw[jj]*jgnl[c_nl];
+                        double dwg = (jdw[jj]*jgnl[c_nl] + jw[jj]*jdgnl[c_nl])*u[a];
+                        for (int lm=l*l; lm<(l+1)*(l+1); ++lm) {
+                            dq[c_nlm + lm] = dwg*ylm[lm] + wg*dylm[a*dim_lm+lm];
+                        }
+                        ++c_nl;
+                    }
+                    c_nlm += dim_lm;
+                }
+            }
+            if (!power) {
+                for (int a=0; a<3; ++a) {
+                    for (int nlm=0; nlm<dim_nlm; ++nlm) {
+                        gp[a*dim + s*dim_nlm + nlm] = dqnlm[a*dim_nlm + nlm];
+                    }
+                }
+                continue;
+            }
+            // d/dr (q_t q_u) = dq_t q_u + q_t dq_u, with dq nonzero for t = s only
+            for (int t=0; t<n_types; ++t) {
+                for (int u_=t; u_<n_types; ++u_) {
+                    if (t != s && u_ != s) continue;
+                    int tu_off = (t*n_types - t*(t+1)/2 + u_)*dim_nkl;
+                    for (int a=0; a<3; ++a) {
+                        double *dq = dqnlm + a*dim_nlm;
+                        double *out = gp + a*dim + tu_off;
+                        int nkl = 0;
+                        for (int n=0; n<nmax; ++n) {
+                            for (int k=0; k<nmax; ++k) {
+                                for (int l=0; l<lmax+1; ++l) {
+                                    double x = 0.;
+                                    for (int lm=l*l; lm<(l+1)*(l+1); ++lm) {
+                                        if (t == s) x += dq[n*dim_lm+lm]*qi[u_*dim_nlm + k*dim_lm + lm];
+                                        if (u_ == s) x += qi[t*dim_nlm + n*dim_lm + lm]*dq[k*dim_lm+lm];
+                                    }
+                                    out[nkl++] = lnorm[l]*x;
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
     free(dx);
     free(dy);
     free(dz);
     free(dr);
     free(dr2);
     free(jw);
+    free(jdw);
     free(jgnl);
+    free(jdgnl);
     free(jgn);
+    free(jdgn);
     free(jhl);
+    free(jdhl);
     free(jylm);
-    if (power) {
-        free(qitnlm);
+    free(jdylm);
+    free(qtnlm);
+    free(dqnlm);
+    free(xa_buf);
+    free(xg_buf);
     }
-    return;
+    }
+    return py::make_tuple(grad_py, pair_src_py, pair_tgt_py);
 }
-
-
@@ -3,6 +3,7 @@
 
 #include <vector>
 #include <pybind11/numpy.h>
+#include "neighbourlist.hpp"
 
 namespace py = pybind11;
 using namespace std;
@@ -15,14 +16,30 @@ void _py_evaluate_xtunkl(
     int nmax,
     int lmax);
 
+py::tuple build_gylm_radial_table(
+    py::array_t<double> gnl_centres, 
+    py::array_t<double> gnl_alphas, 
+    int nmax, 
+    int lmax,
+    double r_cut, 
+    double r_cut_width, 
+    double part_sigma,
+    bool wconstant,
+    double wscale,
+    double wcentre,
+    double ldamp,
+    double tol);
+
 void evaluate_gylm(
-    py::array_t<double> coeffs, 
+    py::array coeffs, 
     py::array_t<double> tgt_pos, 
     py::array_t<double> src_pos, 
     py::array_t<double> gnl_centres, 
     py::array_t<double> gnl_alphas, 
     py::array_t<int> tgt_types, 
     py::array_t<int> all_types, 
+    py::array_t<double> cell, 
+    py::array_t<bool> pbc, 
     double r_cut, 
     double r_cut_width, 
     int n_src, 
@@ -35,7 +52,96 @@ void evaluate_gylm(
     double wscale,
     double wcentre,
     double ldamp,
+    py::array_t<double> radial_table,
+    int radial_n_in,
+    py::array_t<int> channels,
+    bool power,
+    bool verbose,
+    int n_threads,
+    int pooling,
+    bool normalize,
+    double epsilon);
+
+void evaluate_gylm_neighbours(
+    py::array coeffs, 
+    const NeighbourList &nl,
+    py::array_t<double> gnl_centres, 
+    py::array_t<double> gnl_alphas, 
+    py::array_t<int> all_types, 
+    double r_cut, 
+    double r_cut_width, 
+    int n_types, 
+    int nmax, 
+    int lmax,
+    double part_sigma,
+    bool wconstant,
+    double wscale,
+    double wcentre,
+    double ldamp,
+    py::array_t<double> radial_table,
+    int radial_n_in,
+    py::array_t<int> channels,
+    bool power,
+    int n_threads,
+    int pooling,
+    bool normalize,
+    double epsilon);
+
+py::tuple evaluate_gylm_grad(
+    py::array_t<double> coeffs, 
+    py::array_t<double> src_pos, 
+    py::array_t<double> tgt_pos, 
+    py::array_t<double> gnl_centres, 
+    py::array_t<double> gnl_alphas, 
+    py::array_t<int> tgt_types, 
+    py::array_t<int> all_types, 
+    py::array_t<double> cell, 
+    py::array_t<bool> pbc, 
+    double r_cut, 
+    double r_cut_width, 
+    int n_src, 
+    int n_tgt, 
+    int n_types, 
+    int nmax, 
+    int lmax,
+    double part_sigma,
+    bool wconstant,
+    double wscale,
+    double wcentre,
+    double ldamp,
+    py::array_t<double> radial_table,
+    int radial_n_in,
+    bool power,
+    int n_threads);
+
+void evaluate_gylm_batch(
+    py::array coeffs, 
+    py::array_t<double> src_pos, 
+    py::array_t<double> tgt_pos, 
+    py::array_t<double> gnl_centres, 
+    py::array_t<double> gnl_alphas, 
+    py::array_t<int> tgt_types, 
+    py::array_t<int> all_types, 
+    py::array_t<int> n_src_per_struct, 
+    py::array_t<int> n_tgt_per_struct, 
+    double r_cut, 
+    double r_cut_width, 
+    int n_structs, 
+    int n_types, 
+    int nmax, 
+    int lmax,
+    double part_sigma,
+    bool wconstant,
+    double wscale,
+    double wcentre,
+    double ldamp,
+    py::array_t<double> radial_table,
+    int radial_n_in,
+    py::array_t<int> channels,
     bool power,
-    bool verbose);
+    int n_threads,
+    int pooling,
+    bool normalize,
+    double epsilon);
 
 #endif
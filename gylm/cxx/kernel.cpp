@@ -22,8 +22,11 @@ void smooth_match(
     double ay = 1./ny;
     double lambda = 1./gamma;
 
-    double *K = (double*) arg_K.request().ptr;
-    double *P = (double*) arg_P.request().ptr;
+    py::buffer_info K_buf = arg_K.request();
+    py::buffer_info P_buf = arg_P.request();
+    double *K = (double*) K_buf.ptr;
+    double *P = (double*) P_buf.ptr;
+    py::gil_scoped_release release;
 
     double* u = (double*) malloc(sizeof(double)*nx);
     double* u_in = (double*) malloc(sizeof(double)*nx);
@@ -0,0 +1,84 @@
+#include "linalg.hpp"
+#ifdef GYLM_CBLAS
+#include <cblas.h>
+#endif
+
+template<typename T>
+inline void gemm_nt_tile(int mb, int nb, int K, 
+        const T *A, int lda, const T *B, int ldb, 
+        T *C, int ldc) {
+    // Edge tiles (mb, nb < 4)
+    for (int i=0; i<mb; ++i) {
+        for (int j=0; j<nb; ++j) {
+            T x = 0.;
+            for (int k=0; k<K; ++k) x += A[i*lda+k]*B[j*ldb+k];
+            C[i*ldc+j] = x;
+        }
+    }
+}
+
+template<typename T>
+void gemm_nt_kernel(int M, int N, int K, 
+        const T *A, int lda, 
+        const T *B, int ldb, 
+        T *C, int ldc) {
+    int M4 = M - M%4;
+    int N4 = N - N%4;
+    for (int i=0; i<M4; i+=4) {
+        const T *a0 = A + i*lda;
+        const T *a1 = a0 + lda;
+        const T *a2 = a1 + lda;
+        const T *a3 = a2 + lda;
+        for (int j=0; j<N4; j+=4) {
+            const T *b0 = B + j*ldb;
+            const T *b1 = b0 + ldb;
+            const T *b2 = b1 + ldb;
+            const T *b3 = b2 + ldb;
+            T c00 = 0., c01 = 0., c02 = 0., c03 = 0.;
+            T c10 = 0., c11 = 0., c12 = 0., c13 = 0.;
+            T c20 = 0., c21 = 0., c22 = 0., c23 = 0.;
+            T c30 = 0., c31 = 0., c32 = 0., c33 = 0.;
+            for (int k=0; k<K; ++k) {
+                T x0 = a0[k], x1 = a1[k], x2 = a2[k], x3 = a3[k];
+                T y0 = b0[k], y1 = b1[k], y2 = b2[k], y3 = b3[k];
+                c00 += x0*y0; c01 += x0*y1; c02 += x0*y2; c03 += x0*y3;
+                c10 += x1*y0; c11 += x1*y1; c12 += x1*y2; c13 += x1*y3;
+                c20 += x2*y0; c21 += x2*y1; c22 += x2*y2; c23 += x2*y3;
+                c30 += x3*y0; c31 += x3*y1; c32 += x3*y2; c33 += x3*y3;
+            }
+            T *c = C + i*ldc + j;
+            c[0] = c00; c[1] = c01; c[2] = c02; c[3] = c03; c += ldc;
+            c[0] = c10; c[1] = c11; c[2] = c12; c[3] = c13; c += ldc;
+            c[0] = c20; c[1] = c21; c[2] = c22; c[3] = c23; c += ldc;
+            c[0] = c30; c[1] = c31; c[2] = c32; c[3] = c33;
+        }
+        if (N4 < N) gemm_nt_tile(4, N-N4, K, a0, lda, B + N4*ldb, ldb, 
+            C + i*ldc + N4, ldc);
+    }
+    if (M4 < M) gemm_nt_tile(M-M4, N, K, A + M4*lda, lda, B, ldb, 
+        C + M4*ldc, ldc);
+}
+
+void gemm_nt(int M, int N, int K, 
+        const double *A, int lda, 
+        const double *B, int ldb, 
+        double *C, int ldc) {
+#ifdef GYLM_CBLAS
+    cblas_dgemm(CblasRowMajor, CblasNoTrans, CblasTrans, 
+        M, N, K, 1.0, A, lda, B, ldb, 0.0, C, ldc);
+#else
+    gemm_nt_kernel(M, N, K, A, lda, B, ldb, C, ldc);
+#endif
+}
+
+void gemm_nt(int M, int N, int K, 
+        const float *A, int lda, 
+        const float *B, int ldb, 
+        float *C, int ldc) {
+#ifdef GYLM_CBLAS
+    cblas_sgemm(CblasRowMajor, CblasNoTrans, CblasTrans, 
+        M, N, K, 1.0f, A, lda, B, ldb, 0.0f, C, ldc);
+#else
+    gemm_nt_kernel(M, N, K, A, lda, B, ldb, C, ldc);
+#endif
+}
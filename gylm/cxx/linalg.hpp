@@ -0,0 +1,18 @@
+#ifndef LINALG_EXT_HPP 
+#define LINALG_EXT_HPP 
+
+// C = A B^T with row-major A (M x K), B (N x K), C (M x N).
+// Dispatches to cblas_{d,s}gemm if compiled with GYLM_CBLAS, otherwise
+// to a register-blocked kernel that accumulates in the order of K, 
+// such that results agree bitwise with plain dot products.
+void gemm_nt(int M, int N, int K, 
+    const double *A, int lda, 
+    const double *B, int ldb, 
+    double *C, int ldc);
+
+void gemm_nt(int M, int N, int K, 
+    const float *A, int lda, 
+    const float *B, int ldb, 
+    float *C, int ldc);
+
+#endif
@@ -0,0 +1,287 @@
+#include "neighbourlist.hpp"
+#include "gridsearch.hpp"
+#include <algorithm>
+#include <stdexcept>
+#include <math.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// Density (atoms per cutoff cube) from which 2 bins per cutoff are used,
+// about where the builds with 1 and 2 bins per cutoff take equally long
+// (condensed phases at typical cutoffs stay below)
+static const double DENSE_ATOMS_PER_CUTOFF_CUBE = 48.;
+
+void getPeriodicCell(py::buffer_info &cell_buf, py::buffer_info &pbc_buf,
+        const double *&cell, const bool *&pbc) {
+    cell = NULL;
+    pbc = NULL;
+    if (cell_buf.size == 0) return;
+    if (cell_buf.size != 9 || pbc_buf.size != 3) {
+        throw std::invalid_argument("Expected a (3,3) cell and 3 pbc flags");
+    }
+    cell = (const double*) cell_buf.ptr;
+    pbc = (const bool*) pbc_buf.ptr;
+}
+
+NeighbourList::NeighbourList(py::array_t<double> centres, py::array_t<double> positions,
+        py::array_t<int> types, double cutoff, int n_threads,
+        py::array_t<double> cell, py::array_t<bool> pbc, int bins_per_cutoff)
+    : cutoff(cutoff)
+    , binsPerCutoff(bins_per_cutoff)
+{
+    py::buffer_info centres_buf = centres.request();
+    py::buffer_info positions_buf = positions.request();
+    py::buffer_info types_buf = types.request();
+    py::buffer_info cell_buf = cell.request();
+    py::buffer_info pbc_buf = pbc.request();
+    if (centres_buf.size % 3 != 0 || positions_buf.size % 3 != 0
+            || types_buf.size != positions_buf.size/3) {
+        throw std::invalid_argument("Expected (n,3) centres, (m,3) positions and m types");
+    }
+    const double *cell_ptr = NULL;
+    const bool *pbc_ptr = NULL;
+    getPeriodicCell(cell_buf, pbc_buf, cell_ptr, pbc_ptr);
+    this->nCentres = centres_buf.size/3;
+    this->nPositions = positions_buf.size/3;
+    const double *c = (const double*) centres_buf.ptr;
+    this->centres.assign(c, c+3*this->nCentres);
+    py::gil_scoped_release release;
+    this->build((const double*) positions_buf.ptr, (const int*) types_buf.ptr, n_threads,
+        cell_ptr, pbc_ptr);
+}
+
+NeighbourList::NeighbourList(const double *centres, int n_centres,
+        const double *positions, const int *types, int n_positions,
+        double cutoff, int n_threads, const double *cell, const bool *pbc, 
+        int bins_per_cutoff)
+    : nCentres(n_centres)
+    , nPositions(n_positions)
+    , cutoff(cutoff)
+    , binsPerCutoff(bins_per_cutoff)
+    , centres(centres, centres+3*n_centres)
+{
+    this->build(positions, types, n_threads, cell, pbc);
+}
+
+int NeighbourList::chooseBinsPerCutoff(const double *positions, int n_positions,
+        double cutoff, const double *cell, const bool *pbc) {
+    // Atoms per cutoff cube, over the periodic cell or otherwise the 
+    // bounding box of the positions (at least one cutoff wide)
+    double volume = 0.;
+    if (cell != NULL && pbc != NULL && (pbc[0] || pbc[1] || pbc[2])) {
+        const double *c = cell;
+        volume = fabs(c[0]*(c[4]*c[8] - c[5]*c[7]) 
+            - c[1]*(c[3]*c[8] - c[5]*c[6]) 
+            + c[2]*(c[3]*c[7] - c[4]*c[6]));
+    } else if (n_positions > 0) {
+        volume = 1.;
+        for (int a = 0; a < 3; a++) {
+            double xmin = positions[a];
+            double xmax = positions[a];
+            for (int i = 1; i < n_positions; i++) {
+                xmin = min(xmin, positions[3*i+a]);
+                xmax = max(xmax, positions[3*i+a]);
+            }
+            volume *= max(xmax - xmin, cutoff);
+        }
+    }
+    if (!(volume > 0.) || !(cutoff > 0.)) return 1;
+    double density = n_positions*cutoff*cutoff*cutoff/volume;
+    return (density >= DENSE_ATOMS_PER_CUTOFF_CUBE) ? 2 : 1;
+}
+
+int NeighbourList::getMaxNeighbours() const {
+    long n_max = 0;
+    for (int i = 0; i < this->nCentres; i++) {
+        n_max = max(n_max, this->offsets[i+1] - this->offsets[i]);
+    }
+    return n_max;
+}
+
+void NeighbourList::build(const double *positions, const int *types, int n_threads,
+        const double *cell, const bool *pbc) {
+#ifdef _OPENMP
+    if (n_threads < 1) n_threads = omp_get_max_threads();
+#else
+    n_threads = 1;
+#endif
+    if (this->binsPerCutoff < 1) {
+        this->binsPerCutoff = NeighbourList::chooseBinsPerCutoff(positions, 
+            this->nPositions, this->cutoff, cell, pbc);
+    }
+    // Search per centre, neighbours sorted by type in a stable manner.
+    // Rows hold positions into the search result, to keep track of shifts.
+    // Each thread reuses its result buffers across centres.
+    GridSearch cell_list(positions, this->nPositions, this->cutoff, cell, pbc,
+        this->binsPerCutoff);
+    bool periodic = cell_list.isPeriodic();
+    vector<vector<int>> rows(this->nCentres);
+    vector<vector<double>> row_shifts(this->nCentres);
+    #pragma omp parallel num_threads(n_threads)
+    {
+        vector<int> idcs;
+        vector<double> d2;
+        vector<double> nb_shifts;
+        vector<int> perm;
+        #pragma omp for schedule(dynamic, 16)
+        for (int i = 0; i < this->nCentres; i++) {
+            cell_list.getNeighboursForPosition(
+                this->centres[3*i], this->centres[3*i+1], this->centres[3*i+2],
+                idcs, d2, periodic ? &nb_shifts : NULL);
+            if (periodic) {
+                // Sort (index, shift) pairs via a permutation
+                perm.resize(idcs.size());
+                for (int k = 0; k < (int) perm.size(); k++) perm[k] = k;
+                stable_sort(perm.begin(), perm.end(),
+                    [types, &idcs](int a, int b) { return types[idcs[a]] < types[idcs[b]]; });
+                rows[i].resize(perm.size());
+                row_shifts[i].resize(3*perm.size());
+                for (int k = 0; k < (int) perm.size(); k++) {
+                    rows[i][k] = idcs[perm[k]];
+                    for (int a = 0; a < 3; a++) row_shifts[i][3*k+a] = nb_shifts[3*perm[k]+a];
+                }
+                continue;
+            }
+            rows[i].assign(idcs.begin(), idcs.end());
+            stable_sort(rows[i].begin(), rows[i].end(),
+                [types](int a, int b) { return types[a] < types[b]; });
+        }
+    }
+
+    // Compress into CSR arrays
+    long n_entries = 0;
+    for (int i = 0; i < this->nCentres; i++) n_entries += rows[i].size();
+    this->offsets.assign(1, 0);
+    this->centreGroups.assign(1, 0);
+    this->groupOffsets.assign(1, 0);
+    this->groupTypes.clear();
+    this->indices.resize(n_entries);
+    this->deltas.resize(3*n_entries);
+    this->shifts.assign(3*n_entries, 0.);
+    this->distances.resize(n_entries);
+    long e = 0;
+    for (int i = 0; i < this->nCentres; i++) {
+        const double *ci = &this->centres[3*i];
+        bool shifted = (row_shifts[i].size() > 0);
+        for (int jj = 0; jj < (int) rows[i].size(); jj++) {
+            int j = rows[i][jj];
+            if (jj == 0 || types[j] != types[rows[i][jj-1]]) {
+                if (jj > 0) this->groupOffsets.push_back(e);
+                this->groupTypes.push_back(types[j]);
+            }
+            double dx = positions[3*j] - ci[0];
+            double dy = positions[3*j+1] - ci[1];
+            double dz = positions[3*j+2] - ci[2];
+            if (shifted) {
+                double *t = &row_shifts[i][3*jj];
+                dx = (positions[3*j] + t[0]) - ci[0];
+                dy = (positions[3*j+1] + t[1]) - ci[1];
+                dz = (positions[3*j+2] + t[2]) - ci[2];
+                for (int a = 0; a < 3; a++) this->shifts[3*e+a] = t[a];
+            }
+            this->indices[e] = j;
+            this->deltas[3*e] = dx;
+            this->deltas[3*e+1] = dy;
+            this->deltas[3*e+2] = dz;
+            this->distances[e] = sqrt(dx*dx + dy*dy + dz*dz);
+            e++;
+        }
+        if (rows[i].size() > 0) this->groupOffsets.push_back(e);
+        this->offsets.push_back(e);
+        this->centreGroups.push_back(this->groupTypes.size());
+    }
+}
+
+NeighbourList NeighbourList::refresh(py::array_t<double> centres, 
+        py::array_t<double> positions, double cutoff) const {
+    py::buffer_info centres_buf = centres.request();
+    py::buffer_info positions_buf = positions.request();
+    if (centres_buf.size != 3*this->nCentres || positions_buf.size != 3*this->nPositions) {
+        throw std::invalid_argument("Expected as many centres and positions as in the list");
+    }
+    py::gil_scoped_release release;
+    return this->refresh((const double*) centres_buf.ptr, 
+        (const double*) positions_buf.ptr, cutoff);
+}
+
+NeighbourList NeighbourList::refresh(const double *centres, const double *positions, 
+        double cutoff) const {
+    if (cutoff > this->cutoff) {
+        throw std::invalid_argument("Cannot refresh a neighbour list to a larger cutoff");
+    }
+    NeighbourList nl;
+    nl.nCentres = this->nCentres;
+    nl.nPositions = this->nPositions;
+    nl.cutoff = cutoff;
+    nl.binsPerCutoff = this->binsPerCutoff;
+    nl.centres.assign(centres, centres+3*this->nCentres);
+    nl.offsets.assign(1, 0);
+    nl.centreGroups.assign(1, 0);
+    nl.groupOffsets.assign(1, 0);
+    double cutoff2 = cutoff*cutoff;
+    for (int i = 0; i < this->nCentres; i++) {
+        const double *ci = centres + 3*i;
+        for (long g = this->centreGroups[i]; g < this->centreGroups[i+1]; g++) {
+            long n_kept = 0;
+            for (long e = this->groupOffsets[g]; e < this->groupOffsets[g+1]; e++) {
+                int j = this->indices[e];
+                const double *t = &this->shifts[3*e];
+                double d[3];
+                for (int a = 0; a < 3; a++) d[a] = (positions[3*j+a] + t[a]) - ci[a];
+                double d2 = d[0]*d[0] + d[1]*d[1] + d[2]*d[2];
+                if (d2 > cutoff2) continue;
+                nl.indices.push_back(j);
+                nl.deltas.insert(nl.deltas.end(), d, d+3);
+                nl.shifts.insert(nl.shifts.end(), t, t+3);
+                nl.distances.push_back(sqrt(d2));
+                n_kept++;
+            }
+            if (n_kept > 0) {
+                nl.groupOffsets.push_back(nl.indices.size());
+                nl.groupTypes.push_back(this->groupTypes[g]);
+            }
+        }
+        nl.offsets.push_back(nl.indices.size());
+        nl.centreGroups.push_back(nl.groupTypes.size());
+    }
+    return nl;
+}
+
+NeighbourList NeighbourList::filter(double cutoff) const {
+    if (cutoff > this->cutoff) {
+        throw std::invalid_argument("Cannot filter a neighbour list to a larger cutoff");
+    }
+    NeighbourList nl;
+    nl.nCentres = this->nCentres;
+    nl.nPositions = this->nPositions;
+    nl.cutoff = cutoff;
+    nl.binsPerCutoff = this->binsPerCutoff;
+    nl.centres = this->centres;
+    nl.offsets.assign(1, 0);
+    nl.centreGroups.assign(1, 0);
+    nl.groupOffsets.assign(1, 0);
+    double cutoff2 = cutoff*cutoff;
+    for (int i = 0; i < this->nCentres; i++) {
+        for (long g = this->centreGroups[i]; g < this->centreGroups[i+1]; g++) {
+            long n_kept = 0;
+            for (long e = this->groupOffsets[g]; e < this->groupOffsets[g+1]; e++) {
+                const double *d = &this->deltas[3*e];
+                // Same criterion as in GridSearch
+                if (d[0]*d[0] + d[1]*d[1] + d[2]*d[2] > cutoff2) continue;
+                nl.indices.push_back(this->indices[e]);
+                nl.deltas.insert(nl.deltas.end(), d, d+3);
+                nl.shifts.insert(nl.shifts.end(), &this->shifts[3*e], &this->shifts[3*e]+3);
+                nl.distances.push_back(this->distances[e]);
+                n_kept++;
+            }
+            if (n_kept > 0) {
+                nl.groupOffsets.push_back(nl.indices.size());
+                nl.groupTypes.push_back(this->groupTypes[g]);
+            }
+        }
+        nl.offsets.push_back(nl.indices.size());
+        nl.centreGroups.push_back(nl.groupTypes.size());
+    }
+    return nl;
+}
@@ -0,0 +1,76 @@
+#ifndef NEIGHBOURLIST_H
+#define NEIGHBOURLIST_H
+
+#include <pybind11/numpy.h>
+#include <vector>
+
+namespace py = pybind11;
+using namespace std;
+
+// Neighbours of a set of centres within a cutoff, in CSR layout. The
+// neighbours of each centre are grouped by type (ascending), within a
+// group they follow the order of the cell-list search. Per entry, the
+// target index, the delta (target - centre) and its length are stored.
+// With a periodic cell, targets are images of the positions, shifted by
+// the lattice translation in shifts (zero without a cell).
+//   Entries of centre i:  [offsets[i], offsets[i+1])
+//   Groups of centre i:   [centreGroups[i], centreGroups[i+1])
+//   Entries of group g:   [groupOffsets[g], groupOffsets[g+1]),
+//                         all of type groupTypes[g]
+// Cell and pbc pointers of a (3,3) cell and 3 pbc flags, or NULL for an
+// empty cell (no periodicity)
+void getPeriodicCell(py::buffer_info &cell_buf, py::buffer_info &pbc_buf,
+    const double *&cell, const bool *&pbc);
+
+class NeighbourList {
+    public:
+        NeighbourList() : nCentres(0), nPositions(0), cutoff(0.), binsPerCutoff(1) {}
+        // An empty cell means no periodicity. The cell-list search uses
+        // bins_per_cutoff bins per cutoff length, or with 0 a number 
+        // chosen from the density (see chooseBinsPerCutoff). The entries 
+        // do not depend on it, other than in their order within groups.
+        NeighbourList(py::array_t<double> centres, py::array_t<double> positions,
+            py::array_t<int> types, double cutoff, int n_threads,
+            py::array_t<double> cell, py::array_t<bool> pbc, int bins_per_cutoff);
+        NeighbourList(const double *centres, int n_centres,
+            const double *positions, const int *types, int n_positions,
+            double cutoff, int n_threads, 
+            const double *cell=NULL, const bool *pbc=NULL, int bins_per_cutoff=0);
+        // Subset of the entries within a smaller cutoff
+        NeighbourList filter(double cutoff) const;
+        // Entries within cutoff for displaced centres and positions, using
+        // the pairs (and image shifts) of this list. Complete as long as no
+        // pair has come closer than this->cutoff - cutoff since the search.
+        NeighbourList refresh(py::array_t<double> centres, 
+            py::array_t<double> positions, double cutoff) const;
+        NeighbourList refresh(const double *centres, const double *positions, 
+            double cutoff) const;
+        int getNumberOfEntries() const { return indices.size(); }
+        int getMaxNeighbours() const;
+
+        // Finer bins visit fewer pairs per centre (about 16 instead of 27
+        // cutoff cubes at 2 bins per cutoff), but more bins, which only
+        // pays off for dense systems (many atoms per cutoff cube)
+        static int chooseBinsPerCutoff(const double *positions, int n_positions,
+            double cutoff, const double *cell, const bool *pbc);
+
+        int nCentres;
+        int nPositions;
+        double cutoff;
+        int binsPerCutoff;
+        vector<double> centres;
+        vector<long> offsets;
+        vector<long> centreGroups;
+        vector<long> groupOffsets;
+        vector<int> groupTypes;
+        vector<int> indices;
+        vector<double> deltas;
+        vector<double> shifts;
+        vector<double> distances;
+
+    private:
+        void build(const double *positions, const int *types, int n_threads,
+            const double *cell, const bool *pbc);
+};
+
+#endif
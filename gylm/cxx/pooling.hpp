@@ -0,0 +1,50 @@
+#ifndef POOLING_EXT_HPP 
+#define POOLING_EXT_HPP 
+
+#include <vector>
+#include <algorithm>
+#include <math.h>
+
+using namespace std;
+
+// Reduction of the descriptor rows of all centres into a single 
+// (structure-level) row, accumulated row by row in double
+enum Pooling { POOL_NONE = 0, POOL_SUM = 1, POOL_AVERAGE = 2 };
+
+// acc += z*row, with z = 1/sqrt(|row|^2 + epsilon) if normalize, else 1
+template<typename T>
+inline void pool_row(double *acc, const T *row, int dim, 
+        bool normalize, double epsilon) {
+    double z = 1.;
+    if (normalize) {
+        double norm2 = 0.;
+        for (int d=0; d<dim; ++d) norm2 += (double) row[d]*row[d];
+        z = 1./sqrt(norm2 + epsilon);
+    }
+    for (int d=0; d<dim; ++d) acc[d] += z*row[d];
+}
+
+// Pooled centres are split into at most POOL_BLOCKS contiguous blocks of
+// pool_block_size centres, each summed in centre order into an accumulator
+// of its own. As the blocks are reduced in block order, the pooled row does
+// not depend on the number of threads or on how they are scheduled.
+const int POOL_BLOCKS = 64;
+
+inline int pool_block_size(int n_rows) {
+    return max(1, (n_rows + POOL_BLOCKS - 1)/POOL_BLOCKS);
+}
+
+// out = sum (or average over n_rows) of the per-block accumulators,
+// added in block order
+template<typename T>
+inline void pool_reduce(T *out, const vector<vector<double> > &accs, int dim,
+        int pooling, long n_rows) {
+    for (int d=0; d<dim; ++d) {
+        double x = 0.;
+        for (int t=0; t<(int) accs.size(); ++t) x += accs[t][d];
+        if (pooling == POOL_AVERAGE && n_rows > 0) x /= n_rows;
+        out[d] = x;
+    }
+}
+
+#endif
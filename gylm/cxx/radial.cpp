@@ -0,0 +1,156 @@
+#include <math.h>
+#include <algorithm>
+#include <stdexcept>
+#include <stdio.h>
+#include "radial.hpp"
+
+// Largest grid (intervals) tried for a table, a few MB for typical bases
+static const int MAX_RADIAL_INTERVALS = 1 << 15;
+
+inline void locate_node(double r, int n_in, int n_out, 
+        double r_split, double r_max, int &i, double &t, double &h) {
+    // Interval i and local coordinate t in [0,1] of radius r
+    int i0 = 0;
+    int n = n_in;
+    double r0 = 0.;
+    if ((r >= r_split && n_out > 0) || n_in == 0) {
+        i0 = n_in;
+        n = n_out;
+        r0 = r_split;
+        h = (r_max-r_split)/n_out;
+    } else {
+        h = r_split/n_in;
+    }
+    t = (r-r0)/h;
+    i = (int) t;
+    if (i >= n) i = n-1;
+    t -= i;
+    i += i0;
+}
+
+void fill_radial_table(radial_fct_t &fct, int n_fct, 
+        double r_split, double r_max, int n_in, int n_out, 
+        vector<double> &table) {
+    int n_nodes = n_in+n_out+1;
+    table.assign(n_nodes*2*n_fct, 0.);
+    for (int i=0; i<n_nodes; ++i) {
+        double r = (i <= n_in) ? 
+            ((n_in > 0) ? i*r_split/n_in : 0.) : 
+            r_split + (i-n_in)*(r_max-r_split)/n_out;
+        if (i == n_nodes-1) r = r_max;
+        fct(r, &table[i*2*n_fct], &table[i*2*n_fct+n_fct]);
+    }
+}
+
+vector<double> build_radial_table(radial_fct_t fct, int n_fct, 
+        double r_split, double r_max, double tol, int &n_in, int &n_out) {
+    // Halves the grid spacing until the interpolation error, probed
+    // at the quarter points of every interval, is within tol. A probe
+    // above tol ends the pass, grids beyond MAX_RADIAL_INTERVALS throw.
+    vector<double> table;
+    vector<double> f(n_fct);
+    vector<double> df(n_fct);
+    vector<double> f_ip(n_fct);
+    double h = r_max/64.;
+    while (true) {
+        n_in = (int) ceil(r_split/h - 1e-9);
+        n_out = (int) ceil((r_max-r_split)/h - 1e-9);
+        fill_radial_table(fct, n_fct, r_split, r_max, n_in, n_out, table);
+        double err = 0.;
+        int n_nodes = n_in+n_out+1;
+        for (int i=0; i<n_nodes-1 && err <= tol; ++i) {
+            double r0 = (i < n_in) ? i*r_split/n_in : 
+                r_split + (i-n_in)*(r_max-r_split)/n_out;
+            double hi = (i < n_in) ? r_split/n_in : (r_max-r_split)/n_out;
+            for (int q=1; q<4; ++q) {
+                double r = r0 + 0.25*q*hi;
+                fct(r, f.data(), df.data());
+                interpolate_radial_table(table.data(), n_fct, n_in, n_out, 
+                    r_split, r_max, &r, 1, f_ip.data());
+                for (int c=0; c<n_fct; ++c) err = max(err, fabs(f_ip[c]-f[c]));
+            }
+        }
+        if (err <= tol) break;
+        if (2*(n_in+n_out) > MAX_RADIAL_INTERVALS) {
+            char msg[256];
+            snprintf(msg, sizeof(msg), "Radial table does not reach radial_tol=%g "
+                "with %d intervals (error %g), increase radial_tol or use the "
+                "analytic basis", tol, n_in+n_out, err);
+            throw std::invalid_argument(msg);
+        }
+        h *= 0.5;
+    }
+    return table;
+}
+
+template<typename T>
+void interpolate_radial_table_t(const double *table, int n_fct, 
+        int n_in, int n_out, double r_split, double r_max,
+        const T *r, int n_r, T *f_out) {
+    // The Hermite basis is evaluated in double, the output cast to T
+    int i;
+    double t, h;
+    for (int j=0; j<n_r; ++j) {
+        T *fj = f_out + j*n_fct;
+        locate_node(min(double(r[j]), r_max), n_in, n_out, r_split, r_max, i, t, h);
+        double t2 = t*t;
+        double t3 = t2*t;
+        double h00 = 2*t3 - 3*t2 + 1;
+        double h10 = (t3 - 2*t2 + t)*h;
+        double h01 = -2*t3 + 3*t2;
+        double h11 = (t3 - t2)*h;
+        const double *y0 = table + i*2*n_fct;
+        const double *d0 = y0 + n_fct;
+        const double *y1 = d0 + n_fct;
+        const double *d1 = y1 + n_fct;
+        for (int c=0; c<n_fct; ++c) {
+            fj[c] = h00*y0[c] + h10*d0[c] + h01*y1[c] + h11*d1[c];
+        }
+    }
+}
+
+void interpolate_radial_table(const double *table, int n_fct, 
+        int n_in, int n_out, double r_split, double r_max,
+        const double *r, int n_r, double *f_out) {
+    interpolate_radial_table_t(table, n_fct, n_in, n_out, r_split, r_max,
+        r, n_r, f_out);
+}
+
+void interpolate_radial_table(const double *table, int n_fct, 
+        int n_in, int n_out, double r_split, double r_max,
+        const float *r, int n_r, float *f_out) {
+    interpolate_radial_table_t(table, n_fct, n_in, n_out, r_split, r_max,
+        r, n_r, f_out);
+}
+
+void interpolate_radial_table_grad(const double *table, int n_fct, 
+        int n_in, int n_out, double r_split, double r_max,
+        const double *r, int n_r, double *f_out, double *df_out) {
+    int i;
+    double t, h;
+    for (int j=0; j<n_r; ++j) {
+        double *fj = f_out + j*n_fct;
+        double *dfj = df_out + j*n_fct;
+        locate_node(min(r[j], r_max), n_in, n_out, r_split, r_max, i, t, h);
+        double t2 = t*t;
+        double t3 = t2*t;
+        double h00 = 2*t3 - 3*t2 + 1;
+        double h10 = (t3 - 2*t2 + t)*h;
+        double h01 = -2*t3 + 3*t2;
+        double h11 = (t3 - t2)*h;
+        // d/dr = d/dt / h
+        double s = (r[j] > r_max) ? 0. : 1.;
+        double g00 = s*(6*t2 - 6*t)/h;
+        double g10 = s*(3*t2 - 4*t + 1);
+        double g01 = -g00;
+        double g11 = s*(3*t2 - 2*t);
+        const double *y0 = table + i*2*n_fct;
+        const double *d0 = y0 + n_fct;
+        const double *y1 = d0 + n_fct;
+        const double *d1 = y1 + n_fct;
+        for (int c=0; c<n_fct; ++c) {
+            fj[c] = h00*y0[c] + h10*d0[c] + h01*y1[c] + h11*d1[c];
+            dfj[c] = g00*y0[c] + g10*d0[c] + g01*y1[c] + g11*d1[c];
+        }
+    }
+}
@@ -0,0 +1,34 @@
+#ifndef RADIAL_EXT_HPP 
+#define RADIAL_EXT_HPP 
+
+#include <vector>
+#include <functional>
+
+using namespace std;
+
+// Tabulated radial functions f_c(r), c = 0..n_fct-1, on [0, r_max].
+// The grid consists of two uniform segments [0, r_split] and 
+// [r_split, r_max], such that a kink in the smoothness of the 
+// functions at r_split (e.g., the onset of a cutoff band) falls 
+// onto a node. Table layout per node: [f_0 .. f_n-1, df_0 .. df_n-1],
+// interpolation is piecewise cubic Hermite.
+typedef function<void(double r, double *f, double *df)> radial_fct_t;
+
+vector<double> build_radial_table(radial_fct_t fct, int n_fct, 
+    double r_split, double r_max, double tol, int &n_in, int &n_out);
+
+void interpolate_radial_table(const double *table, int n_fct, 
+    int n_in, int n_out, double r_split, double r_max,
+    const double *r, int n_r, double *f_out);
+
+void interpolate_radial_table(const double *table, int n_fct, 
+    int n_in, int n_out, double r_split, double r_max,
+    const float *r, int n_r, float *f_out);
+
+// As above, also returns the radial derivatives of the interpolant
+// (zero beyond r_max)
+void interpolate_radial_table_grad(const double *table, int n_fct, 
+    int n_in, int n_out, double r_split, double r_max,
+    const double *r, int n_r, double *f_out, double *df_out);
+
+#endif
@@ -23,8 +23,16 @@ limitations under the License.
 #include <string>
 #include <map>
 #include <set>
+#include <stdexcept>
 #include "soapgto.hpp"
 #include "gridsearch.hpp"
+#include "neighbourlist.hpp"
+#include "radial.hpp"
+#include "linalg.hpp"
+#include "pooling.hpp"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 #define PI2 9.86960440108936
 #define PI 3.14159265359
@@ -35,47 +43,52 @@ inline int getCrosNum(int n)
   return n*(n+1)/2;
 }
 
-inline void getReIm2(double* x, double* y, double* c3, int Asize){
+template<typename T>
+inline void getReIm2(T* x, T* y, T* c3, int Asize){
   for(int i = 0; i < Asize; i++){
     c3[2*i  ] = x[i]*x[i]-y[i]*y[i];
     c3[2*i+1] = 2*y[i]*x[i];
   }
 }
 
-inline void getReIm3(double* x, double* y, double* c2, double* c3, int Asize){
+template<typename T>
+inline void getReIm3(T* x, T* y, T* c2, T* c3, int Asize){
   for(int i = 0; i < Asize; i++){
     c3[2*i  ] = x[i]*c2[2*i] - y[i]*c2[2*i + 1];
     c3[2*i+1] = x[i]*c2[2*i+1] + y[i]*c2[2*i  ];
   }
 }
 
-inline void getMulReIm(double* c1, double* c2, double* c3, int Asize){
+template<typename T>
+inline void getMulReIm(T* c1, T* c2, T* c3, int Asize){
   for(int i = 0; i < Asize; i++){
     c3[2*i  ] = c1[2*i  ]*c2[2*i  ] - c1[2*i+1]*c2[2*i+1];
     c3[2*i+1] = c1[2*i  ]*c2[2*i+1] + c1[2*i+1]*c2[2*i  ];
   }
 }
 
-inline void getMulDouble(double* c1, double* c3, int Asize){
+template<typename T>
+inline void getMulDouble(T* c1, T* c3, int Asize){
   for(int i = 0; i < Asize; i++){
     c3[2*i  ] = c1[2*i]*c1[2*i] - c1[2*i+1]*c1[2*i+1];
     c3[2*i+1] = 2*c1[2*i]*c1[2*i+1];
   }
 }
 
-inline void getDeltas(double* x, double* y, double* z, const py::array_t<double> &positions, const double ix, const double iy, const double iz, const vector<int> &indices){
+template<typename T>
+inline void getDeltas(T* x, T* y, T* z, const NeighbourList &nl, long begin, long end){
 
     int count = 0;
-    auto pos = positions.unchecked<2>();
-    for (const int &idx : indices) {
-        x[count] = pos(idx, 0) - ix;
-        y[count] = pos(idx, 1) - iy;
-        z[count] = pos(idx, 2) - iz;
+    for (long e = begin; e < end; e++) {
+        x[count] = nl.deltas[3*e];
+        y[count] = nl.deltas[3*e+1];
+        z[count] = nl.deltas[3*e+2];
         count++;
     };
 }
 
-inline void getRsZs(double* x, double* y, double* z,double* r2,double* r4,double* r6,double* r8,double* z2,double* z4,double* z6,double* z8, int size){
+template<typename T>
+inline void getRsZs(T* x, T* y, T* z,T* r2,T* r4,T* r6,T* r8,T* z2,T* z4,T* z6,T* z8, int size){
   for(int i = 0; i < size; i++){
     r2[i] = x[i]*x[i] + y[i]*y[i] + z[i]*z[i];
     r4[i] = r2[i]*r2[i]; r6[i] = r2[i]*r4[i]; r8[i] = r4[i]*r4[i];
@@ -174,13 +187,14 @@ void getAlphaBeta(double* aOa, double* bOa, double* alphas, double* betas, int N
   }
 }
 
-void getCfactors(double* preCoef, int Asize, double* x, double* y, double* z, double* z2, double* z4, double* z6, double* z8, double* r2, double* r4, double* r6, double* r8, double* ReIm2, double* ReIm3, double* ReIm4, double* ReIm5, double* ReIm6, double* ReIm7, double* ReIm8, double* ReIm9,int totalAN, int lMax, int t2, int t3, int t4, int t5, int t6, int t7, int t8, int t9, int t10, int t11, int t12, int t13, int t14, int t15, int t16, int t17, int t18, int t19, int t20, int t21, int t22, int t23, int t24, int t25, int t26, int t27, int t28, int t29, int t30, int t31, int t32, int t33, int t34, int t35, int t36, int t37, int t38, int t39, int t40, int t41, int t42, int t43, int t44, int t45, int t46, int t47, int t48, int t49, int t50, int t51, int t52, int t53, int t54, int t55, int t56, int t57, int t58, int t59, int t60, int t61, int t62, int t63, int t64, int t65, int t66, int t67, int t68, int t69, int t70, int t71, int t72, int t73, int t74, int t75, int t76, int t77, int t78, int t79, int t80, int t81, int t82, int t83, int t84, int t85, int t86, int t87, int t88, int t89, int t90, int t91, int t92, int t93, int t94, int t95, int t96, int t97, int t98, int t99){
-  double c20c;double c30c;double c31c;double c40c;double c41c;double c42c;
-  double c50c;double c51c;double c52c;double c53c;double c60c;double c61c;
-  double c62c;double c63c;double c64c;double c70c;double c71c;double c72c;
-  double c73c;double c74c;double c75c;double c80c;double c81c;double c82c;
-  double c83c;double c84c;double c85c;double c86c;double c90c;double c91c;
-  double c92c;double c93c;double c94c;double c95c;double c96c;double c97c;
+template<typename T>
+void getCfactors(T* preCoef, int Asize, T* x, T* y, T* z, T* z2, T* z4, T* z6, T* z8, T* r2, T* r4, T* r6, T* r8, T* ReIm2, T* ReIm3, T* ReIm4, T* ReIm5, T* ReIm6, T* ReIm7, T* ReIm8, T* ReIm9,int totalAN, int lMax, int t2, int t3, int t4, int t5, int t6, int t7, int t8, int t9, int t10, int t11, int t12, int t13, int t14, int t15, int t16, int t17, int t18, int t19, int t20, int t21, int t22, int t23, int t24, int t25, int t26, int t27, int t28, int t29, int t30, int t31, int t32, int t33, int t34, int t35, int t36, int t37, int t38, int t39, int t40, int t41, int t42, int t43, int t44, int t45, int t46, int t47, int t48, int t49, int t50, int t51, int t52, int t53, int t54, int t55, int t56, int t57, int t58, int t59, int t60, int t61, int t62, int t63, int t64, int t65, int t66, int t67, int t68, int t69, int t70, int t71, int t72, int t73, int t74, int t75, int t76, int t77, int t78, int t79, int t80, int t81, int t82, int t83, int t84, int t85, int t86, int t87, int t88, int t89, int t90, int t91, int t92, int t93, int t94, int t95, int t96, int t97, int t98, int t99){
+  T c20c;T c30c;T c31c;T c40c;T c41c;T c42c;
+  T c50c;T c51c;T c52c;T c53c;T c60c;T c61c;
+  T c62c;T c63c;T c64c;T c70c;T c71c;T c72c;
+  T c73c;T c74c;T c75c;T c80c;T c81c;T c82c;
+  T c83c;T c84c;T c85c;T c86c;T c90c;T c91c;
+  T c92c;T c93c;T c94c;T c95c;T c96c;T c97c;
 
   getReIm2(x, y, ReIm2, Asize);
   getReIm3(x, y, ReIm2, ReIm3, Asize);
@@ -357,17 +371,30 @@ void getCfactors(double* preCoef, int Asize, double* x, double* y, double* z, do
   }
 }
 
-void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2, double* bOa, double* aOa, double* exes,  int totalAN, int Asize, int Ns, int Ntypes, int lMax, int posI, int typeJ, int Nx2, int Nx3, int Nx4, int Nx5, int Nx6, int Nx7, int Nx8, int Nx9, int Nx10, int Nx11, int Nx12, int Nx13, int Nx14, int Nx15, int Nx16, int Nx17, int Nx18, int Nx19, int Nx20, int Nx21, int Nx22, int Nx23, int Nx24, int Nx25, int Nx26, int Nx27, int Nx28, int Nx29, int Nx30, int Nx31, int Nx32, int Nx33, int Nx34, int Nx35, int Nx36, int Nx37, int Nx38, int Nx39, int Nx40, int Nx41, int Nx42, int Nx43, int Nx44, int Nx45, int Nx46, int Nx47, int Nx48, int Nx49, int Nx50, int Nx51, int Nx52, int Nx53, int Nx54, int Nx55, int Nx56, int Nx57, int Nx58, int Nx59, int Nx60, int Nx61, int Nx62, int Nx63, int Nx64, int Nx65, int Nx66, int Nx67, int Nx68, int Nx69, int Nx70, int Nx71, int Nx72, int Nx73, int Nx74, int Nx75, int Nx76, int Nx77, int Nx78, int Nx79, int Nx80, int Nx81, int Nx82, int Nx83, int Nx84, int Nx85, int Nx86, int Nx87, int Nx88, int Nx89, int Nx90, int Nx91, int Nx92, int Nx93, int Nx94, int Nx95, int Nx96, int Nx97, int Nx98, int Nx99, int t2, int t3, int t4, int t5, int t6, int t7, int t8, int t9, int t10, int t11, int t12, int t13, int t14, int t15, int t16, int t17, int t18, int t19, int t20, int t21, int t22, int t23, int t24, int t25, int t26, int t27, int t28, int t29, int t30, int t31, int t32, int t33, int t34, int t35, int t36, int t37, int t38, int t39, int t40, int t41, int t42, int t43, int t44, int t45, int t46, int t47, int t48, int t49, int t50, int t51, int t52, int t53, int t54, int t55, int t56, int t57, int t58, int t59, int t60, int t61, int t62, int t63, int t64, int t65, int t66, int t67, int t68, int t69, int t70, int t71, int t72, int t73, int t74, int t75, int t76, int t77, int t78, int t79, int t80, int t81, int t82, int t83, int t84, int t85, int t86, int t87, int t88, int t89, int t90, int t91, int t92, int t93, int t94, int t95, int t96, int t97, int t98, int t99){
+template<typename T>
+inline void getExes(T* exes, T* r2, const T* exesTab, double a, int lk, int nLk, int Asize){
+  // Gaussians exp(a r^2), interpolated if a radial table is given
+  if(exesTab == NULL){
+    T aT = a;
+    for(int i = 0; i < Asize; i++){exes[i] = exp(aT*r2[i]);}
+  } else {
+    for(int i = 0; i < Asize; i++){exes[i] = exesTab[i*nLk + lk];}
+  }
+}
+
+template<typename T>
+void getC(double* C, T* preCoef, T* x, T* y, T* z,T* r2, double* bOa, double* aOa, T* exes, const T* exesTab, int totalAN, int Asize, int Ns, int Ntypes, int lMax, int posI, int typeJ, int Nx2, int Nx3, int Nx4, int Nx5, int Nx6, int Nx7, int Nx8, int Nx9, int Nx10, int Nx11, int Nx12, int Nx13, int Nx14, int Nx15, int Nx16, int Nx17, int Nx18, int Nx19, int Nx20, int Nx21, int Nx22, int Nx23, int Nx24, int Nx25, int Nx26, int Nx27, int Nx28, int Nx29, int Nx30, int Nx31, int Nx32, int Nx33, int Nx34, int Nx35, int Nx36, int Nx37, int Nx38, int Nx39, int Nx40, int Nx41, int Nx42, int Nx43, int Nx44, int Nx45, int Nx46, int Nx47, int Nx48, int Nx49, int Nx50, int Nx51, int Nx52, int Nx53, int Nx54, int Nx55, int Nx56, int Nx57, int Nx58, int Nx59, int Nx60, int Nx61, int Nx62, int Nx63, int Nx64, int Nx65, int Nx66, int Nx67, int Nx68, int Nx69, int Nx70, int Nx71, int Nx72, int Nx73, int Nx74, int Nx75, int Nx76, int Nx77, int Nx78, int Nx79, int Nx80, int Nx81, int Nx82, int Nx83, int Nx84, int Nx85, int Nx86, int Nx87, int Nx88, int Nx89, int Nx90, int Nx91, int Nx92, int Nx93, int Nx94, int Nx95, int Nx96, int Nx97, int Nx98, int Nx99, int t2, int t3, int t4, int t5, int t6, int t7, int t8, int t9, int t10, int t11, int t12, int t13, int t14, int t15, int t16, int t17, int t18, int t19, int t20, int t21, int t22, int t23, int t24, int t25, int t26, int t27, int t28, int t29, int t30, int t31, int t32, int t33, int t34, int t35, int t36, int t37, int t38, int t39, int t40, int t41, int t42, int t43, int t44, int t45, int t46, int t47, int t48, int t49, int t50, int t51, int t52, int t53, int t54, int t55, int t56, int t57, int t58, int t59, int t60, int t61, int t62, int t63, int t64, int t65, int t66, int t67, int t68, int t69, int t70, int t71, int t72, int t73, int t74, int t75, int t76, int t77, int t78, int t79, int t80, int t81, int t82, int t83, int t84, int t85, int t86, int t87, int t88, int t89, int t90, int t91, int t92, int t93, int t94, int t95, int t96, int t97, int t98, int t99){
 
   if(Asize == 0){return;}
   double sumMe = 0; int NsNs = Ns*Ns;  int NsJ = 100*Ns*typeJ; int LNsNs;
   int LNs; int NsTsI = 100*Ns*Ntypes*posI;
   for(int k = 0; k < Ns; k++){
-    sumMe = 0; for(int i = 0; i < Asize; i++){ sumMe += exp(aOa[k]*r2[i]);}
+    getExes(exes, r2, exesTab, aOa[k], k, (lMax+1)*Ns, Asize);
+    sumMe = 0; for(int i = 0; i < Asize; i++){ sumMe += exes[i];}
     for(int n = 0; n < Ns; n++){ C[NsTsI + NsJ + n] += bOa[n*Ns + k]*sumMe; }
   } if(lMax > 0) { LNsNs=NsNs; LNs=Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c10*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*z[i];}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Ns + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
     sumMe = 0;/*c11Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*x[i];}
@@ -376,7 +403,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx3 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
   }} if(lMax > 1) { LNsNs=2*NsNs; LNs=2*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c20*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*preCoef[i];}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx4 + n] += bOa[LNsNs + n*Ns + k]*sumMe; }
     sumMe = 0;/*c21Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*preCoef[totalAN + i];}
@@ -389,7 +416,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx8 + n] += bOa[LNsNs + n*Ns + k]*sumMe; }
   }} if(lMax > 2) { LNsNs=3*NsNs; LNs=3*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c30*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t5+i]);}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx9 + n] += bOa[LNsNs + n*Ns + k]*sumMe; }
     sumMe = 0;/*c31Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t6+i]);}
@@ -406,7 +433,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx15 + n] += bOa[LNsNs + n*Ns + k]*sumMe; }
   }} if(lMax > 3) { LNsNs=4*NsNs; LNs=4*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c40*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t12+i]);}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx16 + n] += bOa[LNsNs + n*Ns + k]*sumMe; }
     sumMe = 0;/*c41Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t13+i]);}
@@ -428,7 +455,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
 
   }} if(lMax > 4) { LNsNs=5*NsNs; LNs=5*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c50*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t21+i]);}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx25 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
     sumMe = 0;/*c51Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t22+i]);}
@@ -453,7 +480,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx35 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
   }} if(lMax > 5) { LNsNs=6*NsNs; LNs=6*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c60*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t32+i]);}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx36 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
     sumMe = 0;/*c61Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t33+i]);}
@@ -482,7 +509,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx48 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
   }} if(lMax > 6) { LNsNs=7*NsNs; LNs=7*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c70*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t45+i]);}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx49 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
     sumMe = 0;/*c71Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t46+i]);}
@@ -515,7 +542,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx63 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
   }} if(lMax > 7) { LNsNs=8*NsNs; LNs=8*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c80*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t60+i]);}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx64 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
     sumMe = 0;/*c81Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t61+i]);}
@@ -552,7 +579,7 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx80 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
   }} if(lMax > 8) { LNsNs=9*NsNs; LNs=9*Ns;
   for(int k = 0; k < Ns; k++){
-    for(int i = 0; i < Asize; i++){exes[i] = exp(aOa[LNs + k]*r2[i]);}//exponents
+    getExes(exes, r2, exesTab, aOa[LNs + k], LNs + k, (lMax+1)*Ns, Asize);//exponents
     sumMe = 0;/*c90*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t77+i]);}
     for(int n = 0; n < Ns; n++){C[NsTsI + NsJ + Nx81 + n] += bOa[LNsNs + n*Ns + k]*sumMe;}
     sumMe = 0;/*c91Re*/ for(int i = 0; i < Asize; i++){sumMe += exes[i]*(preCoef[t78+i]);}
@@ -594,56 +621,125 @@ void getC(double* C, double* preCoef, double* x, double* y, double* z,double* r2
   }}
 }
 
+// Squared normalization factors of the real spherical harmonics in getC,
+// csTable[l*(l+1)/2 + p] belongs to m' = 2p-1 and 2p (p = 0 for m' = 0):
+//  double   cs0  = pow(PIHalf,2);
+//  double   cs1  = pow(2.7206990464,2);
+//  double cs2  = 2*pow(1.9238247452,2); double   cs3  = pow(1.7562036828,2); double cs4  = 2*pow(4.3018029072,2);
+//  double cs5  = 2*pow(2.1509014536,2); double   cs6  = pow(2.0779682205,2); double cs7  = 2*pow(1.7995732672,2);
+//  double cs8  = 2*pow(5.6907503408,2); double cs9  = 2*pow(2.3232390981,2); double   cs10 = pow(0.5890486225,2);
+//  double cs11 = 2*pow(2.6343055241,2); double cs12 = 2*pow(1.8627352998,2); double cs13 = 2*pow(6.9697172942,2);
+//  double cs14 = 2*pow(2.4641671809,2); double   cs15 = pow(0.6512177548,2); double cs16 = 2*pow(1.7834332706,2);
+//  double cs17 = 2*pow(9.4370418280,2); double cs18 = 2*pow(1.9263280966,2); double cs19 = 2*pow(8.1727179596,2);
+//  double cs20 = 2*pow(2.5844403427,2); double   cs21 = pow(0.3539741687,2); double cs22 = 2*pow(2.2940148014,2);
+//  double cs23 = 2*pow(1.8135779397,2); double cs24 = 2*pow(3.6271558793,2); double cs25 = 2*pow(1.9866750947,2);
+//  double cs26 = 2*pow(9.3183321738,2); double cs27 = 2*pow(2.6899707945,2); double   cs28 = pow(0.3802292509,2);
+//  double cs29 = 2*pow(0.3556718963,2); double cs30 = 2*pow(0.8712146618,2); double cs31 = 2*pow(0.6160417952,2);
+//  double cs32 = 2*pow(4.0863589798,2); double cs33 = 2*pow(2.0431794899,2); double cs34 = 2*pow(10.418212089,2);
+//  double cs35 = 2*pow(2.7843843014,2); double   cs36 = pow(0.0505981185,2); double cs37 = 2*pow(0.4293392727,2);
+//  double cs38 = 2*pow(1.7960550366,2); double cs39 = 2*pow(4.8637400313,2); double cs40 = 2*pow(1.8837184141,2);
+//  double cs41 = 2*pow(13.583686661,2); double cs42 = 2*pow(2.0960083567,2); double cs43 = 2*pow(11.480310577,2);
+//  double cs44 = 2*pow(2.8700776442,2); double   cs45 = pow(0.0534917379,2); double cs46 = 2*pow(0.2537335916,2);
+//  double cs47 = 2*pow(2.3802320735,2); double cs48 = 2*pow(1.8179322747,2); double cs49 = 2*pow(16.055543121,2);
+//  double cs50 = 2*pow(1.9190044477,2); double cs51 = 2*pow(4.9548481782,2); double cs52 = 2*pow(2.1455121971,2);
+//  double cs53 = 2*pow(12.510378411,2); double cs54 = 2*pow(2.9487244699,2);
+static const double csTable[55] = {
+  2.4674011003, 7.4022033011, 7.4022033005, 3.0842513755, 37.0110165048,
+  9.2527541262, 4.3179519254, 6.4769278880, 64.7692788826, 10.7948798139,
+  0.3469782797, 13.8791311886, 6.9395655942, 97.1539183221, 12.1442397908,
+  0.4240845642, 6.3612684614, 178.1155169268, 7.4214798715, 133.5866376943,
+  13.3586637700, 0.1252977121, 10.5250078181, 6.5781298867, 26.3125195455,
+  7.8937558638, 173.6626290026, 14.4718857505, 0.1445742832, 0.2530049956,
+  1.5180299739, 0.7590149869, 33.3966594236, 8.3491648559, 217.0782862628,
+  15.5055918758, 0.0025601696, 0.3686644222, 6.4516273890, 47.3119341841,
+  7.0967901272, 369.0330866085, 8.7865020627, 263.5950618888, 16.4746913675,
+  0.0028613660, 0.1287614710, 11.3310094474, 6.6097555108, 515.5609298206,
+  7.3651561406, 49.1010409380, 9.2064451758, 313.0191359728, 17.3899519988 };
+
 /**
- * Used to calculate the partial power spectrum without crossover.
+ * Packs the coefficients of one l-channel of centre i into row-major
+ * (Ts*Ns) x (2l+1) matrices with rows (type, radial index): a plain copy
+ * and a copy weighted by csTable.
  */
-void getPNoCross(double* soapMat, double* Cnnd, int Ns, int Ts, int Hs, int lMax){
+template<typename T>
+inline void getPackedL(T* A, T* Aw, double* Cnnd, int i, int l, int Ns, int Ts){
   int NsTs100 = Ns*Ts*100;
   int Ns100 = Ns*100;
+  int K = 2*l+1;
+  int csOff = l*(l+1)/2;
+  for(int j = 0; j < Ts; j++){
+    for(int k = 0; k < Ns; k++){
+      int row = (j*Ns + k)*K;
+      for(int m = 0; m < K; m++){
+        double c = Cnnd[NsTs100*i + Ns100*j + (l*l + m)*Ns + k];
+        A[row + m] = c;
+        Aw[row + m] = csTable[csOff + (m+1)/2]*c;
+      }
+    }
+  }
+}
+
+/**
+ * Used to calculate selected entries of the partial power spectrum, in the 
+ * layout of getPCrossOver or getPNoCross, stored compactly per centre.
+ */
+template<typename T>
+void getPSelected(T* soapMat, double* Cnnd, int Ns, int Ts, int Hs, int lMax, 
+    bool crossover, const int* channels, int nChannels){
+  int NsTs100 = Ns*Ts*100;
+  int Ns100 = Ns*100;
+  int NsNs = (crossover) ? Ns*Ns : (Ns*(Ns+1))/2;
+  int NsNsLmax = NsNs*(lMax+1);
+  // Decode the channels into (type, type', l, radial, radial')
+  vector<int> jSel(nChannels), jdSel(nChannels), lSel(nChannels), kSel(nChannels), kdSel(nChannels);
+  vector<int> jPair, jdPair, kPair, kdPair;
+  for(int j = 0; j < Ts; j++){
+    for(int jd = j; jd < Ts; jd++){ jPair.push_back(j); jdPair.push_back(jd); }
+  }
+  for(int k = 0; k < Ns; k++){
+    for(int kd = k; kd < Ns; kd++){ kPair.push_back(k); kdPair.push_back(kd); }
+  }
+  for(int c = 0; c < nChannels; c++){
+    int idx = channels[c];
+    int block = idx/NsNsLmax;
+    int l = (idx%NsNsLmax)/NsNs;
+    int shiftN = idx%NsNs;
+    lSel[c] = l;
+    if (crossover) {
+      jSel[c] = jPair[block]; jdSel[c] = jdPair[block];
+      kSel[c] = shiftN/Ns; kdSel[c] = shiftN%Ns;
+    } else {
+      jSel[c] = block; jdSel[c] = block;
+      kSel[c] = kPair[shiftN]; kdSel[c] = kdPair[shiftN];
+    }
+  }
+  for(int i = 0; i < Hs; i++){
+    for(int c = 0; c < nChannels; c++){
+      int l = lSel[c];
+      double prel = PI*sqrt(8.0/(2.0*l+1.0));
+      double* Cj = Cnnd + NsTs100*i + Ns100*jSel[c] + l*l*Ns + kSel[c];
+      double* Cjd = Cnnd + NsTs100*i + Ns100*jdSel[c] + l*l*Ns + kdSel[c];
+      double x = 0.0;
+      for(int m = 0; m < 2*l+1; m++){
+        x += (csTable[l*(l+1)/2 + (m+1)/2]*Cj[m*Ns])*Cjd[m*Ns];
+      }
+      soapMat[nChannels*i + c] = prel*x;
+    }
+  }
+}
+
+/**
+ * Used to calculate the partial power spectrum without crossover.
+ */
+template<typename T>
+void getPNoCross(T* soapMat, double* Cnnd, int Ns, int Ts, int Hs, int lMax){
   int NsNs = (Ns*(Ns+1))/2;
   int NsNsLmax = NsNs*(lMax+1);
   int NsNsLmaxTs = NsNsLmax*Ts;
-  int shiftN = 0;
-
-  //  double   cs0  = pow(PIHalf,2);
-  //  double   cs1  = pow(2.7206990464,2);
-  //  double cs2  = 2*pow(1.9238247452,2); double   cs3  = pow(1.7562036828,2); double cs4  = 2*pow(4.3018029072,2);
-  //  double cs5  = 2*pow(2.1509014536,2); double   cs6  = pow(2.0779682205,2); double cs7  = 2*pow(1.7995732672,2);
-  //  double cs8  = 2*pow(5.6907503408,2); double cs9  = 2*pow(2.3232390981,2); double   cs10 = pow(0.5890486225,2);
-  //  double cs11 = 2*pow(2.6343055241,2); double cs12 = 2*pow(1.8627352998,2); double cs13 = 2*pow(6.9697172942,2);
-  //  double cs14 = 2*pow(2.4641671809,2); double   cs15 = pow(0.6512177548,2); double cs16 = 2*pow(1.7834332706,2);
-  //  double cs17 = 2*pow(9.4370418280,2); double cs18 = 2*pow(1.9263280966,2); double cs19 = 2*pow(8.1727179596,2);
-  //  double cs20 = 2*pow(2.5844403427,2); double   cs21 = pow(0.3539741687,2); double cs22 = 2*pow(2.2940148014,2);
-  //  double cs23 = 2*pow(1.8135779397,2); double cs24 = 2*pow(3.6271558793,2); double cs25 = 2*pow(1.9866750947,2);
-  //  double cs26 = 2*pow(9.3183321738,2); double cs27 = 2*pow(2.6899707945,2); double   cs28 = pow(0.3802292509,2);
-  //  double cs29 = 2*pow(0.3556718963,2); double cs30 = 2*pow(0.8712146618,2); double cs31 = 2*pow(0.6160417952,2);
-  //  double cs32 = 2*pow(4.0863589798,2); double cs33 = 2*pow(2.0431794899,2); double cs34 = 2*pow(10.418212089,2);
-  //  double cs35 = 2*pow(2.7843843014,2); double   cs36 = pow(0.0505981185,2); double cs37 = 2*pow(0.4293392727,2);
-  //  double cs38 = 2*pow(1.7960550366,2); double cs39 = 2*pow(4.8637400313,2); double cs40 = 2*pow(1.8837184141,2);
-  //  double cs41 = 2*pow(13.583686661,2); double cs42 = 2*pow(2.0960083567,2); double cs43 = 2*pow(11.480310577,2);
-  //  double cs44 = 2*pow(2.8700776442,2); double   cs45 = pow(0.0534917379,2); double cs46 = 2*pow(0.2537335916,2);
-  //  double cs47 = 2*pow(2.3802320735,2); double cs48 = 2*pow(1.8179322747,2); double cs49 = 2*pow(16.055543121,2);
-  //  double cs50 = 2*pow(1.9190044477,2); double cs51 = 2*pow(4.9548481782,2); double cs52 = 2*pow(2.1455121971,2);
-  //  double cs53 = 2*pow(12.510378411,2); double cs54 = 2*pow(2.9487244699,2);
-  double cs0=2.4674011003; double cs1=7.4022033011; double cs2=7.4022033005;
-  double cs3=3.0842513755; double cs4=37.0110165048; double cs5=9.2527541262;
-  double cs6=4.3179519254; double cs7=6.4769278880; double cs8=64.7692788826;
-  double cs9=10.7948798139; double cs10=0.3469782797; double cs11=13.8791311886;
-  double cs12=6.9395655942; double cs13=97.1539183221; double cs14=12.1442397908;
-  double cs15=0.4240845642; double cs16=6.3612684614; double cs17=178.1155169268;
-  double cs18=7.4214798715; double cs19=133.5866376943; double cs20=13.3586637700;
-  double cs21=0.1252977121; double cs22=10.5250078181; double cs23=6.5781298867;
-  double cs24=26.3125195455; double cs25=7.8937558638; double cs26=173.6626290026;
-  double cs27=14.4718857505; double cs28=0.1445742832; double cs29=0.2530049956;
-  double cs30=1.5180299739; double cs31=0.7590149869; double cs32=33.3966594236;
-  double cs33=8.3491648559; double cs34=217.0782862628; double cs35=15.5055918758;
-  double cs36=0.0025601696; double cs37=0.3686644222; double cs38=6.4516273890;
-  double cs39=47.3119341841; double cs40=7.0967901272; double cs41=369.0330866085;
-  double cs42=8.7865020627; double cs43=263.5950618888; double cs44=16.4746913675;
-  double cs45=0.0028613660; double cs46=0.1287614710; double cs47=11.3310094474;
-  double cs48=6.6097555108; double cs49=515.5609298206; double cs50=7.3651561406;
-  double cs51=49.1010409380; double cs52=9.2064451758; double cs53=313.0191359728;
-  double cs54=17.3899519988;
+  int Kmax = 2*lMax+1;
+  T* A = (T*) malloc(sizeof(T)*Ts*Ns*Kmax);
+  T* Aw = (T*) malloc(sizeof(T)*Ts*Ns*Kmax);
+  T* G = (T*) malloc(sizeof(T)*Ns*Ns);
 
   // The power spectrum is multiplied by an l-dependent prefactor that comes
   // from the normalization of the Wigner D matrices. This prefactor is
@@ -652,559 +748,59 @@ void getPNoCross(double* soapMat, double* Cnnd, int Ns, int Ts, int Hs, int lMax
   // root of the prefactor in the dot-product kernel is used, so that after a
   // possible dot-product the full prefactor is recovered.
 
-  // SUM M's UP!
-  double prel0 = PI*sqrt(8.0/(1.0));
+  // SUM M's UP: One (Ns x 2l+1) x (2l+1 x Ns) product per centre, type and l
   for(int i = 0; i < Hs; i++){
-    for(int j = 0; j < Ts; j++){
-      shiftN = 0;
-      for(int k = 0; k < Ns; k++){
-        for(int kd = k; kd < Ns; kd++){
-          soapMat[NsNsLmaxTs*i+ NsNsLmax*j+ 0 +shiftN] = prel0*(
-            cs0*Cnnd[NsTs100*i + Ns100*j + 0 + k]*Cnnd[NsTs100*i + Ns100*j + 0 + kd]);
-          shiftN++;
-        }
-      }
-    }
-  } if (lMax > 0) {
-    double prel1 = PI*sqrt(8.0/(2.0*1.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ NsNs + shiftN] = prel1*(
-              cs1*Cnnd[NsTs100*i + Ns100*j + 1*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 1*Ns + kd]
-             +cs2*Cnnd[NsTs100*i + Ns100*j + 2*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 2*Ns + kd]
-             +cs2*Cnnd[NsTs100*i + Ns100*j + 3*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 3*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if (lMax > 1) {
-    double prel2 = PI*sqrt(8.0/(2.0*2.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 2*NsNs + shiftN] = prel2*(
-              cs3*Cnnd[NsTs100*i + Ns100*j + 4*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 4*Ns + kd]
-             +cs4*Cnnd[NsTs100*i + Ns100*j + 5*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 5*Ns + kd]
-             +cs4*Cnnd[NsTs100*i + Ns100*j + 6*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 6*Ns + kd]
-             +cs5*Cnnd[NsTs100*i + Ns100*j + 7*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 7*Ns + kd]
-             +cs5*Cnnd[NsTs100*i + Ns100*j + 8*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 8*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if (lMax > 2) {
-    double prel3 = PI*sqrt(8.0/(2.0*3.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 3*NsNs + shiftN] = prel3*(
-              cs6*Cnnd[NsTs100*i + Ns100*j + 9*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 9*Ns + kd]
-             +cs7*Cnnd[NsTs100*i + Ns100*j + 10*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 10*Ns + kd]
-             +cs7*Cnnd[NsTs100*i + Ns100*j + 11*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 11*Ns + kd]
-             +cs8*Cnnd[NsTs100*i + Ns100*j + 12*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 12*Ns + kd]
-             +cs8*Cnnd[NsTs100*i + Ns100*j + 13*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 13*Ns + kd]
-             +cs9*Cnnd[NsTs100*i + Ns100*j + 14*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 14*Ns + kd]
-             +cs9*Cnnd[NsTs100*i + Ns100*j + 15*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 15*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if (lMax > 3) {
-    double prel4 = PI*sqrt(8.0/(2.0*4.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 4*NsNs + shiftN] = prel4*(
-              cs10*Cnnd[NsTs100*i + Ns100*j + 16*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 16*Ns + kd]
-             +cs11*Cnnd[NsTs100*i + Ns100*j + 17*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 17*Ns + kd]
-             +cs11*Cnnd[NsTs100*i + Ns100*j + 18*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 18*Ns + kd]
-             +cs12*Cnnd[NsTs100*i + Ns100*j + 19*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 19*Ns + kd]
-             +cs12*Cnnd[NsTs100*i + Ns100*j + 20*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 20*Ns + kd]
-             +cs13*Cnnd[NsTs100*i + Ns100*j + 21*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 21*Ns + kd]
-             +cs13*Cnnd[NsTs100*i + Ns100*j + 22*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 22*Ns + kd]
-             +cs14*Cnnd[NsTs100*i + Ns100*j + 23*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 23*Ns + kd]
-             +cs14*Cnnd[NsTs100*i + Ns100*j + 24*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 24*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if(lMax > 4) {
-    double prel5 = PI*sqrt(8.0/(2.0*5.0+1.0));
-    for(int i = 0; i < Hs; i++){
+    for(int l = 0; l <= lMax; l++){
+      double prel = PI*sqrt(8.0/(2.0*l+1.0));
+      int K = 2*l+1;
+      getPackedL(A, Aw, Cnnd, i, l, Ns, Ts);
       for(int j = 0; j < Ts; j++){
-        shiftN = 0;
+        gemm_nt(Ns, Ns, K, Aw + j*Ns*K, K, A + j*Ns*K, K, G, Ns);
+        int shiftN = 0;
         for(int k = 0; k < Ns; k++){
           for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 5*NsNs + shiftN] = prel5*(
-              cs15*Cnnd[NsTs100*i + Ns100*j + 25*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 25*Ns + kd]
-             +cs16*Cnnd[NsTs100*i + Ns100*j + 26*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 26*Ns + kd]
-             +cs16*Cnnd[NsTs100*i + Ns100*j + 27*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 27*Ns + kd]
-             +cs17*Cnnd[NsTs100*i + Ns100*j + 28*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 28*Ns + kd]
-             +cs17*Cnnd[NsTs100*i + Ns100*j + 29*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 29*Ns + kd]
-             +cs18*Cnnd[NsTs100*i + Ns100*j + 30*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 30*Ns + kd]
-             +cs18*Cnnd[NsTs100*i + Ns100*j + 31*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 31*Ns + kd]
-             +cs19*Cnnd[NsTs100*i + Ns100*j + 32*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 32*Ns + kd]
-             +cs19*Cnnd[NsTs100*i + Ns100*j + 33*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 33*Ns + kd]
-             +cs20*Cnnd[NsTs100*i + Ns100*j + 34*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 34*Ns + kd]
-             +cs20*Cnnd[NsTs100*i + Ns100*j + 35*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 35*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if (lMax > 5) {
-    double prel6 = PI*sqrt(8.0/(2.0*6.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 6*NsNs + shiftN] = prel6*(
-              cs21*Cnnd[NsTs100*i + Ns100*j + 36*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 36*Ns + kd]
-             +cs22*Cnnd[NsTs100*i + Ns100*j + 37*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 37*Ns + kd]
-             +cs22*Cnnd[NsTs100*i + Ns100*j + 38*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 38*Ns + kd]
-             +cs23*Cnnd[NsTs100*i + Ns100*j + 39*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 39*Ns + kd]
-             +cs23*Cnnd[NsTs100*i + Ns100*j + 40*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 40*Ns + kd]
-             +cs24*Cnnd[NsTs100*i + Ns100*j + 41*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 41*Ns + kd]
-             +cs24*Cnnd[NsTs100*i + Ns100*j + 42*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 42*Ns + kd]
-             +cs25*Cnnd[NsTs100*i + Ns100*j + 43*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 43*Ns + kd]
-             +cs25*Cnnd[NsTs100*i + Ns100*j + 44*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 44*Ns + kd]
-             +cs26*Cnnd[NsTs100*i + Ns100*j + 45*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 45*Ns + kd]
-             +cs26*Cnnd[NsTs100*i + Ns100*j + 46*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 46*Ns + kd]
-             +cs27*Cnnd[NsTs100*i + Ns100*j + 47*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 47*Ns + kd]
-             +cs27*Cnnd[NsTs100*i + Ns100*j + 48*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 48*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if (lMax > 6) {
-    double prel7 = PI*sqrt(8.0/(2.0*7.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 7*NsNs + shiftN] = prel7*(
-              cs28*Cnnd[NsTs100*i + Ns100*j + 49*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 49*Ns + kd]
-             +cs29*Cnnd[NsTs100*i + Ns100*j + 50*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 50*Ns + kd]
-             +cs29*Cnnd[NsTs100*i + Ns100*j + 51*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 51*Ns + kd]
-             +cs30*Cnnd[NsTs100*i + Ns100*j + 52*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 52*Ns + kd]
-             +cs30*Cnnd[NsTs100*i + Ns100*j + 53*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 53*Ns + kd]
-             +cs31*Cnnd[NsTs100*i + Ns100*j + 54*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 54*Ns + kd]
-             +cs31*Cnnd[NsTs100*i + Ns100*j + 55*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 55*Ns + kd]
-             +cs32*Cnnd[NsTs100*i + Ns100*j + 56*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 56*Ns + kd]
-             +cs32*Cnnd[NsTs100*i + Ns100*j + 57*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 57*Ns + kd]
-             +cs33*Cnnd[NsTs100*i + Ns100*j + 58*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 58*Ns + kd]
-             +cs33*Cnnd[NsTs100*i + Ns100*j + 59*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 59*Ns + kd]
-             +cs34*Cnnd[NsTs100*i + Ns100*j + 60*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 60*Ns + kd]
-             +cs34*Cnnd[NsTs100*i + Ns100*j + 61*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 61*Ns + kd]
-             +cs35*Cnnd[NsTs100*i + Ns100*j + 62*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 62*Ns + kd]
-             +cs35*Cnnd[NsTs100*i + Ns100*j + 63*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 63*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if (lMax > 7) {
-    double prel8 = PI*sqrt(8.0/(2.0*8.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 8*NsNs + shiftN] = prel8*(
-              cs36*Cnnd[NsTs100*i + Ns100*j + 64*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 64*Ns + kd]
-             +cs37*Cnnd[NsTs100*i + Ns100*j + 65*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 65*Ns + kd]
-             +cs37*Cnnd[NsTs100*i + Ns100*j + 66*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 66*Ns + kd]
-             +cs38*Cnnd[NsTs100*i + Ns100*j + 67*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 67*Ns + kd]
-             +cs38*Cnnd[NsTs100*i + Ns100*j + 68*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 68*Ns + kd]
-             +cs39*Cnnd[NsTs100*i + Ns100*j + 69*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 69*Ns + kd]
-             +cs39*Cnnd[NsTs100*i + Ns100*j + 70*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 70*Ns + kd]
-             +cs40*Cnnd[NsTs100*i + Ns100*j + 71*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 71*Ns + kd]
-             +cs40*Cnnd[NsTs100*i + Ns100*j + 72*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 72*Ns + kd]
-             +cs41*Cnnd[NsTs100*i + Ns100*j + 73*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 73*Ns + kd]
-             +cs41*Cnnd[NsTs100*i + Ns100*j + 74*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 74*Ns + kd]
-             +cs42*Cnnd[NsTs100*i + Ns100*j + 75*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 75*Ns + kd]
-             +cs42*Cnnd[NsTs100*i + Ns100*j + 76*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 76*Ns + kd]
-             +cs43*Cnnd[NsTs100*i + Ns100*j + 77*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 77*Ns + kd]
-             +cs43*Cnnd[NsTs100*i + Ns100*j + 78*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 78*Ns + kd]
-             +cs44*Cnnd[NsTs100*i + Ns100*j + 79*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 79*Ns + kd]
-             +cs44*Cnnd[NsTs100*i + Ns100*j + 80*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 80*Ns + kd]);
-            shiftN++;
-          }
-        }
-      }
-    }
-  } if (lMax > 8) {
-    double prel9 = PI*sqrt(8.0/(2.0*9.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      for(int j = 0; j < Ts; j++){
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = k; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i+NsNsLmax*j+ 9*NsNs + shiftN] = prel9*(
-              cs45*Cnnd[NsTs100*i + Ns100*j + 81*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 81*Ns + kd]
-             +cs46*Cnnd[NsTs100*i + Ns100*j + 82*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 82*Ns + kd]
-             +cs46*Cnnd[NsTs100*i + Ns100*j + 83*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 83*Ns + kd]
-             +cs47*Cnnd[NsTs100*i + Ns100*j + 84*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 84*Ns + kd]
-             +cs47*Cnnd[NsTs100*i + Ns100*j + 85*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 85*Ns + kd]
-             +cs48*Cnnd[NsTs100*i + Ns100*j + 86*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 86*Ns + kd]
-             +cs48*Cnnd[NsTs100*i + Ns100*j + 87*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 87*Ns + kd]
-             +cs49*Cnnd[NsTs100*i + Ns100*j + 88*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 88*Ns + kd]
-             +cs49*Cnnd[NsTs100*i + Ns100*j + 89*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 89*Ns + kd]
-             +cs50*Cnnd[NsTs100*i + Ns100*j + 90*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 90*Ns + kd]
-             +cs50*Cnnd[NsTs100*i + Ns100*j + 91*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 91*Ns + kd]
-             +cs51*Cnnd[NsTs100*i + Ns100*j + 92*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 92*Ns + kd]
-             +cs51*Cnnd[NsTs100*i + Ns100*j + 93*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 93*Ns + kd]
-             +cs52*Cnnd[NsTs100*i + Ns100*j + 94*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 94*Ns + kd]
-             +cs52*Cnnd[NsTs100*i + Ns100*j + 95*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 95*Ns + kd]
-             +cs53*Cnnd[NsTs100*i + Ns100*j + 96*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 96*Ns + kd]
-             +cs53*Cnnd[NsTs100*i + Ns100*j + 97*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 97*Ns + kd]
-             +cs54*Cnnd[NsTs100*i + Ns100*j + 98*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 98*Ns + kd]
-             +cs54*Cnnd[NsTs100*i + Ns100*j + 99*Ns + k]*Cnnd[NsTs100*i + Ns100*j + 99*Ns + kd]);
+            soapMat[NsNsLmaxTs*i + NsNsLmax*j + l*NsNs + shiftN] = prel*G[k*Ns + kd];
             shiftN++;
           }
         }
       }
     }
   }
+  free(A);
+  free(Aw);
+  free(G);
 }
 
 /**
  * Used to calculate the partial power spectrum.
  */
-void getPCrossOver(double* soapMat, double* Cnnd, int Ns, int Ts, int Hs, int lMax){
-  int NsTs100 = Ns*Ts*100;
-  int Ns100 = Ns*100;
+template<typename T>
+void getPCrossOver(T* soapMat, double* Cnnd, int Ns, int Ts, int Hs, int lMax){
   int NsNs = Ns*Ns;
   int NsNsLmax = NsNs*(lMax+1);
   int NsNsLmaxTs = NsNsLmax*getCrosNum(Ts);
-  int shiftN = 0;
-  int shiftT = 0;
-
-  //  double   cs0  = pow(PIHalf,2);
-  //  double   cs1  = pow(2.7206990464,2);
-  //  double cs2  = 2*pow(1.9238247452,2); double   cs3  = pow(1.7562036828,2); double cs4  = 2*pow(4.3018029072,2);
-  //  double cs5  = 2*pow(2.1509014536,2); double   cs6  = pow(2.0779682205,2); double cs7  = 2*pow(1.7995732672,2);
-  //  double cs8  = 2*pow(5.6907503408,2); double cs9  = 2*pow(2.3232390981,2); double   cs10 = pow(0.5890486225,2);
-  //  double cs11 = 2*pow(2.6343055241,2); double cs12 = 2*pow(1.8627352998,2); double cs13 = 2*pow(6.9697172942,2);
-  //  double cs14 = 2*pow(2.4641671809,2); double   cs15 = pow(0.6512177548,2); double cs16 = 2*pow(1.7834332706,2);
-  //  double cs17 = 2*pow(9.4370418280,2); double cs18 = 2*pow(1.9263280966,2); double cs19 = 2*pow(8.1727179596,2);
-  //  double cs20 = 2*pow(2.5844403427,2); double   cs21 = pow(0.3539741687,2); double cs22 = 2*pow(2.2940148014,2);
-  //  double cs23 = 2*pow(1.8135779397,2); double cs24 = 2*pow(3.6271558793,2); double cs25 = 2*pow(1.9866750947,2);
-  //  double cs26 = 2*pow(9.3183321738,2); double cs27 = 2*pow(2.6899707945,2); double   cs28 = pow(0.3802292509,2);
-  //  double cs29 = 2*pow(0.3556718963,2); double cs30 = 2*pow(0.8712146618,2); double cs31 = 2*pow(0.6160417952,2);
-  //  double cs32 = 2*pow(4.0863589798,2); double cs33 = 2*pow(2.0431794899,2); double cs34 = 2*pow(10.418212089,2);
-  //  double cs35 = 2*pow(2.7843843014,2); double   cs36 = pow(0.0505981185,2); double cs37 = 2*pow(0.4293392727,2);
-  //  double cs38 = 2*pow(1.7960550366,2); double cs39 = 2*pow(4.8637400313,2); double cs40 = 2*pow(1.8837184141,2);
-  //  double cs41 = 2*pow(13.583686661,2); double cs42 = 2*pow(2.0960083567,2); double cs43 = 2*pow(11.480310577,2);
-  //  double cs44 = 2*pow(2.8700776442,2); double   cs45 = pow(0.0534917379,2); double cs46 = 2*pow(0.2537335916,2);
-  //  double cs47 = 2*pow(2.3802320735,2); double cs48 = 2*pow(1.8179322747,2); double cs49 = 2*pow(16.055543121,2);
-  //  double cs50 = 2*pow(1.9190044477,2); double cs51 = 2*pow(4.9548481782,2); double cs52 = 2*pow(2.1455121971,2);
-  //  double cs53 = 2*pow(12.510378411,2); double cs54 = 2*pow(2.9487244699,2);
-  double cs0=2.4674011003; double cs1=7.4022033011; double cs2=7.4022033005;
-  double cs3=3.0842513755; double cs4=37.0110165048; double cs5=9.2527541262;
-  double cs6=4.3179519254; double cs7=6.4769278880; double cs8=64.7692788826;
-  double cs9=10.7948798139; double cs10=0.3469782797; double cs11=13.8791311886;
-  double cs12=6.9395655942; double cs13=97.1539183221; double cs14=12.1442397908;
-  double cs15=0.4240845642; double cs16=6.3612684614; double cs17=178.1155169268;
-  double cs18=7.4214798715; double cs19=133.5866376943; double cs20=13.3586637700;
-  double cs21=0.1252977121; double cs22=10.5250078181; double cs23=6.5781298867;
-  double cs24=26.3125195455; double cs25=7.8937558638; double cs26=173.6626290026;
-  double cs27=14.4718857505; double cs28=0.1445742832; double cs29=0.2530049956;
-  double cs30=1.5180299739; double cs31=0.7590149869; double cs32=33.3966594236;
-  double cs33=8.3491648559; double cs34=217.0782862628; double cs35=15.5055918758;
-  double cs36=0.0025601696; double cs37=0.3686644222; double cs38=6.4516273890;
-  double cs39=47.3119341841; double cs40=7.0967901272; double cs41=369.0330866085;
-  double cs42=8.7865020627; double cs43=263.5950618888; double cs44=16.4746913675;
-  double cs45=0.0028613660; double cs46=0.1287614710; double cs47=11.3310094474;
-  double cs48=6.6097555108; double cs49=515.5609298206; double cs50=7.3651561406;
-  double cs51=49.1010409380; double cs52=9.2064451758; double cs53=313.0191359728;
-  double cs54=17.3899519988;
-
-  // The power spectrum is multiplied by an l-dependent prefactor that comes
-  // from the normalization of the Wigner D matrices. This prefactor is
-  // mentioned in the arrata of the original SOAP paper: On representing
-  // chemical environments, Phys. Rev. B 87, 184115 (2013). Here the square
-  // root of the prefactor in the dot-product kernel is used, so that after a
-  // possible dot-product the full prefactor is recovered.
+  int Kmax = 2*lMax+1;
+  T* A = (T*) malloc(sizeof(T)*Ts*Ns*Kmax);
+  T* Aw = (T*) malloc(sizeof(T)*Ts*Ns*Kmax);
+  T* G = (T*) malloc(sizeof(T)*Ns*Ts*Ns);
 
-  // SUM M's UP!
-  double prel0 = PI*sqrt(8.0/(1.0));
-  for(int i = 0; i < Hs; i++){ // centers
-    shiftT = 0;
-    for(int j = 0; j < Ts; j++){ // type1
-      for(int jd = j; jd < Ts; jd++){ // type2
-        shiftN = 0;
-        for(int k = 0; k < Ns; k++){
-          for(int kd = 0; kd < Ns; kd++){
-            soapMat[NsNsLmaxTs*i + NsNsLmax*shiftT + 0 + shiftN] = prel0*(
-                cs0*Cnnd[NsTs100*i + Ns100*j + 0 + k]*Cnnd[NsTs100*i + Ns100*jd + 0 + kd]);
-            shiftN++;
-          }
-        }
-        shiftT++;
-      }
-    }
-  } if(lMax > 0){
-    double prel1 = PI*sqrt(8.0/(2.0*1.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ NsNs + shiftN] = prel1*(
-                  cs1*Cnnd[NsTs100*i + Ns100*j + 1*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 1*Ns + kd]
-                  +cs2*Cnnd[NsTs100*i + Ns100*j + 2*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 2*Ns + kd]
-                  +cs2*Cnnd[NsTs100*i + Ns100*j + 3*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 3*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 1){
-    double prel2 = PI*sqrt(8.0/(2.0*2.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 2*NsNs + shiftN] = prel2*(
-                  cs3*Cnnd[NsTs100*i + Ns100*j + 4*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 4*Ns + kd]
-                  +cs4*Cnnd[NsTs100*i + Ns100*j + 5*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 5*Ns + kd]
-                  +cs4*Cnnd[NsTs100*i + Ns100*j + 6*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 6*Ns + kd]
-                  +cs5*Cnnd[NsTs100*i + Ns100*j + 7*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 7*Ns + kd]
-                  +cs5*Cnnd[NsTs100*i + Ns100*j + 8*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 8*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 2){
-    double prel3 = PI*sqrt(8.0/(2.0*3.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 3*NsNs + shiftN] = prel3*(
-                  cs6*Cnnd[NsTs100*i + Ns100*j + 9*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 9*Ns + kd]
-                  +cs7*Cnnd[NsTs100*i + Ns100*j + 10*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 10*Ns + kd]
-                  +cs7*Cnnd[NsTs100*i + Ns100*j + 11*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 11*Ns + kd]
-                  +cs8*Cnnd[NsTs100*i + Ns100*j + 12*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 12*Ns + kd]
-                  +cs8*Cnnd[NsTs100*i + Ns100*j + 13*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 13*Ns + kd]
-                  +cs9*Cnnd[NsTs100*i + Ns100*j + 14*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 14*Ns + kd]
-                  +cs9*Cnnd[NsTs100*i + Ns100*j + 15*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 15*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 3){
-    double prel4 = PI*sqrt(8.0/(2.0*4.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 4*NsNs + shiftN] = prel4*(
-                  cs10*Cnnd[NsTs100*i + Ns100*j + 16*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 16*Ns + kd]
-                  +cs11*Cnnd[NsTs100*i + Ns100*j + 17*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 17*Ns + kd]
-                  +cs11*Cnnd[NsTs100*i + Ns100*j + 18*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 18*Ns + kd]
-                  +cs12*Cnnd[NsTs100*i + Ns100*j + 19*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 19*Ns + kd]
-                  +cs12*Cnnd[NsTs100*i + Ns100*j + 20*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 20*Ns + kd]
-                  +cs13*Cnnd[NsTs100*i + Ns100*j + 21*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 21*Ns + kd]
-                  +cs13*Cnnd[NsTs100*i + Ns100*j + 22*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 22*Ns + kd]
-                  +cs14*Cnnd[NsTs100*i + Ns100*j + 23*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 23*Ns + kd]
-                  +cs14*Cnnd[NsTs100*i + Ns100*j + 24*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 24*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 4) {
-    double prel5 = PI*sqrt(8.0/(2.0*5.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 5*NsNs + shiftN] = prel5*(
-                  cs15*Cnnd[NsTs100*i + Ns100*j + 25*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 25*Ns + kd]
-                  +cs16*Cnnd[NsTs100*i + Ns100*j + 26*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 26*Ns + kd]
-                  +cs16*Cnnd[NsTs100*i + Ns100*j + 27*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 27*Ns + kd]
-                  +cs17*Cnnd[NsTs100*i + Ns100*j + 28*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 28*Ns + kd]
-                  +cs17*Cnnd[NsTs100*i + Ns100*j + 29*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 29*Ns + kd]
-                  +cs18*Cnnd[NsTs100*i + Ns100*j + 30*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 30*Ns + kd]
-                  +cs18*Cnnd[NsTs100*i + Ns100*j + 31*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 31*Ns + kd]
-                  +cs19*Cnnd[NsTs100*i + Ns100*j + 32*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 32*Ns + kd]
-                  +cs19*Cnnd[NsTs100*i + Ns100*j + 33*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 33*Ns + kd]
-                  +cs20*Cnnd[NsTs100*i + Ns100*j + 34*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 34*Ns + kd]
-                  +cs20*Cnnd[NsTs100*i + Ns100*j + 35*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 35*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 5){
-    double prel6 = PI*sqrt(8.0/(2.0*6.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 6*NsNs + shiftN] = prel6*(
-                  cs21*Cnnd[NsTs100*i + Ns100*j + 36*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 36*Ns + kd]
-                  +cs22*Cnnd[NsTs100*i + Ns100*j + 37*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 37*Ns + kd]
-                  +cs22*Cnnd[NsTs100*i + Ns100*j + 38*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 38*Ns + kd]
-                  +cs23*Cnnd[NsTs100*i + Ns100*j + 39*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 39*Ns + kd]
-                  +cs23*Cnnd[NsTs100*i + Ns100*j + 40*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 40*Ns + kd]
-                  +cs24*Cnnd[NsTs100*i + Ns100*j + 41*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 41*Ns + kd]
-                  +cs24*Cnnd[NsTs100*i + Ns100*j + 42*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 42*Ns + kd]
-                  +cs25*Cnnd[NsTs100*i + Ns100*j + 43*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 43*Ns + kd]
-                  +cs25*Cnnd[NsTs100*i + Ns100*j + 44*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 44*Ns + kd]
-                  +cs26*Cnnd[NsTs100*i + Ns100*j + 45*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 45*Ns + kd]
-                  +cs26*Cnnd[NsTs100*i + Ns100*j + 46*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 46*Ns + kd]
-                  +cs27*Cnnd[NsTs100*i + Ns100*j + 47*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 47*Ns + kd]
-                  +cs27*Cnnd[NsTs100*i + Ns100*j + 48*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 48*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 6){
-    double prel7 = PI*sqrt(8.0/(2.0*7.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 7*NsNs + shiftN] = prel7*(
-                  cs28*Cnnd[NsTs100*i + Ns100*j + 49*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 49*Ns + kd]
-                  +cs29*Cnnd[NsTs100*i + Ns100*j + 50*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 50*Ns + kd]
-                  +cs29*Cnnd[NsTs100*i + Ns100*j + 51*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 51*Ns + kd]
-                  +cs30*Cnnd[NsTs100*i + Ns100*j + 52*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 52*Ns + kd]
-                  +cs30*Cnnd[NsTs100*i + Ns100*j + 53*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 53*Ns + kd]
-                  +cs31*Cnnd[NsTs100*i + Ns100*j + 54*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 54*Ns + kd]
-                  +cs31*Cnnd[NsTs100*i + Ns100*j + 55*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 55*Ns + kd]
-                  +cs32*Cnnd[NsTs100*i + Ns100*j + 56*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 56*Ns + kd]
-                  +cs32*Cnnd[NsTs100*i + Ns100*j + 57*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 57*Ns + kd]
-                  +cs33*Cnnd[NsTs100*i + Ns100*j + 58*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 58*Ns + kd]
-                  +cs33*Cnnd[NsTs100*i + Ns100*j + 59*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 59*Ns + kd]
-                  +cs34*Cnnd[NsTs100*i + Ns100*j + 60*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 60*Ns + kd]
-                  +cs34*Cnnd[NsTs100*i + Ns100*j + 61*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 61*Ns + kd]
-                  +cs35*Cnnd[NsTs100*i + Ns100*j + 62*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 62*Ns + kd]
-                  +cs35*Cnnd[NsTs100*i + Ns100*j + 63*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 63*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 7){
-    double prel8 = PI*sqrt(8.0/(2.0*8.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
-      for(int j = 0; j < Ts; j++){
-        for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
-          for(int k = 0; k < Ns; k++){
-            for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 8*NsNs + shiftN] = prel8*(
-                  cs36*Cnnd[NsTs100*i + Ns100*j + 64*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 64*Ns + kd]
-                  +cs37*Cnnd[NsTs100*i + Ns100*j + 65*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 65*Ns + kd]
-                  +cs37*Cnnd[NsTs100*i + Ns100*j + 66*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 66*Ns + kd]
-                  +cs38*Cnnd[NsTs100*i + Ns100*j + 67*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 67*Ns + kd]
-                  +cs38*Cnnd[NsTs100*i + Ns100*j + 68*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 68*Ns + kd]
-                  +cs39*Cnnd[NsTs100*i + Ns100*j + 69*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 69*Ns + kd]
-                  +cs39*Cnnd[NsTs100*i + Ns100*j + 70*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 70*Ns + kd]
-                  +cs40*Cnnd[NsTs100*i + Ns100*j + 71*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 71*Ns + kd]
-                  +cs40*Cnnd[NsTs100*i + Ns100*j + 72*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 72*Ns + kd]
-                  +cs41*Cnnd[NsTs100*i + Ns100*j + 73*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 73*Ns + kd]
-                  +cs41*Cnnd[NsTs100*i + Ns100*j + 74*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 74*Ns + kd]
-                  +cs42*Cnnd[NsTs100*i + Ns100*j + 75*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 75*Ns + kd]
-                  +cs42*Cnnd[NsTs100*i + Ns100*j + 76*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 76*Ns + kd]
-                  +cs43*Cnnd[NsTs100*i + Ns100*j + 77*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 77*Ns + kd]
-                  +cs43*Cnnd[NsTs100*i + Ns100*j + 78*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 78*Ns + kd]
-                  +cs44*Cnnd[NsTs100*i + Ns100*j + 79*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 79*Ns + kd]
-                  +cs44*Cnnd[NsTs100*i + Ns100*j + 80*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 80*Ns + kd]);
-              shiftN++;
-            }
-          }
-          shiftT++;
-        }
-      }
-    }
-  }  if(lMax > 8){
-    double prel9 = PI*sqrt(8.0/(2.0*9.0+1.0));
-    for(int i = 0; i < Hs; i++){
-      shiftT = 0;
+  // See getPNoCross for the prefactors. Per centre and l, the rows of
+  // type j are multiplied against the rows of all types jd >= j at once.
+  for(int i = 0; i < Hs; i++){
+    for(int l = 0; l <= lMax; l++){
+      double prel = PI*sqrt(8.0/(2.0*l+1.0));
+      int K = 2*l+1;
+      getPackedL(A, Aw, Cnnd, i, l, Ns, Ts);
+      int shiftT = 0;
       for(int j = 0; j < Ts; j++){
+        int nCols = (Ts-j)*Ns;
+        gemm_nt(Ns, nCols, K, Aw + j*Ns*K, K, A + j*Ns*K, K, G, nCols);
         for(int jd = j; jd < Ts; jd++){
-          shiftN = 0;
+          int shiftN = 0;
           for(int k = 0; k < Ns; k++){
             for(int kd = 0; kd < Ns; kd++){
-              soapMat[NsNsLmaxTs*i+NsNsLmax*shiftT+ 9*NsNs + shiftN] = prel9*(
-                  cs45*Cnnd[NsTs100*i + Ns100*j + 81*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 81*Ns + kd]
-                  +cs46*Cnnd[NsTs100*i + Ns100*j + 82*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 82*Ns + kd]
-                  +cs46*Cnnd[NsTs100*i + Ns100*j + 83*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 83*Ns + kd]
-                  +cs47*Cnnd[NsTs100*i + Ns100*j + 84*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 84*Ns + kd]
-                  +cs47*Cnnd[NsTs100*i + Ns100*j + 85*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 85*Ns + kd]
-                  +cs48*Cnnd[NsTs100*i + Ns100*j + 86*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 86*Ns + kd]
-                  +cs48*Cnnd[NsTs100*i + Ns100*j + 87*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 87*Ns + kd]
-                  +cs49*Cnnd[NsTs100*i + Ns100*j + 88*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 88*Ns + kd]
-                  +cs49*Cnnd[NsTs100*i + Ns100*j + 89*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 89*Ns + kd]
-                  +cs50*Cnnd[NsTs100*i + Ns100*j + 90*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 90*Ns + kd]
-                  +cs50*Cnnd[NsTs100*i + Ns100*j + 91*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 91*Ns + kd]
-                  +cs51*Cnnd[NsTs100*i + Ns100*j + 92*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 92*Ns + kd]
-                  +cs51*Cnnd[NsTs100*i + Ns100*j + 93*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 93*Ns + kd]
-                  +cs52*Cnnd[NsTs100*i + Ns100*j + 94*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 94*Ns + kd]
-                  +cs52*Cnnd[NsTs100*i + Ns100*j + 95*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 95*Ns + kd]
-                  +cs53*Cnnd[NsTs100*i + Ns100*j + 96*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 96*Ns + kd]
-                  +cs53*Cnnd[NsTs100*i + Ns100*j + 97*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 97*Ns + kd]
-                  +cs54*Cnnd[NsTs100*i + Ns100*j + 98*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 98*Ns + kd]
-                  +cs54*Cnnd[NsTs100*i + Ns100*j + 99*Ns + k]*Cnnd[NsTs100*i + Ns100*jd + 99*Ns + kd]);
+              soapMat[NsNsLmaxTs*i + NsNsLmax*shiftT + l*NsNs + shiftN] = 
+                prel*G[k*nCols + (jd-j)*Ns + kd];
               shiftN++;
             }
           }
@@ -1213,59 +809,113 @@ void getPCrossOver(double* soapMat, double* Cnnd, int Ns, int Ts, int Hs, int lM
       }
     }
   }
+  free(A);
+  free(Aw);
+  free(G);
 }
 
-void soapGTO(
-        py::array_t<double> cArr, 
-        py::array_t<double> positions, 
-        py::array_t<double> HposArr, 
-        py::array_t<double> alphasArr, 
-        py::array_t<double> betasArr, 
-        py::array_t<int> atomicNumbersArr, 
-        py::array_t<int> atomicNumbersGlobalArr,
+/**
+ * Power spectrum rows (all or the selected channels) of Hs centres.
+ */
+template<typename T>
+void getPowerSpectrum(T* c, double* cnnd, int Ns, int Nt, int Hs, int lMax,
+    const int* channels, int nChannels, bool crossover){
+  if (channels != NULL) {
+      getPSelected(c, cnnd, Ns, Nt, Hs, lMax, crossover, channels, nChannels);
+  } else if (crossover) {
+      getPCrossOver(c, cnnd, Ns, Nt, Hs, lMax);
+  } else {
+      getPNoCross(c, cnnd, Ns, Nt, Hs, lMax);
+  }
+}
+
+map<int, int> getZIndexMap(int *atomicNumbersGlobal, int Nt) {
+  // Create a mapping between an atomic index and its internal index in the output
+  map<int, int> ZIndexMap;
+  set<int> atomicNumberSet;
+  for (int i = 0; i < Nt; ++i) {
+      atomicNumberSet.insert(atomicNumbersGlobal[i]);
+  };
+  int i = 0;
+  for (auto it=atomicNumberSet.begin(); it!=atomicNumberSet.end(); ++it) {
+      ZIndexMap[*it] = i;
+      ++i;
+  };
+  return ZIndexMap;
+}
+
+template<typename T>
+void soapGTOSystem(
+        T *c, 
+        const NeighbourList &nl,
+        double *alphas, 
+        double *betas, 
+        const map<int, int> &ZIndexMap,
         double rCut, 
         double cutoffPadding, 
-        int totalAN, 
-        int Nt, // n_types
-        int Ns, // n_radial
+        int Nt, 
+        int Ns, 
         int lMax, 
-        int Hs, // n_heavy
         double eta, 
+        const double *radialTable,
+        int radialNIn,
+        int radialNOut,
+        const int *channels,
+        int nChannels,
         bool crossover,
-        bool power) {
+        bool power,
+        int pooling=POOL_NONE,
+        bool normalize=false,
+        double epsilon=0.) {
 
-  auto atomicNumbers = atomicNumbersArr.unchecked<1>();
-  auto atomicNumbersGlobal = atomicNumbersGlobalArr.unchecked<1>();
-  double *c = (double*)cArr.request().ptr;
-  double *Hpos = (double*)HposArr.request().ptr;
-  double *alphas = (double*)alphasArr.request().ptr;
-  double *betas = (double*)betasArr.request().ptr;
+  // Neighbours within rCut+cutoffPadding of the Hs centres. The per
+  // neighbour scratch arrays are strided by the largest neighbourhood.
+  int totalAN = max(1, nl.getMaxNeighbours());
+  int Hs = nl.nCentres;
+  // Pooling (power spectrum only): The coefficients of one centre at a
+  // time are contracted and the rows added up, c then holds a single row
+  bool pooled = (pooling != POOL_NONE && power);
+  int Hc = (pooled) ? 1 : Hs;
+  int dimOut = (channels != NULL) ? nChannels : ((crossover) ? 
+    Ns*Ns*(lMax+1)*getCrosNum(Nt) : getCrosNum(Ns)*(lMax+1)*Nt);
+  vector<vector<double> > poolAccs;
+  T* row = NULL;
+  if (pooled) {
+    poolAccs.assign(1, vector<double>(dimOut, 0.0));
+    row = (T*) malloc(sizeof(T)*dimOut);
+  }
 
   double oOeta = 1.0/eta;
   double oOeta3O2 = sqrt(oOeta*oOeta*oOeta);
 
   double NsNs = Ns*Ns;
-  double* dx  = (double*) malloc(sizeof(double)*totalAN);
-  double* dy  = (double*) malloc(sizeof(double)*totalAN);
-  double* dz  = (double*) malloc(sizeof(double)*totalAN);
-  double* z2 = (double*) malloc(sizeof(double)*totalAN);
-  double* z4 = (double*) malloc(sizeof(double)*totalAN);
-  double* z6 = (double*) malloc(sizeof(double)*totalAN);
-  double* z8 = (double*) malloc(sizeof(double)*totalAN);
-  double* r2 = (double*) malloc(sizeof(double)*totalAN);
-  double* r4 = (double*) malloc(sizeof(double)*totalAN);
-  double* r6 = (double*) malloc(sizeof(double)*totalAN);
-  double* r8 = (double*) malloc(sizeof(double)*totalAN);
-  double* ReIm2 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* ReIm3 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* ReIm4 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* ReIm5 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* ReIm6 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* ReIm7 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* ReIm8 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* ReIm9 = (double*) malloc(2*sizeof(double)*totalAN);// 2 -> Re + ixIm
-  double* exes = (double*) malloc (sizeof(double)*totalAN);
-  double* preCoef = (double*) malloc(96*sizeof(double)*totalAN);
+  T* dx  = (T*) malloc(sizeof(T)*totalAN);
+  T* dy  = (T*) malloc(sizeof(T)*totalAN);
+  T* dz  = (T*) malloc(sizeof(T)*totalAN);
+  T* z2 = (T*) malloc(sizeof(T)*totalAN);
+  T* z4 = (T*) malloc(sizeof(T)*totalAN);
+  T* z6 = (T*) malloc(sizeof(T)*totalAN);
+  T* z8 = (T*) malloc(sizeof(T)*totalAN);
+  T* r2 = (T*) malloc(sizeof(T)*totalAN);
+  T* r4 = (T*) malloc(sizeof(T)*totalAN);
+  T* r6 = (T*) malloc(sizeof(T)*totalAN);
+  T* r8 = (T*) malloc(sizeof(T)*totalAN);
+  T* ReIm2 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* ReIm3 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* ReIm4 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* ReIm5 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* ReIm6 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* ReIm7 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* ReIm8 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* ReIm9 = (T*) malloc(2*sizeof(T)*totalAN);// 2 -> Re + ixIm
+  T* exes = (T*) malloc (sizeof(T)*totalAN);
+  T* rs = NULL;
+  T* exesTab = NULL;
+  if (radialTable) {
+    rs = (T*) malloc(sizeof(T)*totalAN);
+    exesTab = (T*) malloc((lMax+1)*Ns*sizeof(T)*totalAN);
+  }
+  T* preCoef = (T*) malloc(96*sizeof(T)*totalAN);
   double* bOa = (double*) malloc((lMax+1)*NsNs*sizeof(double));
   double* aOa = (double*) malloc((lMax+1)*Ns*sizeof(double));
 
@@ -1328,46 +978,24 @@ void soapGTO(
   int t95 = 95*totalAN;  int t96 = 96*totalAN;  int t97 = 97*totalAN;
   int t98 = 98*totalAN;  int t99 = 99*totalAN;
 
-  double* cnnd = (double*) malloc(100*Nt*Ns*Hs*sizeof(double));
-  for(int i = 0; i < 100*Nt*Ns*Hs; i++){cnnd[i] = 0.0;}
-
-  // Initialize binning
-  GridSearch cellList(positions, rCut+cutoffPadding);
-
-  // Create a mapping between an atomic index and its internal index in the output
-  map<int, int> ZIndexMap;
-  set<int> atomicNumberSet;
-  for (int i = 0; i < Nt; ++i) {
-      atomicNumberSet.insert(atomicNumbersGlobal(i));
-  };
-  int i = 0;
-  for (auto it=atomicNumberSet.begin(); it!=atomicNumberSet.end(); ++it) {
-      ZIndexMap[*it] = i;
-      ++i;
-  };
+  double* cnnd = (double*) malloc(100*Nt*Ns*Hc*sizeof(double));
+  for(int i = 0; i < 100*Nt*Ns*Hc; i++){cnnd[i] = 0.0;}
 
   getAlphaBeta(aOa,bOa,alphas,betas,Ns,lMax,oOeta, oOeta3O2);
 
   // Loop through the centers
   for (int i = 0; i < Hs; i++) {
-    // Get all neighbours for the central atom i
-    double ix = Hpos[3*i];
-    double iy = Hpos[3*i+1];
-    double iz = Hpos[3*i+2];
-    GridSearchResult result = cellList.getNeighboursForPosition(ix, iy, iz);
-    // Sort the neighbours by type
-    map<int, vector<int>> atomicTypeMap;
-    for (const int &idx : result.indices) {
-        int Z = atomicNumbers(idx);
-        atomicTypeMap[Z].push_back(idx);
-    };
-    // Loop through neighbours sorted by type
-    for (const auto &ZIndexPair : atomicTypeMap) {
+    int posI = (pooled) ? 0 : i;
+    if (pooled) {
+      for(int k = 0; k < 100*Nt*Ns; k++){cnnd[k] = 0.0;}
+    }
+    // Loop through the neighbours of the central atom i, sorted by type
+    for (long g = nl.centreGroups[i]; g < nl.centreGroups[i+1]; g++) {
       // j is the internal index for this atomic number
-      int j = ZIndexMap[ZIndexPair.first];
-      int n_neighbours = ZIndexPair.second.size();
+      int j = ZIndexMap.at(nl.groupTypes[g]);
+      int n_neighbours = nl.groupOffsets[g+1] - nl.groupOffsets[g];
       // Save the neighbour distances into the arrays dx, dy and dz
-      getDeltas(dx, dy, dz, positions, ix, iy, iz, ZIndexPair.second);
+      getDeltas(dx, dy, dz, nl, nl.groupOffsets[g], nl.groupOffsets[g+1]);
       getRsZs(dx, dy, dz, r2, r4, r6, r8, z2, z4, z6, z8, n_neighbours);
       getCfactors(preCoef, n_neighbours, dx, dy, dz, z2, z4, z6, z8, r2, r4, r6, r8, 
         ReIm2, ReIm3, ReIm4, ReIm5, ReIm6, ReIm7, ReIm8, ReIm9, totalAN, lMax, 
@@ -1378,8 +1006,13 @@ void soapGTO(
         t60, t61, t62, t63, t64, t65, t66, t67, t68, t69, t70, t71, t72, t73, 
         t74, t75, t76, t77, t78, t79, t80, t81, t82, t83, t84, t85, t86, t87, 
         t88, t89, t90, t91, t92, t93, t94, t95, t96, t97, t98, t99);
-      getC(cnnd, preCoef, dx, dy, dz, r2, bOa, aOa, exes, totalAN, n_neighbours, 
-        Ns, Nt, lMax, i, j, Nx2, Nx3, Nx4, Nx5, Nx6, Nx7, Nx8, Nx9, Nx10, Nx11, Nx12, 
+      if (radialTable) {
+        for (int k = 0; k < n_neighbours; k++) { rs[k] = sqrt(r2[k]); }
+        interpolate_radial_table(radialTable, (lMax+1)*Ns, radialNIn, radialNOut,
+          rCut+cutoffPadding, rCut+cutoffPadding, rs, n_neighbours, exesTab);
+      }
+      getC(cnnd, preCoef, dx, dy, dz, r2, bOa, aOa, exes, (radialTable) ? exesTab : NULL, totalAN, n_neighbours, 
+        Ns, Nt, lMax, posI, j, Nx2, Nx3, Nx4, Nx5, Nx6, Nx7, Nx8, Nx9, Nx10, Nx11, Nx12, 
         Nx13, Nx14, Nx15, Nx16, Nx17, Nx18, Nx19, Nx20, Nx21, Nx22, Nx23, Nx24, Nx25, 
         Nx26, Nx27, Nx28, Nx29, Nx30, Nx31, Nx32, Nx33, Nx34, Nx35, Nx36, Nx37, Nx38, 
         Nx39, Nx40, Nx41, Nx42, Nx43, Nx44, Nx45, Nx46, Nx47, Nx48, Nx49, Nx50, Nx51, 
@@ -1394,6 +1027,10 @@ void soapGTO(
         t67, t68, t69, t70, t71, t72, t73, t74, t75, t76, t77, t78, t79, t80, t81, t82, 
         t83, t84, t85, t86, t87, t88, t89, t90, t91, t92, t93, t94, t95, t96, t97, t98, t99);
     }
+    if (pooled) {
+      getPowerSpectrum(row, cnnd, Ns, Nt, 1, lMax, channels, nChannels, crossover);
+      pool_row(poolAccs[0].data(), row, dimOut, normalize, epsilon);
+    }
   }
 
   free(dx);
@@ -1416,16 +1053,19 @@ void soapGTO(
   free(ReIm8);
   free(ReIm9);
   free(exes);
+  if (radialTable) {
+    free(rs);
+    free(exesTab);
+  }
   free(preCoef);
   free(bOa);
   free(aOa);
 
-  if (power) {
-      if (crossover) {
-        getPCrossOver(c, cnnd, Ns, Nt, Hs, lMax);
-      } else {
-        getPNoCross(c, cnnd, Ns, Nt, Hs, lMax);
-      };
+  if (pooled) {
+      pool_reduce(c, poolAccs, dimOut, pooling, Hs);
+      free(row);
+  } else if (power) {
+      getPowerSpectrum(c, cnnd, Ns, Nt, Hs, lMax, channels, nChannels, crossover);
   } else {
       for(int i = 0; i < (lMax+1)*(lMax+1)*Nt*Ns*Hs; i++) {
         c[i] = cnnd[i];
@@ -1436,3 +1076,302 @@ void soapGTO(
   return;
 }
 
+
+int* getChannels(py::buffer_info &buf, int Ns, int Ts, int lMax, bool crossover){
+  // An empty index list selects all channels
+  if (buf.size == 0) return NULL;
+  int* channels = (int*)buf.ptr;
+  int dim = (crossover) ? Ns*Ns*(lMax+1)*getCrosNum(Ts) : getCrosNum(Ns)*(lMax+1)*Ts;
+  for (int c = 0; c < buf.size; c++) {
+    if (channels[c] < 0 || channels[c] >= dim) {
+      throw std::invalid_argument("Channel index out of range");
+    }
+  }
+  return channels;
+}
+
+bool isSinglePrecision(py::buffer_info &buf){
+  // The precision of the evaluation follows the output array
+  if (buf.format == py::format_descriptor<float>::format()) return true;
+  if (buf.format == py::format_descriptor<double>::format()) return false;
+  throw std::invalid_argument("Output array must be of type float32 or float64");
+}
+
+void getRadialTableLayout(py::buffer_info &buf, int nFct, int nIn, 
+        double *&table, int &nOut) {
+  // An empty table selects the analytic exponentials
+  table = NULL;
+  nOut = 0;
+  if (buf.size == 0) return;
+  int nNodes = buf.size/(2*nFct);
+  if (nNodes*2*nFct != buf.size || nNodes < 2 || nNodes < nIn+1) {
+    throw std::invalid_argument("Radial table inconsistent with nmax, lmax");
+  }
+  table = (double*)buf.ptr;
+  nOut = nNodes-1-nIn;
+}
+
+py::tuple buildSoapGTORadialTable(
+        py::array_t<double> alphasArr, 
+        py::array_t<double> betasArr, 
+        double rCut, 
+        double cutoffPadding, 
+        int Ns, 
+        int lMax, 
+        double eta, 
+        double tol) {
+  // Tabulates the gaussians exp(aOa_lk r^2) of getC on [0, rCut+cutoffPadding]
+  py::buffer_info alphasBuf = alphasArr.request();
+  py::buffer_info betasBuf = betasArr.request();
+  double *alphas = (double*)alphasBuf.ptr;
+  double *betas = (double*)betasBuf.ptr;
+  int nLk = (lMax+1)*Ns;
+  int nIn, nOut;
+  vector<double> table;
+  {
+    py::gil_scoped_release release;
+    double oOeta = 1.0/eta;
+    double oOeta3O2 = sqrt(oOeta*oOeta*oOeta);
+    vector<double> aOa(nLk);
+    vector<double> bOa((lMax+1)*Ns*Ns);
+    getAlphaBeta(aOa.data(), bOa.data(), alphas, betas, Ns, lMax, oOeta, oOeta3O2);
+    radial_fct_t fct = [&](double r, double *f, double *df) {
+      for (int lk = 0; lk < nLk; lk++) {
+        f[lk] = exp(aOa[lk]*r*r);
+        df[lk] = 2.0*aOa[lk]*r*f[lk];
+      }
+    };
+    table = build_radial_table(fct, nLk, rCut+cutoffPadding, rCut+cutoffPadding, 
+      tol, nIn, nOut);
+  }
+  py::array_t<double> tableArr({ (long) (nIn+nOut+1), (long) 2, (long) nLk });
+  std::copy(table.begin(), table.end(), (double*)tableArr.request().ptr);
+  return py::make_tuple(tableArr, nIn);
+}
+
+void soapGTO(
+        py::array cArr, 
+        py::array_t<double> positions, 
+        py::array_t<double> HposArr, 
+        py::array_t<double> alphasArr, 
+        py::array_t<double> betasArr, 
+        py::array_t<int> atomicNumbersArr, 
+        py::array_t<int> atomicNumbersGlobalArr,
+        py::array_t<double> cellArr, 
+        py::array_t<bool> pbcArr, 
+        double rCut, 
+        double cutoffPadding, 
+        int totalAN, 
+        int Nt, // n_types
+        int Ns, // n_radial
+        int lMax, 
+        int Hs, // n_heavy
+        double eta, 
+        py::array_t<double> radialTableArr,
+        int radialNIn,
+        py::array_t<int> channelsArr,
+        bool crossover,
+        bool power,
+        int pooling,
+        bool normalize,
+        double epsilon) {
+
+  // Pin array buffers: The numeric part below runs without the GIL
+  py::buffer_info cBuf = cArr.request();
+  py::buffer_info positionsBuf = positions.request();
+  py::buffer_info HposBuf = HposArr.request();
+  py::buffer_info alphasBuf = alphasArr.request();
+  py::buffer_info betasBuf = betasArr.request();
+  py::buffer_info atomicNumbersBuf = atomicNumbersArr.request();
+  py::buffer_info atomicNumbersGlobalBuf = atomicNumbersGlobalArr.request();
+  py::buffer_info cellBuf = cellArr.request();
+  py::buffer_info pbcBuf = pbcArr.request();
+  const double *cell = NULL;
+  const bool *pbc = NULL;
+  getPeriodicCell(cellBuf, pbcBuf, cell, pbc);
+  bool single = isSinglePrecision(cBuf);
+  double *pos = (double*)positionsBuf.ptr;
+  double *Hpos = (double*)HposBuf.ptr;
+  double *alphas = (double*)alphasBuf.ptr;
+  double *betas = (double*)betasBuf.ptr;
+  int *atomicNumbers = (int*)atomicNumbersBuf.ptr;
+  int *atomicNumbersGlobal = (int*)atomicNumbersGlobalBuf.ptr;
+  py::buffer_info radialTableBuf = radialTableArr.request();
+  double *radialTable = NULL;
+  int radialNOut = 0;
+  getRadialTableLayout(radialTableBuf, (lMax+1)*Ns, radialNIn, radialTable, radialNOut);
+  py::buffer_info channelsBuf = channelsArr.request();
+  int nChannels = channelsBuf.size;
+  int *channels = getChannels(channelsBuf, Ns, Nt, lMax, crossover);
+  py::gil_scoped_release release;
+
+  map<int, int> ZIndexMap = getZIndexMap(atomicNumbersGlobal, Nt);
+  NeighbourList nl(Hpos, Hs, pos, atomicNumbers, totalAN, rCut+cutoffPadding, 1, cell, pbc);
+  if (single) soapGTOSystem((float*)cBuf.ptr, nl, alphas, betas, ZIndexMap,
+    rCut, cutoffPadding, Nt, Ns, lMax, eta, 
+    radialTable, radialNIn, radialNOut, channels, nChannels, crossover, power,
+    pooling, normalize, epsilon);
+  else soapGTOSystem((double*)cBuf.ptr, nl, alphas, betas, ZIndexMap,
+    rCut, cutoffPadding, Nt, Ns, lMax, eta, 
+    radialTable, radialNIn, radialNOut, channels, nChannels, crossover, power,
+    pooling, normalize, epsilon);
+}
+
+void soapGTONeighbours(
+        py::array cArr, 
+        const NeighbourList &nlIn,
+        py::array_t<double> alphasArr, 
+        py::array_t<double> betasArr, 
+        py::array_t<int> atomicNumbersGlobalArr,
+        double rCut, 
+        double cutoffPadding, 
+        int Nt, // n_types
+        int Ns, // n_radial
+        int lMax, 
+        double eta, 
+        py::array_t<double> radialTableArr,
+        int radialNIn,
+        py::array_t<int> channelsArr,
+        bool crossover,
+        bool power,
+        int pooling,
+        bool normalize,
+        double epsilon) {
+
+  // As soapGTO, for the centres and neighbours of a prebuilt neighbour
+  // list. A list with a larger cutoff is filtered to rCut+cutoffPadding.
+  py::buffer_info cBuf = cArr.request();
+  py::buffer_info alphasBuf = alphasArr.request();
+  py::buffer_info betasBuf = betasArr.request();
+  py::buffer_info atomicNumbersGlobalBuf = atomicNumbersGlobalArr.request();
+  bool single = isSinglePrecision(cBuf);
+  double *alphas = (double*)alphasBuf.ptr;
+  double *betas = (double*)betasBuf.ptr;
+  int *atomicNumbersGlobal = (int*)atomicNumbersGlobalBuf.ptr;
+  py::buffer_info radialTableBuf = radialTableArr.request();
+  double *radialTable = NULL;
+  int radialNOut = 0;
+  getRadialTableLayout(radialTableBuf, (lMax+1)*Ns, radialNIn, radialTable, radialNOut);
+  py::buffer_info channelsBuf = channelsArr.request();
+  int nChannels = channelsBuf.size;
+  int *channels = getChannels(channelsBuf, Ns, Nt, lMax, crossover);
+  double cutoff = rCut+cutoffPadding;
+  if (nlIn.cutoff < cutoff) {
+    throw std::invalid_argument("Neighbour list cutoff smaller than rCut+cutoffPadding");
+  }
+  map<int, int> ZIndexMap = getZIndexMap(atomicNumbersGlobal, Nt);
+  for (const int &Z : nlIn.groupTypes) {
+    if (ZIndexMap.count(Z) == 0) {
+      throw std::invalid_argument("Neighbour list contains unknown types");
+    }
+  }
+  py::gil_scoped_release release;
+
+  NeighbourList nlFiltered = (nlIn.cutoff > cutoff) ? nlIn.filter(cutoff) : NeighbourList();
+  const NeighbourList &nl = (nlIn.cutoff > cutoff) ? nlFiltered : nlIn;
+  if (single) soapGTOSystem((float*)cBuf.ptr, nl, alphas, betas, ZIndexMap,
+    rCut, cutoffPadding, Nt, Ns, lMax, eta, 
+    radialTable, radialNIn, radialNOut, channels, nChannels, crossover, power,
+    pooling, normalize, epsilon);
+  else soapGTOSystem((double*)cBuf.ptr, nl, alphas, betas, ZIndexMap,
+    rCut, cutoffPadding, Nt, Ns, lMax, eta, 
+    radialTable, radialNIn, radialNOut, channels, nChannels, crossover, power,
+    pooling, normalize, epsilon);
+}
+
+void soapGTOBatch(
+        py::array cArr, 
+        py::array_t<double> positions, 
+        py::array_t<double> HposArr, 
+        py::array_t<double> alphasArr, 
+        py::array_t<double> betasArr, 
+        py::array_t<int> atomicNumbersArr, 
+        py::array_t<int> atomicNumbersGlobalArr,
+        py::array_t<int> nAtomsArr,
+        py::array_t<int> nCentresArr,
+        double rCut, 
+        double cutoffPadding, 
+        int nStructs,
+        int Nt, // n_types
+        int Ns, // n_radial
+        int lMax, 
+        double eta, 
+        py::array_t<double> radialTableArr,
+        int radialNIn,
+        py::array_t<int> channelsArr,
+        bool crossover,
+        bool power,
+        int nThreads,
+        int pooling,
+        bool normalize,
+        double epsilon) {
+
+  py::buffer_info cBuf = cArr.request();
+  py::buffer_info positionsBuf = positions.request();
+  py::buffer_info HposBuf = HposArr.request();
+  py::buffer_info alphasBuf = alphasArr.request();
+  py::buffer_info betasBuf = betasArr.request();
+  py::buffer_info atomicNumbersBuf = atomicNumbersArr.request();
+  py::buffer_info atomicNumbersGlobalBuf = atomicNumbersGlobalArr.request();
+  py::buffer_info nAtomsBuf = nAtomsArr.request();
+  py::buffer_info nCentresBuf = nCentresArr.request();
+  bool single = isSinglePrecision(cBuf);
+  double *pos = (double*)positionsBuf.ptr;
+  double *Hpos = (double*)HposBuf.ptr;
+  double *alphas = (double*)alphasBuf.ptr;
+  double *betas = (double*)betasBuf.ptr;
+  int *atomicNumbers = (int*)atomicNumbersBuf.ptr;
+  int *atomicNumbersGlobal = (int*)atomicNumbersGlobalBuf.ptr;
+  int *nAtoms = (int*)nAtomsBuf.ptr;
+  int *nCentres = (int*)nCentresBuf.ptr;
+  py::buffer_info radialTableBuf = radialTableArr.request();
+  double *radialTable = NULL;
+  int radialNOut = 0;
+  getRadialTableLayout(radialTableBuf, (lMax+1)*Ns, radialNIn, radialTable, radialNOut);
+  py::buffer_info channelsBuf = channelsArr.request();
+  int nChannels = channelsBuf.size;
+  int *channels = getChannels(channelsBuf, Ns, Nt, lMax, crossover);
+  py::gil_scoped_release release;
+
+  map<int, int> ZIndexMap = getZIndexMap(atomicNumbersGlobal, Nt);
+  int dim;
+  if (power) {
+    if (crossover) dim = Ns*Ns*(lMax+1)*getCrosNum(Nt);
+    else dim = getCrosNum(Ns)*(lMax+1)*Nt;
+  } else {
+    dim = Nt*Ns*(lMax+1)*(lMax+1);
+  }
+  if (power && channels != NULL) dim = nChannels;
+  vector<long> atomOff(nStructs+1, 0);
+  vector<long> centreOff(nStructs+1, 0);
+  for (int s = 0; s < nStructs; s++) {
+    atomOff[s+1] = atomOff[s] + nAtoms[s];
+    centreOff[s+1] = centreOff[s] + nCentres[s];
+  }
+
+#ifdef _OPENMP
+  if (nThreads < 1) nThreads = omp_get_max_threads();
+#else
+  nThreads = 1;
+#endif
+
+  // Structures are distributed over threads, each one writing its own rows,
+  // or with pooling its single row
+  #pragma omp parallel for num_threads(nThreads) schedule(dynamic, 1)
+  for (int s = 0; s < nStructs; s++) {
+    if (nCentres[s] == 0 || nAtoms[s] == 0) continue;
+    long row = (pooling != POOL_NONE) ? s : centreOff[s];
+    NeighbourList nl(Hpos + 3*centreOff[s], nCentres[s], pos + 3*atomOff[s], 
+      atomicNumbers + atomOff[s], nAtoms[s], rCut+cutoffPadding, 1);
+    if (single) soapGTOSystem((float*)cBuf.ptr + row*dim, nl,
+      alphas, betas, ZIndexMap,
+      rCut, cutoffPadding, Nt, Ns, lMax, eta, 
+      radialTable, radialNIn, radialNOut, channels, nChannels, crossover, power,
+      pooling, normalize, epsilon);
+    else soapGTOSystem((double*)cBuf.ptr + row*dim, nl,
+      alphas, betas, ZIndexMap,
+      rCut, cutoffPadding, Nt, Ns, lMax, eta, 
+      radialTable, radialNIn, radialNOut, channels, nChannels, crossover, power,
+      pooling, normalize, epsilon);
+  }
+}
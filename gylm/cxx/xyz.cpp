@@ -0,0 +1,246 @@
+#include "xyz.hpp"
+#include <stdexcept>
+#include <stdlib.h>
+#include <string.h>
+
+static inline bool is_blank(char c) {
+    return c == ' ' || c == '\t' || c == '\r';
+}
+
+// Decimal number at s, as strtod: Mantissas of up to 15 digits with
+// exponents within +-22 are exact doubles scaled by an exact power of ten,
+// hence correctly rounded (Clinger's fast path). Anything else (long
+// mantissas, large exponents, inf/nan, hex) is left to strtod.
+static double parse_double(const char *s, char **end) {
+    static const double pow10[] = {
+        1e0, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10, 1e11,
+        1e12, 1e13, 1e14, 1e15, 1e16, 1e17, 1e18, 1e19, 1e20, 1e21, 1e22 };
+    const char *p = s;
+    bool negative = false;
+    if (*p == '-' || *p == '+') negative = (*p++ == '-');
+    unsigned long long m = 0;
+    int n_digits = 0;
+    int exponent = 0;
+    const char *d0 = p;
+    while (*p >= '0' && *p <= '9') {
+        if (n_digits > 0 || *p != '0') n_digits++;
+        m = 10*m + (*p++ - '0');
+        if (n_digits > 15) return strtod(s, end);
+    }
+    bool has_digits = (p > d0);
+    if (*p == '.') {
+        p++;
+        const char *f0 = p;
+        while (*p >= '0' && *p <= '9') {
+            if (n_digits > 0 || *p != '0') n_digits++;
+            m = 10*m + (*p++ - '0');
+            exponent--;
+            if (n_digits > 15) return strtod(s, end);
+        }
+        has_digits = has_digits || (p > f0);
+    }
+    if (!has_digits) return strtod(s, end);
+    if (*p == 'e' || *p == 'E') {
+        const char *q = p+1;
+        bool negative_exp = false;
+        if (*q == '-' || *q == '+') negative_exp = (*q++ == '-');
+        if (!(*q >= '0' && *q <= '9')) return strtod(s, end);
+        int e = 0;
+        while (*q >= '0' && *q <= '9') {
+            if (e > 10000) return strtod(s, end);
+            e = 10*e + (*q++ - '0');
+        }
+        exponent += negative_exp ? -e : e;
+        p = q;
+    }
+    if (exponent < -22 || exponent > 22) return strtod(s, end);
+    *end = (char*) p;
+    double x = (double) m;
+    x = (exponent < 0) ? x/pow10[-exponent] : x*pow10[exponent];
+    return negative ? -x : x;
+}
+
+// End of the line starting at p (position of '\n', or len for the last
+// line of final input), -1 if the line is incomplete
+static long line_end(const char *data, long len, long p, bool final) {
+    const char *nl = (const char*) memchr(data+p, '\n', len-p);
+    if (nl != NULL) return nl - data;
+    return final ? len : -1;
+}
+
+static void parse_error(const char *what, long p) {
+    throw std::invalid_argument(string("Malformed xyz input (") + what
+        + ") at byte " + to_string(p));
+}
+
+// Atom count of the frame starting at p, with eol set to the end of the
+// count line. Returns -1 if the line is incomplete, -2 if it is blank
+// (or the final input has ended).
+static long read_count(const char *data, long len, long p, bool final, long &eol) {
+    eol = line_end(data, len, p, final);
+    if (eol < 0) return -1;
+    long q = p;
+    while (q < eol && is_blank(data[q])) q++;
+    if (q == eol) return (eol < len || final) ? -2 : -1;
+    char *end;
+    long n_atoms = strtol(data+q, &end, 10);
+    if (end == data+q || n_atoms < 0) parse_error("atom count", q);
+    for (q = end - data; q < eol && is_blank(data[q]); q++);
+    if (q != eol) parse_error("atom count", q);
+    if (eol == len) parse_error("missing header", eol);
+    return n_atoms;
+}
+
+void parse_xyz_block(const char *data, long len, bool final, XyzBlock &block) {
+    block.consumed = 0;
+    block.done = false;
+    block.offsets.assign(1, 0);
+    block.headers.clear();
+    block.names.clear();
+    block.symbols.clear();
+    block.positions.clear();
+    long p = 0;
+    while (true) {
+        long eol;
+        long n_atoms = read_count(data, len, p, final, eol);
+        if (n_atoms == -2) block.done = true;
+        if (n_atoms < 0) break;
+        // Header line
+        long h0 = eol+1;
+        long h1 = line_end(data, len, h0, final);
+        if (h1 < 0) break;
+        // Atom lines
+        long n_prev = block.symbols.size();
+        bool complete = true;
+        p = h1+1;
+        for (long i = 0; i < n_atoms; i++) {
+            if (p > len) parse_error("missing atoms", len);
+            eol = line_end(data, len, p, final);
+            if (eol < 0) {
+                complete = false;
+                break;
+            }
+            long q;
+            for (q = p; q < eol && is_blank(data[q]); q++);
+            long s0 = q;
+            while (q < eol && !is_blank(data[q])) q++;
+            if (q == s0) parse_error("missing symbol", s0);
+            // Few distinct symbols: linear search, most recent first
+            int k = (int) block.names.size()-1;
+            for (; k >= 0; k--) {
+                const string &name = block.names[k];
+                if ((long) name.size() == q-s0 && memcmp(name.data(), data+s0, q-s0) == 0) break;
+            }
+            if (k < 0) {
+                k = block.names.size();
+                block.names.emplace_back(data+s0, q-s0);
+            }
+            block.symbols.push_back(k);
+            for (int a = 0; a < 3; a++) {
+                while (q < eol && is_blank(data[q])) q++;
+                if (q == eol) parse_error("missing coordinate", q);
+                char *end;
+                double x = parse_double(data+q, &end);
+                if (end == data+q || end > data+eol) parse_error("coordinate", q);
+                block.positions.push_back(x);
+                q = end - data;
+            }
+            p = eol+1;
+        }
+        if (!complete) {
+            block.symbols.resize(n_prev);
+            block.positions.resize(3*n_prev);
+            break;
+        }
+        long hend = h1;
+        if (hend > h0 && data[hend-1] == '\r') hend--;
+        block.headers.emplace_back(data+h0, hend-h0);
+        block.offsets.push_back(block.symbols.size());
+        block.consumed = (p < len) ? p : len;
+        if (p >= len) {
+            block.done = final;
+            break;
+        }
+    }
+    if (final && !block.done) parse_error("incomplete frame", block.consumed);
+}
+
+void index_xyz_block(const char *data, long len, bool final,
+        vector<long> &starts, long &consumed, bool &done) {
+    starts.clear();
+    consumed = 0;
+    done = false;
+    long p = 0;
+    while (true) {
+        long eol;
+        long n_atoms = read_count(data, len, p, final, eol);
+        if (n_atoms == -2) done = true;
+        if (n_atoms < 0) break;
+        // Skip the header and atom lines
+        long q = eol+1;
+        long i = -1;
+        for (; i < n_atoms; i++) {
+            if (q > len) parse_error("missing atoms", len);
+            eol = line_end(data, len, q, final);
+            if (eol < 0) break;
+            q = eol+1;
+        }
+        if (i < n_atoms) break;
+        starts.push_back(p);
+        p = q;
+        consumed = (p < len) ? p : len;
+        if (p >= len) {
+            done = final;
+            break;
+        }
+    }
+    if (final && !done) parse_error("incomplete frame", consumed);
+}
+
+py::tuple parse_xyz(py::bytes buffer, bool final) {
+    char *data;
+    Py_ssize_t len;
+    if (PyBytes_AsStringAndSize(buffer.ptr(), &data, &len) != 0) {
+        throw py::error_already_set();
+    }
+    XyzBlock block;
+    {
+        py::gil_scoped_release release;
+        parse_xyz_block(data, len, final, block);
+    }
+    // Symbols are shared str objects
+    vector<py::str> names(block.names.begin(), block.names.end());
+    py::list symbols(block.symbols.size());
+    for (long i = 0; i < (long) block.symbols.size(); i++) {
+        symbols[i] = names[block.symbols[i]];
+    }
+    py::list headers;
+    for (auto &h : block.headers) headers.append(py::str(h));
+    py::array_t<long> offsets(block.offsets.size(), block.offsets.data());
+    py::array_t<double> positions({ (long) block.symbols.size(), 3L });
+    if (block.positions.size() > 0) {
+        memcpy(positions.mutable_data(), block.positions.data(),
+            block.positions.size()*sizeof(double));
+    }
+    py::list name_list;
+    for (auto &name : names) name_list.append(name);
+    py::array_t<int> ids(block.symbols.size(), block.symbols.data());
+    return py::make_tuple(block.consumed, block.done, offsets, headers, symbols, positions,
+        name_list, ids);
+}
+
+py::tuple index_xyz(py::bytes buffer, bool final) {
+    char *data;
+    Py_ssize_t len;
+    if (PyBytes_AsStringAndSize(buffer.ptr(), &data, &len) != 0) {
+        throw py::error_already_set();
+    }
+    vector<long> starts;
+    long consumed;
+    bool done;
+    {
+        py::gil_scoped_release release;
+        index_xyz_block(data, len, final, starts, consumed, done);
+    }
+    return py::make_tuple(consumed, done, py::array_t<long>(starts.size(), starts.data()));
+}
@@ -0,0 +1,42 @@
+#ifndef XYZ_H
+#define XYZ_H
+
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+#include <vector>
+#include <string>
+
+namespace py = pybind11;
+using namespace std;
+
+// Bulk parser for (extended) xyz text: frames of a count line, a header
+// line and one line per atom, of which the symbol and the three leading
+// coordinates are read (further columns are skipped). A blank count line
+// ends the input. Per frame, the header is kept as raw text.
+struct XyzBlock {
+    long consumed;              // bytes up to the end of the last full frame
+    bool done;                  // blank count line or end of final input
+    vector<long> offsets;       // atoms of frame f: [offsets[f], offsets[f+1])
+    vector<string> headers;
+    vector<string> names;       // distinct symbols
+    vector<int> symbols;        // per atom, index into names
+    vector<double> positions;   // (n_atoms,3)
+};
+
+// Parses the complete frames in data[0:len). Without final, a trailing
+// incomplete frame is left unparsed (see consumed), with final it is an
+// error. Malformed frames throw invalid_argument.
+void parse_xyz_block(const char *data, long len, bool final, XyzBlock &block);
+
+// Byte offsets of the complete frames in data[0:len), found by skipping
+// lines without parsing them, otherwise as parse_xyz_block
+void index_xyz_block(const char *data, long len, bool final,
+    vector<long> &starts, long &consumed, bool &done);
+
+// Returns (consumed, done, offsets, headers, symbols, positions, names, ids),
+// with symbols[i] == names[ids[i]]
+py::tuple parse_xyz(py::bytes buffer, bool final);
+// Returns (consumed, done, frame byte offsets)
+py::tuple index_xyz(py::bytes buffer, bool final);
+
+#endif
@@ -8,6 +8,7 @@
 #include <set>
 #include <iostream>
 #include "ylm.hpp"
+#include "dual.hpp"
 
 void _py_ylm(
         py::array_t<double> x_py, 
@@ -16,15 +17,21 @@ void _py_ylm(
         int n_pts,
         int lmax, 
         py::array_t<double> py_ylm_out) {
-    double *x = (double*) x_py.request().ptr;
-    double *y = (double*) y_py.request().ptr;
-    double *z = (double*) z_py.request().ptr;
-    double *ylm_out = (double*) py_ylm_out.request().ptr;
+    py::buffer_info x_buf = x_py.request();
+    py::buffer_info y_buf = y_py.request();
+    py::buffer_info z_buf = z_py.request();
+    py::buffer_info ylm_out_buf = py_ylm_out.request();
+    double *x = (double*) x_buf.ptr;
+    double *y = (double*) y_buf.ptr;
+    double *z = (double*) z_buf.ptr;
+    double *ylm_out = (double*) ylm_out_buf.ptr;
+    py::gil_scoped_release release;
     double *r = (double*) malloc(sizeof(double)*n_pts);
     for (int i=0; i<n_pts; ++i) {
         r[i] = sqrt(x[i]*x[i] + y[i]*y[i] + z[i]*z[i]);
     }
     evaluate_ylm(x, y, z, r, n_pts, lmax, ylm_out);
+    free(r);
 }
 
 // Unfortunately icc forbids math functions in constexpr
@@ -75,9 +82,10 @@ constexpr double pre7_f      = +1.32298033090e+00;  // constexpr double pre7_f =
 constexpr double pre7_g      = +3.53581366262e-01;  // constexpr double pre7_g = pre7_f/s_2/s_7;
 
 // Condon-Shortley phase, see https://en.wikipedia.org/wiki/Table_of_spherical_harmonics
-void evaluate_ylm(
-        double *x, double *y, double *z, double *r, 
-        int n_pts, int lmax, double *ylm_out) {
+template<typename T>
+void evaluate_ylm_t(
+        T *x, T *y, T *z, T *r, 
+        int n_pts, int lmax, T *ylm_out) {
     int dim = (lmax+1)*(lmax+1);
     for (int pt=0; pt<n_pts; ++pt) {
         int c = pt*dim;
@@ -86,58 +94,58 @@ void evaluate_ylm(
             for (int lm=1; lm<dim; ++lm) ylm_out[++c] = 0.;
             continue;
         }
-        double zr = z[pt]/r[pt];
-        double xr = x[pt]/r[pt];
-        double yr = y[pt]/r[pt];
+        T zr = z[pt]/r[pt];
+        T xr = x[pt]/r[pt];
+        T yr = y[pt]/r[pt];
         // Angular factors
         //   an = exp(-i*phi*n)*sin^n(theta) = anr + i*ani
         //   bn = exp(+i*phi*n)*sin^n(theta) = bnr + i*bni
         //   cn = cos^n(theta) = cnr + i*0
-        double a1r = xr;
-        double a1i = -yr;
-        double c1r = zr;
-        double b1r = xr;
-        double b1i = yr;
-        double a2r = a1r*a1r - a1i*a1i;
-        double a2i = 2*a1r*a1i;
-        double c2r = c1r*c1r;
-        double c2r_a = 3*c2r-1.;
-        double b2r = b1r*b1r - b1i*b1i;
-        double b2i = 2*b1r*b1i;
-        double a3r = a2r*a1r - a2i*a1i;
-        double a3i = a2r*a1i + a2i*a1r;
-        double c3r = c2r*c1r;
-        double c3r_a = 5*c2r-1.;
-        double c3r_b = 5*c3r-3*c1r;
-        double b3r = b2r*b1r - b2i*b1i;
-        double b3i = b2r*b1i + b2i*b1r;
-        double a4r = a2r*a2r - a2i*a2i;
-        double a4i = 2*a2r*a2i;
-        double c4r = c2r*c2r;
-        double c4r_0 = 35.*c4r - 30*c2r + 3.;
-        double c4r_1 = 7*c3r - 3*c1r;
-        double c4r_2 = 7*c2r - 1.;
-        double b4r = b2r*b2r - b2i*b2i;
-        double b4i = 2*b2r*b2i;
-        double a5r = a4r*a1r - a4i*a1i;
-        double a5i = a4r*a1i + a4i*a1r;
-        double c5r = c4r*c1r;
-        double c5r_0 = 63*c5r - 70*c3r + 15*c1r;
-        double c5r_1 = 21*c4r - 14*c2r + 1;
-        double c5r_2 = 3*c3r - c1r;
-        double c5r_3 = 9*c2r - 1;
-        double b5r = b4r*b1r - b4i*b1i;
-        double b5i = b4r*b1i + b4i*b1r;
-        double a6r = a3r*a3r - a3i*a3i;
-        double a6i = 2*a3r*a3i;
-        double c6r = c3r*c3r;
-        double c6r_0 = 231*c6r - 315*c4r + 105*c2r - 5;
-        double c6r_1 = 33*c5r - 30*c3r + 5*c1r;
-        double c6r_2 = 33*c4r - 18*c2r + 1;
-        double c6r_3 = 11*c3r - 3*c1r;
-        double c6r_4 = 11*c2r - 1;
-        double b6r = b3r*b3r - b3i*b3i;
-        double b6i = 2*b3r*b3i;
+        T a1r = xr;
+        T a1i = -yr;
+        T c1r = zr;
+        T b1r = xr;
+        T b1i = yr;
+        T a2r = a1r*a1r - a1i*a1i;
+        T a2i = 2*a1r*a1i;
+        T c2r = c1r*c1r;
+        T c2r_a = 3*c2r-1.;
+        T b2r = b1r*b1r - b1i*b1i;
+        T b2i = 2*b1r*b1i;
+        T a3r = a2r*a1r - a2i*a1i;
+        T a3i = a2r*a1i + a2i*a1r;
+        T c3r = c2r*c1r;
+        T c3r_a = 5*c2r-1.;
+        T c3r_b = 5*c3r-3*c1r;
+        T b3r = b2r*b1r - b2i*b1i;
+        T b3i = b2r*b1i + b2i*b1r;
+        T a4r = a2r*a2r - a2i*a2i;
+        T a4i = 2*a2r*a2i;
+        T c4r = c2r*c2r;
+        T c4r_0 = 35.*c4r - 30*c2r + 3.;
+        T c4r_1 = 7*c3r - 3*c1r;
+        T c4r_2 = 7*c2r - 1.;
+        T b4r = b2r*b2r - b2i*b2i;
+        T b4i = 2*b2r*b2i;
+        T a5r = a4r*a1r - a4i*a1i;
+        T a5i = a4r*a1i + a4i*a1r;
+        T c5r = c4r*c1r;
+        T c5r_0 = 63*c5r - 70*c3r + 15*c1r;
+        T c5r_1 = 21*c4r - 14*c2r + 1;
+        T c5r_2 = 3*c3r - c1r;
+        T c5r_3 = 9*c2r - 1;
+        T b5r = b4r*b1r - b4i*b1i;
+        T b5i = b4r*b1i + b4i*b1r;
+        T a6r = a3r*a3r - a3i*a3i;
+        T a6i = 2*a3r*a3i;
+        T c6r = c3r*c3r;
+        T c6r_0 = 231*c6r - 315*c4r + 105*c2r - 5;
+        T c6r_1 = 33*c5r - 30*c3r + 5*c1r;
+        T c6r_2 = 33*c4r - 18*c2r + 1;
+        T c6r_3 = 11*c3r - 3*c1r;
+        T c6r_4 = 11*c2r - 1;
+        T b6r = b3r*b3r - b3i*b3i;
+        T b6i = 2*b3r*b3i;
         if (lmax > 0) {
             ylm_out[++c] = -pre1_a* (a1i-b1i);        // +-
             ylm_out[++c] =  s_2*pre1*c1r;
@@ -193,17 +201,17 @@ void evaluate_ylm(
             ylm_out[++c] =  pre6_e* (a5r+b5r)*c1r;
             ylm_out[++c] =  pre6_f* (a6r+b6r);
         if (lmax > 6) {
-            double a7r = a4r*a3r - a4i*a3i;
-            double a7i = a4r*a3i + a4i*a3r;
-            double c7r = c4r*c3r;
-            double c7r_0 = 429*c7r - 693*c5r + 315*c3r - 35*c1r;
-            double c7r_1 = 429*c6r - 495*c4r + 135*c2r - 5;
-            double c7r_2 = 143*c5r - 110*c3r + 15*c1r;
-            double c7r_3 = 143*c4r - 66*c2r + 3;
-            double c7r_4 = 13*c3r - 3*c1r;
-            double c7r_5 = 13*c2r - 1;
-            double b7r = b4r*b3r - b4i*b3i;
-            double b7i = b4r*b3i + b4i*b3r;
+            T a7r = a4r*a3r - a4i*a3i;
+            T a7i = a4r*a3i + a4i*a3r;
+            T c7r = c4r*c3r;
+            T c7r_0 = 429*c7r - 693*c5r + 315*c3r - 35*c1r;
+            T c7r_1 = 429*c6r - 495*c4r + 135*c2r - 5;
+            T c7r_2 = 143*c5r - 110*c3r + 15*c1r;
+            T c7r_3 = 143*c4r - 66*c2r + 3;
+            T c7r_4 = 13*c3r - 3*c1r;
+            T c7r_5 = 13*c2r - 1;
+            T b7r = b4r*b3r - b4i*b3i;
+            T b7i = b4r*b3i + b4i*b3r;
             ylm_out[++c] = -pre7_g* (a7i-b7i);
             ylm_out[++c] = -pre7_f* (a6i-b6i)*c1r;
             ylm_out[++c] = -pre7_e* (a5i-b5i)*c7r_5;
@@ -223,3 +231,45 @@ void evaluate_ylm(
     }
 }
 
+void evaluate_ylm(
+        double *x, double *y, double *z, double *r, 
+        int n_pts, int lmax, double *ylm_out) {
+    evaluate_ylm_t<double>(x, y, z, r, n_pts, lmax, ylm_out);
+}
+
+void evaluate_ylm(
+        float *x, float *y, float *z, float *r, 
+        int n_pts, int lmax, float *ylm_out) {
+    evaluate_ylm_t<float>(x, y, z, r, n_pts, lmax, ylm_out);
+}
+
+void evaluate_ylm_grad(
+        double *x, double *y, double *z, double *r, 
+        int n_pts, int lmax, double *ylm_out, double *dylm_out) {
+    // Gradients with respect to (x,y,z) via dual numbers, layout of
+    // dylm_out is (n_pts, 3, (lmax+1)^2). At the origin they vanish.
+    int dim = (lmax+1)*(lmax+1);
+    vector<Dual3> xd(n_pts);
+    vector<Dual3> yd(n_pts);
+    vector<Dual3> zd(n_pts);
+    vector<Dual3> rd(n_pts);
+    vector<Dual3> ylm(n_pts*dim);
+    for (int pt=0; pt<n_pts; ++pt) {
+        xd[pt] = Dual3(x[pt], 1., 0., 0.);
+        yd[pt] = Dual3(y[pt], 0., 1., 0.);
+        zd[pt] = Dual3(z[pt], 0., 0., 1.);
+        if (r[pt] < radius_eps) rd[pt] = Dual3(r[pt]);
+        else rd[pt] = Dual3(r[pt], x[pt]/r[pt], y[pt]/r[pt], z[pt]/r[pt]);
+    }
+    evaluate_ylm_t<Dual3>(xd.data(), yd.data(), zd.data(), rd.data(), 
+        n_pts, lmax, ylm.data());
+    for (int pt=0; pt<n_pts; ++pt) {
+        for (int lm=0; lm<dim; ++lm) {
+            const Dual3 &y_lm = ylm[pt*dim+lm];
+            ylm_out[pt*dim+lm] = y_lm.v;
+            dylm_out[(3*pt+0)*dim+lm] = y_lm.d[0];
+            dylm_out[(3*pt+1)*dim+lm] = y_lm.d[1];
+            dylm_out[(3*pt+2)*dim+lm] = y_lm.d[2];
+        }
+    }
+}
@@ -18,4 +18,10 @@ void _py_ylm(
 void evaluate_ylm(double *x, double *y, double *z, double *r,
     int n_pts, int lmax, double *ylm_out);
 
+void evaluate_ylm(float *x, float *y, float *z, float *r,
+    int n_pts, int lmax, float *ylm_out);
+
+void evaluate_ylm_grad(double *x, double *y, double *z, double *r,
+    int n_pts, int lmax, double *ylm_out, double *dylm_out);
+
 #endif
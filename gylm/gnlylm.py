@@ -5,9 +5,7 @@ from scipy.linalg import sqrtm, inv
 from gylm._gylm import *
 from . import ptable
 from . import connectivity
-
-def eval_single(args):
-    return args["calc"].evaluate(**args)
+from .pool import DescriptorPool, stream
 
 class GylmCalculator(object):
     def __init__(
@@ -27,8 +25,15 @@ class GylmCalculator(object):
             periodic=False,
             normalize=False,
             power=True,
-            encoder=lambda s: ptable.lookup[s].z,
-            decoder=lambda z: ptable.lookup[int(z)].name):
+            n_threads=1,
+            radial_table=False,
+            radial_tol=1e-8,
+            channels=None,
+            pooling=None,
+            cache=None,
+            dtype=np.float64,
+            encoder=ptable.symbol_to_z,
+            decoder=ptable.z_to_symbol):
         self.types = types
         self.types_z = np.array(sorted([ encoder(s) for s in self.types ]))
         self.types_elem = np.array([ decoder(z) for z in self.types_z ])
@@ -50,9 +55,38 @@ class GylmCalculator(object):
         self.periodic = periodic
         self.normalize = normalize
         self.power = power
+        self.n_threads = n_threads
         self.epsilon = 1e-10
+        # Output precision: float32 runs the kernels in single precision
+        # (with double accumulation of the expansion coefficients)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("dtype must be float32 or float64")
+        # Optional subset of output columns (index list or boolean mask)
+        self.channels = self.setupChannels(channels)
+        # Structure-level output: None, "average" or "sum" over centres
+        self.pooling = pooling
+        self._pooling = self.setupPooling(pooling)
+        # Optional DescriptorCache for evaluate (see cache.py)
+        self.cache = cache
+        # Spline table for the weighted radial basis (empty = analytic)
+        self._radial_table = np.zeros((0,), dtype=np.float64)
+        self._radial_n_in = 0
+        if radial_table:
+            self._radial_table, self._radial_n_in = build_gylm_radial_table(
+                self._gnl_centres, self._gnl_alphas,
+                self._nmax, self._lmax,
+                self._rcut, self._rcut_width,
+                self.part_sigma,
+                self.wconstant,
+                self.wscale,
+                self.wcentre,
+                self.ldamp,
+                radial_tol)
     def getDim(self, with_power=None):
-        if with_power is None: with_power = self.power
+        if with_power is None:
+            if self.channels is not None: return len(self.channels)
+            with_power = self.power
         return self.getChannelDim(with_power)*self.getNumberOfChannels(with_power)
     def getChannelDim(self, with_power):
         if with_power:
@@ -61,77 +95,282 @@ class GylmCalculator(object):
             return self._nmax*(self._lmax+1)**2
     def getNumberOfChannels(self, with_power):
         if with_power:
-            return self._Nt*(self._Nt+1)/2
+            return self._Nt*(self._Nt+1)//2
         else:
             return self._Nt
     def getNumberofTypes(self):
         return len(self.types_z)
+    def setupChannels(self, channels):
+        if channels is None: return None
+        dim = self.getDim(self.power)
+        channels = np.asarray(channels)
+        if channels.dtype == bool:
+            if channels.shape != (dim,):
+                raise ValueError("Channel mask must have length %d" % dim)
+            channels = np.where(channels)[0]
+        channels = channels.astype(np.int32).flatten()
+        if np.any(channels < 0) or np.any(channels >= dim):
+            raise ValueError("Channel indices must lie within [0, %d)" % dim)
+        return np.ascontiguousarray(channels)
+    def setupPooling(self, pooling):
+        modes = { None: POOL_NONE, "sum": POOL_SUM, "average": POOL_AVERAGE }
+        if pooling not in modes:
+            raise ValueError("Pooling must be None, 'average' or 'sum'")
+        return modes[pooling]
+    def getPoolingArg(self):
+        # The engine pools the (normalized) rows as they are produced, except
+        # for the expansion coefficients with channels, which are normalized
+        # only after subselection
+        if self.channels is not None and not self.power and self.normalize:
+            return POOL_NONE
+        return self._pooling
+    def poolRows(self, X):
+        if self._pooling == POOL_SUM:
+            return np.sum(X, axis=0, keepdims=True)
+        elif self._pooling == POOL_AVERAGE:
+            return np.mean(X, axis=0, keepdims=True)
+        return X
+    def getChannelsArg(self):
+        # Channels are selected inside the power-spectrum contraction,
+        # the (cheap) expansion coefficients are subselected afterwards
+        if self.channels is None or not self.power:
+            return np.zeros((0,), dtype=np.int32)
+        return self.channels
     def evaluate_mp(self, systems, positions=None,
-            power=True,
-            normalize=True,
+            power=None,
+            normalize=None,
             verbose=False,
             procs=1):
-        args = [ {
-            "calc": self,
-            "system": systems[i],
-            "positions": positions[i] if positions != None else None,
-            "power": power,
-            "normalize": normalize,
-            "verbose": verbose } \
-            for i in range(len(systems)) ]
-        pool = mp.Pool(processes=procs)
-        X_list = pool.map(eval_single, args)
-        pool.close()
+        # Power and normalize are those of the calculator, the arguments are
+        # only accepted if they agree with it
+        if power is not None and power != self.power:
+            raise ValueError("power=%s differs from the calculator setting" % power)
+        if normalize is not None and normalize != self.normalize:
+            raise ValueError("normalize=%s differs from the calculator setting" % normalize)
+        if verbose:
+            raise ValueError("verbose is not supported with worker processes")
+        with DescriptorPool(self, procs=procs) as pool:
+            X_list = pool.evaluate(systems, positions)
         return X_list
+    def evaluate_stream(self, frames, procs=1, chunksize=64):
+        # Yields (frame_index, X) for frames or an xyz file (see pool.stream)
+        return stream(self, frames, procs=procs, chunksize=chunksize)
+    def getCutoff(self):
+        # Minimum cutoff of a neighbour list passed to evaluate
+        return self._rcut
     def evaluate(self, system, positions=None,
             verbose=False,
-            calc=None):
+            calc=None,
+            neighbours=None):
+        # With a prebuilt NeighbourList (see connectivity.get_neighbour_list),
+        # its centres replace the positions and no cell search takes place.
+        # With pooling, a single (1,dim) row is returned.
+        if self.cache is not None and neighbours is None:
+            return self.cache.evaluate(self, system, positions,
+                lambda: self.evaluateUncached(system, positions, verbose))
+        return self.evaluateUncached(system, positions, verbose, neighbours)
+    def evaluateUncached(self, system, positions=None, verbose=False, neighbours=None):
+        pooling = self.getPoolingArg()
+        if neighbours is not None:
+            X = self.evaluateGylmNeighbours(neighbours, power=self.power,
+                pooling=pooling)
+        else:
+            if positions is None:
+                positions = system.get_positions()
+            X = self.evaluateGylm(
+                system,
+                positions,
+                self._gnl_centres,
+                self._gnl_alphas,
+                rcut=self._rcut,
+                cutoff_padding=self._rcut_width,
+                nmax=self._nmax,
+                lmax=self._lmax,
+                eta=self._eta,
+                atomic_numbers=None,
+                power=self.power,
+                verbose=verbose,
+                pooling=pooling)
+        if pooling != POOL_NONE:
+            return X
+        if self.normalize:
+            z = 1./(np.sum(X**2, axis=1)+self.epsilon)**0.5
+            X = (X.T*z).T
+        return self.poolRows(X)
+    def evaluate_trajectory(self, frames, positions=None, skin=0.5):
+        # Yields the descriptors frame by frame, the neighbour search is
+        # redone only once atoms have moved by more than the skin in total
+        # (see connectivity.VerletList)
+        verlet = connectivity.VerletList(self.getCutoff(), skin, self.n_threads)
+        for i, frame in enumerate(frames):
+            nl = verlet.get(frame, positions[i] if positions is not None else None)
+            yield self.evaluate(frame, neighbours=nl)
+    def evaluate_with_gradients(self, system, positions=None,
+            centre_indices=None):
+        # Returns X, dX, pairs with dX[p,a,:] = dX[pairs[p,0],:]/dR[pairs[p,1],a].
+        # Centres given as atoms (default: all atoms) move with their atom,
+        # for explicit positions without centre_indices the centres are fixed.
         if positions is None:
-            positions = system.get_positions()
-        if np.any(system.pbc) and system.get_cell() is not None:
-            system = connectivity.pad_cell_to_cutoff(system, self._rcut)
-        X = self.evaluateGylm(
-            system,
-            positions,
-            self._gnl_centres,
-            self._gnl_alphas,
-            rcut=self._rcut,
-            cutoff_padding=self._rcut_width,
-            nmax=self._nmax,
-            lmax=self._lmax,
-            eta=self._eta,
-            atomic_numbers=None,
-            power=self.power,
-            verbose=verbose)
+            if centre_indices is None:
+                centre_indices = np.arange(len(system))
+            positions = system.get_positions()[np.asarray(centre_indices)]
+        cell, pbc = connectivity.get_cell_args(system)
+        tgt_pos, Z_sorted, _, _ = self.flattenPositions(system)
+        order = np.argsort(system.get_atomic_numbers(), kind="stable")
+        if not set(np.unique(Z_sorted)).issubset(self.types_set):
+            raise ValueError("Some types not recognized:", set(Z_sorted))
+        src_pos = np.ascontiguousarray(positions, dtype=np.float64).reshape((-1,3))
+        X = np.zeros((src_pos.shape[0], self.getDim(self.power)), dtype=np.float64)
+        dX, pair_src, pair_tgt = evaluate_gylm_grad(X, src_pos,
+            np.ascontiguousarray(tgt_pos, dtype=np.float64),
+            self._gnl_centres, self._gnl_alphas,
+            np.ascontiguousarray(Z_sorted, dtype=np.int32), self.types_z,
+            cell, pbc,
+            self._rcut, self._rcut_width,
+            src_pos.shape[0], tgt_pos.shape[0], self._Nt,
+            self._nmax, self._lmax,
+            self.part_sigma,
+            self.wconstant,
+            self.wscale,
+            self.wcentre,
+            self.ldamp,
+            self._radial_table,
+            self._radial_n_in,
+            self.power,
+            self.n_threads)
+        # Map type-sorted targets back to atoms
+        pair_tgt = order[pair_tgt]
+        if centre_indices is not None:
+            centre_indices = np.asarray(centre_indices)
+            pair_src = np.concatenate([ pair_src, np.arange(src_pos.shape[0]) ])
+            pair_tgt = np.concatenate([ pair_tgt, centre_indices ])
+            dX_centre = np.zeros((src_pos.shape[0], 3, dX.shape[2]))
+            np.add.at(dX_centre, pair_src[:dX.shape[0]], -dX)
+            dX = np.concatenate([ dX, dX_centre ])
+        # Merge contributions of periodic images and centres
+        pairs, inverse = np.unique(np.array([ pair_src, pair_tgt ]).T,
+            axis=0, return_inverse=True)
+        dX_merged = np.zeros((pairs.shape[0], 3, dX.shape[2]))
+        np.add.at(dX_merged, inverse.ravel(), dX)
+        dX = dX_merged
+        if self.channels is not None:
+            X = X[:,self.channels]
+            dX = dX[:,:,self.channels]
         if self.normalize:
             z = 1./(np.sum(X**2, axis=1)+self.epsilon)**0.5
+            Xp = X[pairs[:,0]]
+            zp = z[pairs[:,0]]
+            proj = np.einsum('pd,pad->pa', Xp, dX)
+            dX = zp[:,None,None]*dX \
+                - (Xp*zp[:,None]**3)[:,None,:]*proj[:,:,None]
             X = (X.T*z).T
-        return X
+        if self._pooling != POOL_NONE:
+            # Pooled row: Gradients with respect to each atom summed over centres
+            atoms, inverse = np.unique(pairs[:,1], return_inverse=True)
+            dX_pooled = np.zeros((atoms.shape[0], 3, dX.shape[2]))
+            np.add.at(dX_pooled, inverse.ravel(), dX)
+            if self._pooling == POOL_AVERAGE:
+                dX_pooled = dX_pooled/X.shape[0]
+            X = self.poolRows(X)
+            dX = dX_pooled
+            pairs = np.array([ np.zeros_like(atoms), atoms ]).T
+        # Gradients are always evaluated in double precision
+        return X.astype(self.dtype, copy=False), \
+            dX.astype(self.dtype, copy=False), pairs
+    def evaluate_batch(self, positions_packed, Z_packed, n_atoms_per_struct,
+            centres_packed=None,
+            n_centres_per_struct=None):
+        # Packed (non-periodic) structures are evaluated in a single call,
+        # threaded over structures. Without centres, all atoms are centres.
+        # Returns the stacked descriptors and the row offsets per structure.
+        positions_packed = np.ascontiguousarray(positions_packed, dtype=np.float64)
+        Z_packed = np.ascontiguousarray(Z_packed, dtype=np.int32)
+        n_atoms_per_struct = np.ascontiguousarray(n_atoms_per_struct, dtype=np.int32)
+        if centres_packed is None:
+            centres_packed = positions_packed
+            n_centres_per_struct = n_atoms_per_struct
+        centres_packed = np.ascontiguousarray(centres_packed, dtype=np.float64)
+        n_centres_per_struct = np.ascontiguousarray(n_centres_per_struct, dtype=np.int32)
+        if np.sum(n_atoms_per_struct) != Z_packed.shape[0] or \
+                np.sum(n_centres_per_struct) != centres_packed.shape[0]:
+            raise ValueError("Packed arrays inconsistent with counts per structure")
+        if not set(np.unique(Z_packed)).issubset(self.types_set):
+            raise ValueError("Some types not recognized:", set(np.unique(Z_packed)))
+        n_types = self._Nt
+        channels = self.getChannelsArg()
+        pooling = self.getPoolingArg()
+        n_rows = n_atoms_per_struct.shape[0] if pooling != POOL_NONE \
+            else centres_packed.shape[0]
+        dim = len(channels) if len(channels) > 0 else self.getDim(self.power)
+        X = np.zeros((n_rows, dim), dtype=self.dtype)
+        evaluate_gylm_batch(X, centres_packed, positions_packed,
+            self._gnl_centres, self._gnl_alphas, Z_packed, self.types_z,
+            n_centres_per_struct, n_atoms_per_struct,
+            self._rcut, self._rcut_width,
+            n_atoms_per_struct.shape[0], n_types,
+            self._nmax, self._lmax,
+            self.part_sigma,
+            self.wconstant,
+            self.wscale,
+            self.wcentre,
+            self.ldamp,
+            self._radial_table,
+            self._radial_n_in,
+            channels,
+            self.power,
+            self.n_threads,
+            pooling, self.normalize, self.epsilon)
+        if self.channels is not None and not self.power:
+            X = X[:,self.channels]
+        if pooling != POOL_NONE:
+            # Rows pooled (and normalized before) inside the engine
+            return X, np.arange(n_rows+1, dtype=np.int64)
+        if self.normalize:
+            z = 1./(np.sum(X**2, axis=1)+self.epsilon)**0.5
+            X = (X.T*z).T
+        offsets = np.zeros((n_centres_per_struct.shape[0]+1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(n_centres_per_struct)
+        if self._pooling != POOL_NONE:
+            X = np.concatenate([ self.poolRows(X[offsets[s]:offsets[s+1]]) \
+                for s in range(offsets.shape[0]-1) ])
+            offsets = np.arange(offsets.shape[0], dtype=np.int64)
+        return X, offsets
     def evaluateGylm(self, system, centers,
             gnl_centres, gnl_alphas,
             rcut, cutoff_padding,
             nmax, lmax, eta, atomic_numbers=None,
-            use_global_types=True, power=True, verbose=False):
+            use_global_types=True, power=True, verbose=False,
+            pooling=POOL_NONE):
+        # Pooled rows are normalized (if set) before they are added up
         n_tgt = len(system)
         n_src = len(centers)
+        n_rows = 1 if pooling != POOL_NONE else n_src
         positions, Z_sorted, n_types, atomtype_lst = self.flattenPositions(
             system, atomic_numbers)
-        if len(set(Z_sorted).union(self.types_set)) > len(self.types_set):
-            raise ValueError("Some types not recognized:", set(Z_sorted))
+        if not set(np.unique(Z_sorted)).issubset(self.types_set):
+            raise ValueError("Some types not recognized:", set(np.unique(Z_sorted)))
         centers = np.array(centers)
         n_centers = centers.shape[0]
         centers = centers.flatten()
         Z_sorted_global = self.types_z if use_global_types \
             else np.array(list(set(Z_sorted)))
         n_types = len(Z_sorted_global)
-        if power:
-            coeffs = np.zeros(nmax*nmax*(lmax+1)*int((n_types*(n_types + 1))/2)*n_src, dtype=np.float64)
-            shape = (n_centers, nmax*nmax*(lmax+1)*int((n_types*(n_types+1))/2))
+        use_channels = (self.channels is not None and power == self.power)
+        channels = self.getChannelsArg() if use_channels \
+            else np.zeros((0,), dtype=np.int32)
+        if power and len(channels) > 0:
+            coeffs = np.zeros(len(channels)*n_rows, dtype=self.dtype)
+            shape = (n_rows, len(channels))
+        elif power:
+            coeffs = np.zeros(nmax*nmax*(lmax+1)*int((n_types*(n_types + 1))/2)*n_rows, dtype=self.dtype)
+            shape = (n_rows, nmax*nmax*(lmax+1)*int((n_types*(n_types+1))/2))
         else:
-            coeffs = np.zeros(nmax*(lmax+1)*(lmax+1)*n_types*n_src, dtype=np.float64)
-            shape = (n_centers, nmax*(lmax+1)*(lmax+1)*n_types)
+            coeffs = np.zeros(nmax*(lmax+1)*(lmax+1)*n_types*n_rows, dtype=self.dtype)
+            shape = (n_rows, nmax*(lmax+1)*(lmax+1)*n_types)
+        cell, pbc = connectivity.get_cell_args(system)
         evaluate_gylm(coeffs, centers, positions,
             gnl_centres, gnl_alphas, Z_sorted, Z_sorted_global,
+            cell, pbc,
             rcut, cutoff_padding,
             n_src, n_tgt, n_types,
             nmax, lmax,
@@ -140,29 +379,63 @@ class GylmCalculator(object):
             self.wscale,
             self.wcentre,
             self.ldamp,
-            power, verbose)
+            self._radial_table,
+            self._radial_n_in,
+            channels,
+            power, verbose, self.n_threads,
+            pooling, self.normalize, self.epsilon)
         coeffs = coeffs.reshape(shape)
+        if use_channels and not power:
+            coeffs = coeffs[:,self.channels]
+        return coeffs
+    def evaluateGylmNeighbours(self, nl, power=True, pooling=POOL_NONE):
+        if nl.cutoff < self._rcut:
+            raise ValueError("Neighbour list cutoff %f smaller than rcut %f" % (
+                nl.cutoff, self._rcut))
+        n_src = nl.n_centres
+        n_rows = 1 if pooling != POOL_NONE else n_src
+        nmax, lmax, n_types = self._nmax, self._lmax, self._Nt
+        use_channels = (self.channels is not None and power == self.power)
+        channels = self.getChannelsArg() if use_channels \
+            else np.zeros((0,), dtype=np.int32)
+        if power and len(channels) > 0:
+            dim = len(channels)
+        elif power:
+            dim = nmax*nmax*(lmax+1)*int((n_types*(n_types+1))/2)
+        else:
+            dim = nmax*(lmax+1)*(lmax+1)*n_types
+        coeffs = np.zeros(dim*n_rows, dtype=self.dtype)
+        evaluate_gylm_neighbours(coeffs, nl,
+            self._gnl_centres, self._gnl_alphas, self.types_z,
+            self._rcut, self._rcut_width,
+            n_types, nmax, lmax,
+            self.part_sigma,
+            self.wconstant,
+            self.wscale,
+            self.wcentre,
+            self.ldamp,
+            self._radial_table,
+            self._radial_n_in,
+            channels,
+            power, self.n_threads,
+            pooling, self.normalize, self.epsilon)
+        coeffs = coeffs.reshape((n_rows, dim))
+        if use_channels and not power:
+            coeffs = coeffs[:,self.channels]
         return coeffs
     def flattenPositions(self, system, atomic_numbers=None):
-        Z = system.get_atomic_numbers()
-        pos = system.get_positions()
+        # Positions and atomic numbers grouped by type (ascending), in the
+        # original order within a type. Types default to those present.
+        Z = np.asarray(system.get_atomic_numbers())
+        pos = np.asarray(system.get_positions(), dtype=np.float64).reshape((-1,3))
+        order = np.argsort(Z, kind="stable")
         if atomic_numbers is not None:
-            atomtype_set = set(atomic_numbers)
+            atomtypes = np.unique(atomic_numbers)
+            order = order[np.isin(Z[order], atomtypes)]
         else:
-            atomtype_set = set(Z)
-        atomic_numbers_sorted = np.sort(list(atomtype_set))
-        pos_lst = []
-        z_lst = []
-        for atomtype in atomic_numbers_sorted:
-            condition = (Z == atomtype)
-            pos_onetype = pos[condition]
-            z_onetype = Z[condition]
-            pos_lst.append(pos_onetype)
-            z_lst.append(z_onetype)
-        n_types = len(atomic_numbers_sorted)
-        positions_sorted = np.concatenate(pos_lst, axis=0)
-        atomic_numbers_sorted = np.concatenate(z_lst).ravel()
-        return positions_sorted, atomic_numbers_sorted, n_types, atomic_numbers_sorted
+            atomtypes = np.unique(Z)
+        atomic_numbers_sorted = Z[order]
+        return pos[order], atomic_numbers_sorted, len(atomtypes), atomic_numbers_sorted
     def setupBasisGylm(self, rmin, rcut, sigma, nmax):
         centres = np.linspace(rmin, rcut, nmax);
         alphas = np.ones_like(centres)/(2.*sigma**2)
@@ -0,0 +1,135 @@
+import numpy as np
+import itertools
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from . import readwrite
+
+_worker_calc = None
+
+def _init_worker(calc):
+    global _worker_calc
+    _worker_calc = calc
+
+def _attach(shm_name):
+    # Workers only borrow the segment: It must not be registered with
+    # (and hence unlinked by) the resource tracker of the worker
+    try:
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+    except TypeError:
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=shm_name)
+    finally:
+        resource_tracker.register = register
+
+def _evaluate_task(task):
+    shm_name, shape, dtype, offset, system, positions = task
+    X = _worker_calc.evaluate(system, positions)
+    if X.shape[0] != shape[0] or X.shape[1] != shape[1]:
+        raise ValueError("Unexpected descriptor shape %s, expected %s" % (
+            str(X.shape), str(shape)))
+    shm = _attach(shm_name)
+    try:
+        dtype = np.dtype(dtype)
+        block = np.ndarray((shm.size//dtype.itemsize,), dtype=dtype, buffer=shm.buf)
+        block[offset:offset+X.size] = X.flatten()
+        del block
+    finally:
+        shm.close()
+    return offset
+
+class SharedBlock(object):
+    # Owns a shared-memory segment and exposes it via the array interface,
+    # such that arrays and views into it keep the segment mapped
+    def __init__(self, size, dtype=np.float64):
+        dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True,
+            size=max(8, dtype.itemsize*size))
+        tmp = np.frombuffer(self.shm.buf, dtype=np.uint8)
+        self.__array_interface__ = {
+            "shape": (size,),
+            "typestr": dtype.str,
+            "data": (tmp.ctypes.data, False),
+            "version": 3 }
+        del tmp
+    @property
+    def name(self):
+        return self.shm.name
+    def unlink(self):
+        self.shm.unlink()
+    def __del__(self):
+        self.shm.close()
+
+class DescriptorPool(object):
+    def __init__(self, calc, procs=1, start_method=None, chunksize=1):
+        # The calculator is shipped once per worker via the initializer
+        ctx = mp.get_context(start_method)
+        self.calc = calc
+        self.chunksize = chunksize
+        self.pool = ctx.Pool(
+            processes=procs,
+            initializer=_init_worker,
+            initargs=(calc,))
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+    def evaluate(self, systems, positions=None):
+        # Workers write into one preallocated shared block, the returned
+        # descriptor matrices are zero-copy views into that block
+        if self.pool is None:
+            raise RuntimeError("Pool has been closed")
+        dim = int(self.calc.getDim())
+        n_rows = [ len(positions[i]) if positions is not None else len(s) \
+            for i, s in enumerate(systems) ]
+        if getattr(self.calc, "pooling", None) is not None:
+            n_rows = [ 1 for s in systems ]
+        offsets = np.zeros((len(systems)+1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(n_rows)
+        dtype = np.dtype(getattr(self.calc, "dtype", np.float64))
+        block = SharedBlock(int(offsets[-1])*dim, dtype)
+        try:
+            tasks = [ (
+                block.name,
+                (n_rows[i], dim),
+                dtype.str,
+                int(offsets[i])*dim,
+                systems[i],
+                positions[i] if positions is not None else None) \
+                for i in range(len(systems)) ]
+            for _ in self.pool.imap_unordered(_evaluate_task, tasks,
+                    chunksize=self.chunksize):
+                pass
+        finally:
+            block.unlink()
+        X = np.asarray(block)
+        return [ X[offsets[i]*dim:offsets[i+1]*dim].reshape((n_rows[i], dim)) \
+            for i in range(len(systems)) ]
+
+def stream(calc, frames, procs=1, chunksize=64, start_method=None):
+    # Yields (frame_index, X) for an iterable of frames or an xyz file,
+    # which is read lazily. Frames are featurized in chunks of chunksize
+    # (in parallel over procs > 1 workers), such that memory stays bounded
+    # however many frames there are.
+    if isinstance(frames, str):
+        frames = readwrite.iread(frames)
+    frames = iter(frames)
+    if procs <= 1:
+        for fidx, frame in enumerate(frames):
+            yield fidx, calc.evaluate(frame)
+        return
+    with DescriptorPool(calc, procs=procs, start_method=start_method) as pool:
+        offset = 0
+        while True:
+            chunk = list(itertools.islice(frames, chunksize))
+            if len(chunk) == 0: break
+            for i, X in enumerate(pool.evaluate(chunk)):
+                yield offset + i, X
+            offset += len(chunk)
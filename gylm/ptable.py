@@ -1,3 +1,5 @@
+import numpy as np
+
 
 class PeriodicTable(object):
     element_elneg = [ 0.0, 
@@ -108,3 +110,15 @@ class AtomicElement(object):
 
 lookup = PeriodicTable().setup()
 
+def symbol_to_z(symbol):
+    return lookup[symbol].z
+
+def z_to_symbol(z):
+    return lookup[int(z)].name
+
+def symbols_to_z(symbols):
+    # Atomic numbers (int32) of a sequence of symbols, with one table lookup
+    # per distinct symbol
+    names, inverse = np.unique(np.asarray(symbols, dtype=str), return_inverse=True)
+    z = np.array([ lookup[str(name)].z for name in names ], dtype=np.int32)
+    return z[inverse.reshape((-1,))]
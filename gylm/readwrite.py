@@ -2,8 +2,11 @@
 import numpy as np
 import json
 import os
+import re
+import multiprocessing as mp
 from . import ptable
 from .logger import log, Mock
+from ._gylm import parse_xyz, index_xyz
 try:
     import ase.io
 except ImportError:
@@ -11,23 +14,51 @@ except ImportError:
     ase.io = None
 
 class ExtendedXyz(object):
-    def __init__(self):
-        self.info = {}
+    # Frame with contiguous (n,3) float64 positions and a list of symbols,
+    # the int32 atomic numbers are cached until the symbols are assigned or
+    # handed out (and thus may be edited in place)
+    __slots__ = ("info", "cell", "pbc", "_positions", "_symbols", "_numbers")
+    def __init__(self, positions=None, symbols=None, cell=None, info=None):
+        self.info = {} if info is None else info
         self.cell = None
         self.pbc = np.array([False, False, False])
-        self.atoms = []
-        self.positions = []
-        self.symbols = []
+        self.positions = [] if positions is None else positions
+        self.symbols = [] if symbols is None else symbols
+        if cell is not None:
+            self.cell = np.asarray(cell, dtype=np.float64).reshape((3,3))
+            self.set_pbc()
+    @property
+    def positions(self):
+        return self._positions
+    @positions.setter
+    def positions(self, positions):
+        self._positions = np.ascontiguousarray(positions, dtype=np.float64).reshape((-1,3))
+    @property
+    def symbols(self):
+        self._numbers = None
+        return self._symbols
+    @symbols.setter
+    def symbols(self, symbols):
+        self._symbols = list(symbols) if isinstance(symbols, list) \
+            else [ str(s) for s in symbols ]
+        self._numbers = None
+    def __getstate__(self):
+        return { key: getattr(self, key) for key in self.__slots__ }
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
     def __len__(self):
-        return len(self.symbols)
-    def set_pbc(self, booleans):
+        return len(self._symbols)
+    def set_pbc(self, booleans=(True, True, True)):
         self.pbc = np.array(booleans)
     def get_positions(self):
-        return self.positions
+        return self._positions
     def get_chemical_symbols(self):
         return self.symbols
     def get_atomic_numbers(self):
-        return np.array([ ptable.lookup[s].z for s in self.get_chemical_symbols() ])
+        if self._numbers is None:
+            self._numbers = ptable.symbols_to_z(self._symbols)
+        return self._numbers
     def get_cell(self):
         if self.cell is None and "Lattice" in self.info:
             self.cell = np.array(list(
@@ -49,7 +80,7 @@ class ExtendedXyz(object):
         nkl = np.ceil(r_cut/proj).astype('int')
         # Replicate
         n_atoms = len(self)
-        n_images = np.product(2*nkl + 1) 
+        n_images = np.prod(2*nkl + 1) 
         positions_padded = np.tile(self.positions, (n_images, 1))
         offset = 0
         for i in np.append(np.arange(0, nkl[0]+1), np.arange(-nkl[0], 0)):
@@ -65,110 +96,189 @@ class ExtendedXyz(object):
             cell=nkl*cell)
         return config_padded
     def create(self, n_atoms, fs):
-        # Parse header: key1="str1" key2=123 key3="another value" ...
-        header = fs.readline().replace("\n", "")
-        tokens = []
-        pos0 = 0
-        pos1 = 0
-        status = "<"
-        quotcount = 0
-        while pos1 < len(header):
-            status_out = status
-            # On the lhs of the key-value pair?
-            if status == "<":
-                if header[pos1] == "=":
-                    tokens.append(header[pos0:pos1])
-                    pos0 = pos1+1
-                    pos1 = pos1+1
-                    status_out = ">"
-                    quotcount = 0
-                else:
-                    pos1 += 1
-            # On the rhs of the key-value pair?
-            elif status == ">":
-                if header[pos1-1:pos1] == '"':
-                    quotcount += 1
-                if quotcount == 0 and header[pos1] == ' ':
-                    quotcount = 2
-                if quotcount <= 1:
-                    pos1 += 1
-                elif quotcount == 2:
-                    tokens.append(header[pos0:pos1])
-                    pos0 = pos1+1
-                    pos1 = pos1+1
-                    status_out = ""
-                    quotcount = 0
-                else:
-                    assert False
-            # In between key-value pairs?
-            elif status == "":
-                if header[pos1] == ' ':
-                    pos0 += 1
-                    pos1 += 1
-                else:
-                    status_out = "<"
-            else:
-                assert False
-            status = status_out
-        kvs = []
-        for i in range(len(tokens)//2):
-            kvs.append([tokens[2*i], tokens[2*i+1]])
-        # Process key-value pairs
-        for kv in kvs:
-            key = kv[0]
-            value = '='.join(kv[1:])
-            value = value.replace('"','').replace('\'','')
-            # Float?
-            if '.' in value:
-                try:
-                    value = float(value)
-                except: pass
-            else:
-                # Int?
-                try:
-                    value = int(value)
-                except: pass
-            self.info[kv[0]] = value
-        # Read atoms
-        self.positions = []
-        self.symbols = []
-        for i in range(n_atoms):
-            new_atom = self.create_atom(fs.readline())
-            self.positions.append(new_atom.pos)
-            self.symbols.append(new_atom.name)
-        self.positions = np.array(self.positions)
+        # Reads the header and atom lines of a frame from a text stream
+        lines = [ "%d\n" % n_atoms ] + [ fs.readline() for i in range(n_atoms+1) ]
+        config = next(make_frames(parse_xyz("".join(lines).encode(), True)))
+        self.info.update(config.info)
+        self.positions = config.positions
+        self._symbols = config._symbols
+        self._numbers = config._numbers
+
+# key=value, key="value with spaces"
+HEADER_PAIR = re.compile(r'\s*([^=]*)=("[^"]*"|[^ ]*)')
+# Bytes read per call of the bulk parser
+CHUNK_BYTES = 1<<24
+
+def parse_header(header):
+    info = {}
+    for key, value in HEADER_PAIR.findall(header.rstrip("\r\n")):
+        value = value.replace('"','').replace('\'','')
+        # Float?
+        if '.' in value:
+            try:
+                value = float(value)
+            except: pass
+        else:
+            # Int?
+            try:
+                value = int(value)
+            except: pass
+        info[key] = value
+    return info
+
+def make_frames(parsed):
+    # ExtendedXyz frames from the output of parse_xyz
+    consumed, done, offsets, headers, symbols, positions, names, ids = parsed
+    # Atomic numbers via the distinct symbols, unknown symbols only fail
+    # once the numbers are asked for
+    try:
+        numbers = ptable.symbols_to_z(names)[ids]
+    except KeyError:
+        numbers = None
+    for f, header in enumerate(headers):
+        config = ExtendedXyz()
+        config.info = parse_header(header)
+        config.positions = np.copy(positions[offsets[f]:offsets[f+1]])
+        config.symbols = symbols[offsets[f]:offsets[f+1]]
+        if numbers is not None:
+            config._numbers = np.copy(numbers[offsets[f]:offsets[f+1]])
+        yield config
+
+def iread_frames(ifs, chunk_bytes=CHUNK_BYTES):
+    # Frames of a binary stream, parsed natively chunk by chunk
+    buffer = b""
+    while True:
+        chunk = ifs.read(chunk_bytes)
+        final = (len(chunk) == 0)
+        buffer = buffer + chunk if len(buffer) > 0 else chunk
+        parsed = parse_xyz(buffer, final)
+        for config in make_frames(parsed):
+            yield config
+        consumed, done = parsed[0:2]
+        if done: break
+        buffer = buffer[consumed:]
+
+def build_index(config_file, chunk_bytes=CHUNK_BYTES):
+    # Byte offsets of the frames, from a scan over line ends only
+    starts = []
+    base = 0
+    buffer = b""
+    with open(config_file, 'rb') as ifs:
+        while True:
+            chunk = ifs.read(chunk_bytes)
+            final = (len(chunk) == 0)
+            buffer = buffer + chunk if len(buffer) > 0 else chunk
+            consumed, done, s = index_xyz(buffer, final)
+            starts.append(s + base)
+            base += consumed
+            if done: break
+            buffer = buffer[consumed:]
+    starts.append(np.array([ base ], dtype=np.int64))
+    return np.concatenate(starts).astype(np.int64)
+
+def get_index(config_file, rebuild=False):
+    # Byte offsets of the (n_frames+1) frame boundaries of an xyz file. The
+    # index is kept next to the file as <config_file>.idx.npz and rebuilt
+    # once the file has changed (size or mtime).
+    st = os.stat(config_file)
+    path = config_file + ".idx.npz"
+    if not rebuild:
+        try:
+            with np.load(path) as idx:
+                if int(idx["size"]) == st.st_size and int(idx["mtime_ns"]) == st.st_mtime_ns:
+                    return idx["offsets"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    offsets = build_index(config_file)
+    # Read-only locations simply go without a persistent index
+    try:
+        tmp = path + ".%d.tmp" % os.getpid()
+        with open(tmp, 'wb') as ofs:
+            np.savez(ofs, offsets=offsets, size=st.st_size, mtime_ns=st.st_mtime_ns)
+        os.replace(tmp, path)
+    except (IOError, OSError):
+        pass
+    return offsets
+
+def is_single_frame(index):
+    return isinstance(index, (int, np.integer)) \
+        or (isinstance(index, str) and ':' not in index)
+
+def select_frames(index, n_frames):
+    # Frame indices for index as in ase.io.read (int, slice, "i" or
+    # "start:stop:step") or a list of ints
+    if index is None:
+        index = ':'
+    if isinstance(index, str):
+        if ':' in index:
+            index = slice(*[ int(i) if i != '' else None for i in index.split(':') ])
+        else:
+            index = int(index)
+    if isinstance(index, slice):
+        return np.arange(n_frames)[index]
+    indices = np.array(index, dtype=np.int64).reshape((-1,))
+    indices = np.where(indices < 0, indices + n_frames, indices)
+    if np.any(indices < 0) or np.any(indices >= n_frames):
+        raise IndexError("Frame index out of range for %d frames" % n_frames)
+    return indices
+
+def iread_ranges(config_file, starts, ends, chunk_bytes=CHUNK_BYTES):
+    # Frames of the byte ranges [starts[k], ends[k]), adjacent ranges are
+    # read and parsed in blocks of up to chunk_bytes
+    with open(config_file, 'rb') as ifs:
+        k = 0
+        while k < len(starts):
+            l = k+1
+            while l < len(starts) and starts[l] == ends[l-1] \
+                    and ends[l] - starts[k] <= chunk_bytes:
+                l += 1
+            ifs.seek(starts[k])
+            for config in make_frames(parse_xyz(ifs.read(ends[l-1] - starts[k]), True)):
+                yield config
+            k = l
+
+def _read_ranges_task(args):
+    return list(iread_ranges(*args))
+
+def iread(
+        config_file,
+        index=':'):
+    # Yields one frame at a time, without holding the file in memory. Other
+    # than all frames, the index selects frames via the byte offsets of
+    # get_index and only those are read.
+    if ase.io is not None:
+        for config in ase.io.iread(config_file, index):
+            yield config
         return
-    def create_atom(self, ln):
-        ln = ln.split()
-        name = ln[0]
-        pos = list(map(float, ln[1:4]))
-        pos = np.array(pos)
-        new_atom = ExtendedXyzAtom(name, pos)
-        self.atoms.append(new_atom)
-        return new_atom
-
-class ExtendedXyzAtom(object):
-    def __init__(self, name, pos):
-        self.name = name
-        self.pos = pos
+    if index is None or (isinstance(index, str) and index == ':'):
+        with open(config_file, 'rb') as ifs:
+            for config in iread_frames(ifs):
+                yield config
+        return
+    offsets = get_index(config_file)
+    indices = select_frames(index, len(offsets)-1)
+    for config in iread_ranges(config_file, offsets[indices], offsets[indices+1]):
+        yield config
 
 def read(
         config_file,
-        index=':'):
+        index=':',
+        procs=1):
+    # With procs > 1, the selected frames are split into contiguous parts
+    # that worker processes parse from their byte ranges
     if ase.io is not None: 
         return ase.io.read(config_file, index)
-    configs = []
-    ifs = open(config_file, 'r')
-    while True:
-        header = ifs.readline().split()
-        if header != []:
-            assert len(header) == 1
-            n_atoms = int(header[0])
-            config = ExtendedXyz()
-            config.create(n_atoms, ifs)
-            configs.append(config)
-        else: break
-    return configs
+    if procs <= 1:
+        configs = list(iread(config_file, index))
+        return configs[0] if is_single_frame(index) else configs
+    offsets = get_index(config_file)
+    indices = select_frames(index, len(offsets)-1)
+    tasks = [ (config_file, offsets[part], offsets[part+1]) \
+        for part in np.array_split(indices, procs) if len(part) > 0 ]
+    with mp.get_context().Pool(processes=procs) as pool:
+        configs = [ config for part in pool.map(_read_ranges_task, tasks) \
+            for config in part ]
+    return configs[0] if is_single_frame(index) else configs
 
 def write(
         config_file,
@@ -197,3 +307,141 @@ def write(
     ofs.close()
     return
 
+
+# Binary datasets: A directory of raw columns over all frames,
+#   positions.bin  float64 (n_atoms,3)
+#   numbers.bin    int32 (n_atoms,) atomic numbers
+#   offsets.bin    int64 (n_frames+1,) atoms of frame f: [offsets[f], offsets[f+1])
+#   cells.bin      float64 (n_frames,3,3), zero without a cell
+#   pbc.bin        bool (n_frames,3)
+#   info.jsonl     info dict per frame, one JSON line each
+#   meta.json      format, n_frames and n_atoms, written last
+BINARY_COLUMNS = [
+    ("positions", np.float64, (3,)),
+    ("numbers", np.int32, ()),
+    ("offsets", np.int64, ()),
+    ("cells", np.float64, (3,3)),
+    ("pbc", bool, (3,)) ]
+
+def json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot store info value of type %s" % type(value).__name__)
+
+def write_binary(path, configs):
+    # Frames (e.g. a list or iread) as a binary dataset, positions at full
+    # precision
+    if not isinstance(configs, list) and hasattr(configs, "get_positions"):
+        configs = [ configs ]
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        os.remove(os.path.join(path, "meta.json"))
+    ofs = { name: open(os.path.join(path, name + ".bin"), 'wb') \
+        for name, _, _ in BINARY_COLUMNS }
+    n_frames = 0
+    n_atoms = 0
+    try:
+        with open(os.path.join(path, "info.jsonl"), 'w') as info_ofs:
+            ofs["offsets"].write(np.zeros((1,), dtype=np.int64).tobytes())
+            for config in configs:
+                positions = np.asarray(config.get_positions(), dtype=np.float64).reshape((-1,3))
+                cell = config.get_cell()
+                cell = np.zeros((3,3)) if cell is None else np.asarray(cell, dtype=np.float64)
+                n_frames += 1
+                n_atoms += positions.shape[0]
+                ofs["positions"].write(positions.tobytes())
+                ofs["numbers"].write(np.asarray(config.get_atomic_numbers(), dtype=np.int32).tobytes())
+                ofs["offsets"].write(np.array([ n_atoms ], dtype=np.int64).tobytes())
+                ofs["cells"].write(cell.reshape((3,3)).tobytes())
+                ofs["pbc"].write(np.asarray(config.pbc, dtype=bool).reshape((3,)).tobytes())
+                info_ofs.write(json.dumps(config.info, default=json_default) + "\n")
+    finally:
+        for f in ofs.values(): f.close()
+    with open(os.path.join(path, "meta.json"), 'w') as meta_ofs:
+        json.dump({ "format": "gylm-binary", "version": 1,
+            "n_frames": n_frames, "n_atoms": n_atoms }, meta_ofs)
+
+class BinaryFrame(object):
+    # Lightweight frame of a BinaryDataset, with read-only views into the
+    # memory-mapped columns. Pickles as (dataset path, frame index).
+    def __init__(self, dataset, index):
+        self.dataset = dataset
+        self.index = index
+        self.positions = dataset.positions[dataset.offsets[index]:dataset.offsets[index+1]]
+        self.pbc = dataset.pbc[index]
+    def __reduce__(self):
+        return (BinaryFrame, (self.dataset, self.index))
+    def __len__(self):
+        return self.positions.shape[0]
+    @property
+    def info(self):
+        return self.dataset.getInfo(self.index)
+    @property
+    def symbols(self):
+        return self.get_chemical_symbols()
+    def get_positions(self):
+        return self.positions
+    def get_atomic_numbers(self):
+        d = self.dataset
+        return d.numbers[d.offsets[self.index]:d.offsets[self.index+1]]
+    def get_chemical_symbols(self):
+        return [ ptable.z_to_symbol(z) for z in self.get_atomic_numbers() ]
+    def get_cell(self):
+        if not np.any(self.pbc): return None
+        return self.dataset.cells[self.index]
+
+class BinaryDataset(object):
+    # Frames of a binary dataset (see write_binary), memory-mapped such that
+    # processes reading the same dataset share one page-cached copy. Pickles
+    # as its path, hence workers map the files themselves.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as ifs:
+            self.meta = json.load(ifs)
+        sizes = {
+            "positions": self.meta["n_atoms"],
+            "numbers": self.meta["n_atoms"],
+            "offsets": self.meta["n_frames"]+1,
+            "cells": self.meta["n_frames"],
+            "pbc": self.meta["n_frames"] }
+        for name, dtype, shape in BINARY_COLUMNS:
+            shape = (sizes[name],) + shape
+            if sizes[name] == 0:
+                column = np.zeros(shape, dtype=dtype)
+            else:
+                column = np.memmap(os.path.join(path, name + ".bin"),
+                    dtype=dtype, mode='r', shape=shape)
+            setattr(self, name, column)
+        self.info_lines = None
+    def __reduce__(self):
+        return (open_binary, (self.path,))
+    def __len__(self):
+        return self.meta["n_frames"]
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0: index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Frame index out of range for %d frames" % len(self))
+            return BinaryFrame(self, index)
+        return [ BinaryFrame(self, i) for i in select_frames(index, len(self)) ]
+    def __iter__(self):
+        for i in range(len(self)):
+            yield BinaryFrame(self, i)
+    def getInfo(self, index):
+        if self.info_lines is None:
+            with open(os.path.join(self.path, "info.jsonl")) as ifs:
+                self.info_lines = ifs.readlines()
+        return json.loads(self.info_lines[index])
+
+_binary_datasets = {}
+
+def open_binary(path):
+    # Datasets are mapped once per process (and path)
+    path = os.path.abspath(path)
+    stamp = os.stat(os.path.join(path, "meta.json")).st_mtime_ns
+    if path not in _binary_datasets or _binary_datasets[path][0] != stamp:
+        _binary_datasets[path] = (stamp, BinaryDataset(path))
+    return _binary_datasets[path][1]
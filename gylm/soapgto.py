@@ -22,6 +22,7 @@ from scipy.linalg import sqrtm, inv
 from gylm._gylm import *
 from . import ptable
 from . import connectivity
+from .pool import stream
 
 class SoapGtoCalculator(object):
     def __init__(
@@ -36,9 +37,16 @@ class SoapGtoCalculator(object):
             sparse=False,
             normalize=False,
             crossover=True,
-            encoder=lambda s: ptable.lookup[s].z,
-            decoder=lambda z: ptable.lookup[int(z)].name,
-            power=True):
+            encoder=ptable.symbol_to_z,
+            decoder=ptable.z_to_symbol,
+            power=True,
+            n_threads=1,
+            radial_table=False,
+            radial_tol=1e-8,
+            channels=None,
+            pooling=None,
+            cache=None,
+            dtype=np.float64):
         self.types = types
         self.types_z = np.array(sorted([ encoder(s) for s in self.types ]))
         self.types_elem = np.array([ decoder(z) for z in self.types_z ])
@@ -54,42 +62,214 @@ class SoapGtoCalculator(object):
         self._normalize = normalize
         self._crossover = crossover
         self.power = power
+        self.n_threads = n_threads
+        # Output precision: float32 runs the kernels in single precision
+        # (with double accumulation of the expansion coefficients)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("dtype must be float32 or float64")
+        # Optional subset of output columns (index list or boolean mask)
+        self.channels = self.setupChannels(channels)
+        # Structure-level output: None, "average" or "sum" over centres,
+        # average=True is short for pooling="average"
+        if average and pooling is None:
+            pooling = "average"
+        self.pooling = pooling
+        self._pooling = self.setupPooling(pooling)
+        # Optional DescriptorCache for evaluate (see cache.py)
+        self.cache = cache
+        # Spline table for the radial gaussians (empty = analytic)
+        self._radial_table = np.zeros((0,), dtype=np.float64)
+        self._radial_n_in = 0
+        if radial_table:
+            threshold = 0.001
+            cutoff_padding = self._sigma*np.sqrt(-2*np.log(threshold))
+            self._radial_table, self._radial_n_in = build_soapgto_radial_table(
+                self._alphas.flatten(), self._betas.flatten(),
+                self._rcut, cutoff_padding,
+                self._nmax, self._lmax, self._eta,
+                radial_tol)
     def getDim(self):
+        if self.channels is not None: return len(self.channels)
         return self.getChannelDim()*self.getNumberOfChannels()
     def getChannelDim(self):
-        return self._nmax*(self._nmax+1)/2*(self._lmax+1)
+        if not self.power:
+            return self._nmax*(self._lmax+1)**2
+        elif self._crossover:
+            return self._nmax*self._nmax*(self._lmax+1)
+        else:
+            return self._nmax*(self._nmax+1)//2*(self._lmax+1)
     def getNumberOfChannels(self):
-        return self._Nt*(self._Nt+1)/2
+        if self.power and self._crossover:
+            return self._Nt*(self._Nt+1)//2
+        else:
+            return self._Nt
     def getNumberofTypes(self):
         return len(self.types_z)
-    def evaluate(self, system, positions=None):
-        if positions is None:
-            positions = system.get_positions()
+    def setupChannels(self, channels):
+        if channels is None: return None
+        dim = self.getChannelDim()*self.getNumberOfChannels()
+        channels = np.asarray(channels)
+        if channels.dtype == bool:
+            if channels.shape != (dim,):
+                raise ValueError("Channel mask must have length %d" % dim)
+            channels = np.where(channels)[0]
+        channels = channels.astype(np.int32).flatten()
+        if np.any(channels < 0) or np.any(channels >= dim):
+            raise ValueError("Channel indices must lie within [0, %d)" % dim)
+        return np.ascontiguousarray(channels)
+    def setupPooling(self, pooling):
+        modes = { None: POOL_NONE, "sum": POOL_SUM, "average": POOL_AVERAGE }
+        if pooling not in modes:
+            raise ValueError("Pooling must be None, 'average' or 'sum'")
+        return modes[pooling]
+    def getPoolingArg(self):
+        # The engine pools power-spectrum rows only
+        if not self.power:
+            return POOL_NONE
+        return self._pooling
+    def poolRows(self, X):
+        if self._pooling == POOL_SUM:
+            return np.sum(X, axis=0, keepdims=True)
+        elif self._pooling == POOL_AVERAGE:
+            return np.mean(X, axis=0, keepdims=True)
+        return X
+    def getChannelsArg(self):
+        # Channels are selected inside the power-spectrum contraction,
+        # the expansion coefficients are subselected afterwards
+        if self.channels is None or not self.power:
+            return np.zeros((0,), dtype=np.int32)
+        return self.channels
+    def getCutoffPadding(self):
         threshold = 0.001
-        cutoff_padding = self._sigma*np.sqrt(-2*np.log(threshold))
-        if np.any(system.pbc) and system.get_cell() is not None:
-            system = connectivity.pad_cell_to_cutoff(
-                system, self._rcut+cutoff_padding)
-        X = self.evaluateGTO(
-            system,
-            positions,
-            self._alphas,
-            self._betas,
-            rcut=self._rcut,
-            cutoff_padding=cutoff_padding,
-            nmax=self._nmax,
-            lmax=self._lmax,
-            eta=self._eta,
-            atomic_numbers=None)
+        return self._sigma*np.sqrt(-2*np.log(threshold))
+    def getCutoff(self):
+        # Minimum cutoff of a neighbour list passed to evaluate
+        return self._rcut + self.getCutoffPadding()
+    def evaluate(self, system, positions=None, neighbours=None):
+        # With a prebuilt NeighbourList (see connectivity.get_neighbour_list),
+        # its centres replace the positions and no cell search takes place.
+        # With pooling, a single (1,dim) row is returned.
+        if self.cache is not None and neighbours is None:
+            return self.cache.evaluate(self, system, positions,
+                lambda: self.evaluateUncached(system, positions))
+        return self.evaluateUncached(system, positions, neighbours)
+    def evaluateUncached(self, system, positions=None, neighbours=None):
+        cutoff_padding = self.getCutoffPadding()
+        pooling = self.getPoolingArg()
+        if neighbours is not None:
+            X = self.evaluateGTONeighbours(neighbours, cutoff_padding, pooling)
+        else:
+            if positions is None:
+                positions = system.get_positions()
+            X = self.evaluateGTO(
+                system,
+                positions,
+                self._alphas,
+                self._betas,
+                rcut=self._rcut,
+                cutoff_padding=cutoff_padding,
+                nmax=self._nmax,
+                lmax=self._lmax,
+                eta=self._eta,
+                atomic_numbers=None,
+                pooling=pooling)
+        if pooling != POOL_NONE:
+            return X
         if self._normalize:
             z = 1./np.sum(X**2, axis=1)**0.5
             X = (X.T*z).T
-        return X
+        return self.poolRows(X)
+    def evaluate_stream(self, frames, procs=1, chunksize=64):
+        # Yields (frame_index, X) for frames or an xyz file (see pool.stream)
+        return stream(self, frames, procs=procs, chunksize=chunksize)
+    def evaluate_trajectory(self, frames, positions=None, skin=0.5):
+        # Yields the descriptors frame by frame, the neighbour search is
+        # redone only once atoms have moved by more than the skin in total
+        # (see connectivity.VerletList)
+        verlet = connectivity.VerletList(self.getCutoff(), skin, self.n_threads)
+        for i, frame in enumerate(frames):
+            nl = verlet.get(frame, positions[i] if positions is not None else None)
+            yield self.evaluate(frame, neighbours=nl)
+    def evaluate_batch(self, positions_packed, Z_packed, n_atoms_per_struct,
+            centres_packed=None,
+            n_centres_per_struct=None):
+        # Packed (non-periodic) structures are evaluated in a single call,
+        # threaded over structures. Without centres, all atoms are centres.
+        # Returns the stacked descriptors and the row offsets per structure.
+        positions_packed = np.ascontiguousarray(positions_packed, dtype=np.float64)
+        Z_packed = np.ascontiguousarray(Z_packed, dtype=np.int32)
+        n_atoms_per_struct = np.ascontiguousarray(n_atoms_per_struct, dtype=np.int32)
+        if centres_packed is None:
+            centres_packed = positions_packed
+            n_centres_per_struct = n_atoms_per_struct
+        centres_packed = np.ascontiguousarray(centres_packed, dtype=np.float64)
+        n_centres_per_struct = np.ascontiguousarray(n_centres_per_struct, dtype=np.int32)
+        if np.sum(n_atoms_per_struct) != Z_packed.shape[0] or \
+                np.sum(n_centres_per_struct) != centres_packed.shape[0]:
+            raise ValueError("Packed arrays inconsistent with counts per structure")
+        if not set(np.unique(Z_packed)).issubset(set(self.types_z)):
+            raise ValueError("Some types not recognized:", set(np.unique(Z_packed)))
+        cutoff_padding = self.getCutoffPadding()
+        nmax, lmax, n_types = self._nmax, self._lmax, self._Nt
+        channels = self.getChannelsArg()
+        pooling = self.getPoolingArg()
+        n_rows = n_atoms_per_struct.shape[0] if pooling != POOL_NONE \
+            else centres_packed.shape[0]
+        dim = len(channels) if len(channels) > 0 \
+            else self.getChannelDim()*self.getNumberOfChannels()
+        X = np.zeros((n_rows, dim), dtype=self.dtype)
+        evaluate_soapgto_batch(X, positions_packed, centres_packed,
+            self._alphas.flatten(), self._betas.flatten(),
+            Z_packed, self.types_z,
+            n_atoms_per_struct, n_centres_per_struct,
+            self._rcut, cutoff_padding,
+            n_atoms_per_struct.shape[0], n_types,
+            nmax, lmax, self._eta,
+            self._radial_table, self._radial_n_in, channels,
+            self._crossover, self.power, self.n_threads,
+            pooling, self._normalize, 0.)
+        if pooling != POOL_NONE:
+            # Rows pooled (and normalized before) inside the engine
+            return X, np.arange(n_rows+1, dtype=np.int64)
+        if self.channels is not None and not self.power:
+            X = X[:,self.channels]
+        if self._normalize:
+            z = 1./np.sum(X**2, axis=1)**0.5
+            X = (X.T*z).T
+        offsets = np.zeros((n_centres_per_struct.shape[0]+1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(n_centres_per_struct)
+        if self._pooling != POOL_NONE:
+            X = np.concatenate([ self.poolRows(X[offsets[s]:offsets[s+1]]) \
+                for s in range(offsets.shape[0]-1) ])
+            offsets = np.arange(offsets.shape[0], dtype=np.int64)
+        return X, offsets
+    def evaluateGTONeighbours(self, nl, cutoff_padding, pooling=POOL_NONE):
+        if nl.cutoff < self._rcut+cutoff_padding:
+            raise ValueError("Neighbour list cutoff %f smaller than rcut+padding %f" % (
+                nl.cutoff, self._rcut+cutoff_padding))
+        nmax, lmax, n_types = self._nmax, self._lmax, self._Nt
+        channels = self.getChannelsArg()
+        dim = len(channels) if len(channels) > 0 \
+            else self.getChannelDim()*self.getNumberOfChannels()
+        n_rows = 1 if pooling != POOL_NONE else nl.n_centres
+        c = np.zeros(dim*n_rows, dtype=self.dtype)
+        evaluate_soapgto_neighbours(c, nl,
+            self._alphas.flatten(), self._betas.flatten(), self.types_z,
+            self._rcut, cutoff_padding,
+            n_types, nmax, lmax, self._eta,
+            self._radial_table, self._radial_n_in, channels,
+            self._crossover, self.power,
+            pooling, self._normalize, 0.)
+        c = c.reshape((n_rows, dim))
+        if self.channels is not None and not self.power:
+            c = c[:,self.channels]
+        return c
     def evaluateGTO(self, system, centers, 
             alphas, betas, 
             rcut, cutoff_padding, 
             nmax, lmax, eta, atomic_numbers=None, 
-            use_global_types=True):
+            use_global_types=True, pooling=POOL_NONE):
         n_atoms = len(system)
         positions, Z_sorted, n_types, atomtype_lst = self.flattenPositions(system, atomic_numbers)
         centers = np.array(centers)
@@ -105,23 +285,33 @@ class SoapGtoCalculator(object):
         # >>> c = np.zeros(dim*n_centers, dtype=np.float64)
         # >>> shape = (n_centers, dim)
 
-        if self.power:
+        channels = self.getChannelsArg()
+        if len(channels) > 0:
+            dim = len(channels)
+        elif self.power:
             if self._crossover:
                 dim = nmax*nmax*(lmax+1)*int((n_types*(n_types + 1))/2)
             else:
                 dim = int(nmax*(nmax+1)/2*(lmax+1)*n_types)
         else:
             dim = n_types*nmax*(lmax+1)**2
-        c = np.zeros(dim*n_centers, dtype=np.float64)
-        shape = (n_centers, dim)
+        n_rows = 1 if pooling != POOL_NONE else n_centers
+        c = np.zeros(dim*n_rows, dtype=self.dtype)
+        shape = (n_rows, dim)
 
+        cell, pbc = connectivity.get_cell_args(system)
         evaluate_soapgto(c, positions, centers, 
             alphas, betas, Z_sorted, Z_sorted_global,
+            cell, pbc,
             rcut, cutoff_padding, 
             n_atoms, n_types, 
-            nmax, lmax, n_centers, eta, self._crossover, 
-            self.power)
+            nmax, lmax, n_centers, eta,
+            self._radial_table, self._radial_n_in, channels,
+            self._crossover, self.power,
+            pooling, self._normalize, 0.)
         c = c.reshape(shape)
+        if self.channels is not None and not self.power:
+            c = c[:,self.channels]
 
         # TODO Check rotation invariance
         # >>> if not self.power:
@@ -136,25 +326,18 @@ class SoapGtoCalculator(object):
 
         return c
     def flattenPositions(self, system, atomic_numbers=None):
-        Z = system.get_atomic_numbers()
-        pos = system.get_positions()
+        # Positions and atomic numbers grouped by type (ascending), in the
+        # original order within a type. Types default to those present.
+        Z = np.asarray(system.get_atomic_numbers())
+        pos = np.asarray(system.get_positions(), dtype=np.float64).reshape((-1,3))
+        order = np.argsort(Z, kind="stable")
         if atomic_numbers is not None:
-            atomtype_set = set(atomic_numbers)
+            atomtypes = np.unique(atomic_numbers)
+            order = order[np.isin(Z[order], atomtypes)]
         else:
-            atomtype_set = set(Z)
-        atomic_numbers_sorted = np.sort(list(atomtype_set))
-        pos_lst = []
-        z_lst = []
-        for atomtype in atomic_numbers_sorted:
-            condition = (Z == atomtype)
-            pos_onetype = pos[condition]
-            z_onetype = Z[condition]
-            pos_lst.append(pos_onetype)
-            z_lst.append(z_onetype)
-        n_types = len(atomic_numbers_sorted)
-        positions_sorted = np.concatenate(pos_lst, axis=0)
-        atomic_numbers_sorted = np.concatenate(z_lst).ravel()
-        return positions_sorted, atomic_numbers_sorted, n_types, atomic_numbers_sorted
+            atomtypes = np.unique(Z)
+        atomic_numbers_sorted = Z[order]
+        return pos[order], atomic_numbers_sorted, len(atomtypes), atomic_numbers_sorted
     def setupBasisGTO(self, rcut, nmax):
         # These are the values for where the different basis functions should decay
         # to: evenly space between 1 angstrom and rcut.
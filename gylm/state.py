@@ -0,0 +1,117 @@
+import numpy as np
+from gylm._gylm import NeighbourList, evaluate_gylm_neighbours, evaluate_power, POOL_NONE
+from . import connectivity
+
+class GylmState(object):
+    # Gylm descriptors of all atoms of a structure under repeated moves of
+    # a few atoms (e.g., Monte Carlo): The expansion coefficients per centre
+    # are additive over neighbours and hence updated by the contributions
+    # of the moved atoms only, the power spectrum is then recontracted for
+    # the affected centres. Candidates come from a list with a skin, which
+    # is rebuilt (along with all coefficients) once a moved atom has left
+    # its skin/2 sphere. Updated descriptors agree with a full evaluation up
+    # to round-off, recompute() resets the accumulated round-off.
+    def __init__(self, calc, system, skin=1.0):
+        self.calc = calc
+        self.skin = skin
+        self.positions = np.array(system.get_positions(), dtype=np.float64).reshape((-1,3))
+        self.types = np.ascontiguousarray(system.get_atomic_numbers(), dtype=np.int32)
+        if not set(np.unique(self.types)).issubset(calc.types_set):
+            raise ValueError("Some types not recognized:", set(np.unique(self.types)))
+        self.cell, self.pbc = connectivity.get_cell_args(system)
+        self.n_builds = 0
+        self.recompute()
+    def __len__(self):
+        return self.positions.shape[0]
+    def expand(self, centres, positions, types):
+        # Expansion coefficients (double) of centres due to the given atoms,
+        # and the number of neighbours found per centre
+        calc = self.calc
+        centres = np.ascontiguousarray(centres, dtype=np.float64).reshape((-1,3))
+        nl = NeighbourList(centres,
+            np.ascontiguousarray(positions, dtype=np.float64).reshape((-1,3)),
+            np.ascontiguousarray(types, dtype=np.int32),
+            calc._rcut, calc.n_threads, self.cell, self.pbc)
+        dim = calc._nmax*(calc._lmax+1)**2*calc._Nt
+        q = np.zeros((centres.shape[0]*dim,), dtype=np.float64)
+        evaluate_gylm_neighbours(q, nl,
+            calc._gnl_centres, calc._gnl_alphas, calc.types_z,
+            calc._rcut, calc._rcut_width,
+            calc._Nt, calc._nmax, calc._lmax,
+            calc.part_sigma,
+            calc.wconstant,
+            calc.wscale,
+            calc.wcentre,
+            calc.ldamp,
+            calc._radial_table,
+            calc._radial_n_in,
+            np.zeros((0,), dtype=np.int32),
+            False, calc.n_threads,
+            POOL_NONE, False, 0.)
+        return q.reshape((centres.shape[0], dim)), np.diff(nl.offsets)
+    def contract(self, centre_indices):
+        calc = self.calc
+        q = np.ascontiguousarray(self.q[centre_indices])
+        if not calc.power:
+            self.X[centre_indices] = q
+            return
+        X = np.zeros((q.shape[0], self.X.shape[1]), dtype=np.float64)
+        evaluate_power(X, q.flatten(), q.shape[0], calc._Nt, calc._nmax, calc._lmax)
+        self.X[centre_indices] = X
+    def recompute(self):
+        calc = self.calc
+        nl = NeighbourList(self.positions, self.positions, self.types,
+            calc._rcut + self.skin, calc.n_threads, self.cell, self.pbc)
+        self._ref_positions = np.copy(self.positions)
+        self._ref_indices = nl.indices
+        self._ref_offsets = nl.offsets
+        self.n_builds += 1
+        self.q, _ = self.expand(self.positions, self.positions, self.types)
+        self.X = np.zeros((len(self), calc.getDim(calc.power)), dtype=np.float64)
+        self.contract(np.arange(len(self)))
+    def move_atoms(self, indices, new_positions):
+        indices = np.asarray(indices, dtype=np.int64).reshape((-1,))
+        if np.unique(indices).shape[0] != indices.shape[0]:
+            raise ValueError("Atom indices must be unique")
+        if indices.shape[0] == 0:
+            return
+        positions = np.copy(self.positions)
+        positions[indices] = np.asarray(new_positions, dtype=np.float64).reshape((-1,3))
+        d = np.sum((positions[indices] - self._ref_positions[indices])**2, axis=1)**0.5
+        if np.any(d > 0.5*self.skin):
+            self.positions = positions
+            self.recompute()
+            return
+        # Candidates: Atoms within r_cut+skin of the moved ones at the last
+        # rebuild, a superset of their neighbours before and after the move
+        candidates = np.unique(np.concatenate([
+            self._ref_indices[self._ref_offsets[i]:self._ref_offsets[i+1]] \
+                for i in indices ]))
+        others = np.setdiff1d(candidates, indices)
+        # Other centres: Swap the old for the new contributions
+        affected = [ indices ]
+        if others.shape[0] > 0:
+            q_old, n_old = self.expand(self.positions[others],
+                self.positions[indices], self.types[indices])
+            q_new, n_new = self.expand(positions[others],
+                positions[indices], self.types[indices])
+            self.q[others] += q_new - q_old
+            affected.append(others[(n_old + n_new) > 0])
+        # Moved centres: Expand from scratch over the candidates
+        self.q[indices], _ = self.expand(positions[indices],
+            positions[candidates], self.types[candidates])
+        self.positions = positions
+        self.contract(np.concatenate(affected))
+    def descriptors(self):
+        # As returned by calc.evaluate(system)
+        calc = self.calc
+        X = self.X
+        if calc.channels is not None:
+            X = X[:,calc.channels]
+        if calc.normalize:
+            z = 1./(np.sum(X**2, axis=1)+calc.epsilon)**0.5
+            X = (X.T*z).T
+        else:
+            X = np.copy(X)
+        X = calc.poolRows(X)
+        return X.astype(calc.dtype, copy=False)
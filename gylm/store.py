@@ -0,0 +1,167 @@
+import numpy as np
+import itertools
+import json
+import os
+from .pool import stream
+
+def get_hyperparameters(calc):
+    # JSON-serializable settings of a calculator, to tell whether stored
+    # descriptors are compatible with it (as in cache.get_key, without the
+    # thread count and the descriptor cache)
+    hypers = { "calculator": type(calc).__name__ }
+    for key, value in sorted(calc.__dict__.items()):
+        if key in ("n_threads", "cache"): continue
+        if isinstance(value, np.ndarray) and value.size <= 4096:
+            value = value.tolist()
+        elif isinstance(value, np.dtype):
+            value = value.str
+        elif isinstance(value, (np.integer, np.floating, np.bool_)):
+            value = value.item()
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        hypers[key] = value
+    # As read back from the header
+    return json.loads(json.dumps(hypers))
+
+class DescriptorStore(object):
+    # Descriptor blocks of many structures appended to one raw file on disk,
+    # with the rows of structure i at [offsets[i], offsets[i+1]). Files in
+    # the store directory:
+    #   descriptors.bin  (n_rows, dim) rows of dtype, raw
+    #   offsets.bin      int64 row offsets of the structures, raw
+    #   header.json      dim, dtype, calculator hyperparameters and the
+    #                    committed numbers of structures and rows
+    # Blocks are committed by rewriting the header after the data files have
+    # been synced, on reopening (mode "a") anything beyond the last commit
+    # is discarded, such that an interrupted run resumes from there.
+    def __init__(self, path, calc=None, mode="a"):
+        if mode not in ("r", "a", "w"):
+            raise ValueError("Mode must be 'r', 'a' or 'w'")
+        self.path = path
+        self.mode = mode
+        self.hypers = get_hyperparameters(calc) if calc is not None else None
+        self.header = None
+        if mode == "w" or not os.path.exists(self.getPath("header.json")):
+            if mode == "r":
+                raise IOError("No descriptor store at '%s'" % path)
+            self.create()
+        else:
+            self.load()
+    def getPath(self, name):
+        return os.path.join(self.path, name)
+    def create(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(self.getPath("descriptors.bin"), "wb") as ofs:
+            pass
+        with open(self.getPath("offsets.bin"), "wb") as ofs:
+            ofs.write(np.zeros((1,), dtype=np.int64).tobytes())
+        self.header = {
+            "dim": None,
+            "dtype": None,
+            "hyperparameters": self.hypers,
+            "n_structures": 0,
+            "n_rows": 0 }
+        self.writeHeader()
+    def load(self):
+        with open(self.getPath("header.json")) as ifs:
+            self.header = json.load(ifs)
+        if self.hypers is not None and self.header["hyperparameters"] is not None \
+                and self.hypers != self.header["hyperparameters"]:
+            raise ValueError("Calculator differs from the one of the store at '%s'" % self.path)
+        if self.mode == "a":
+            # Drop blocks that were written but not committed
+            row_bytes = self.getRowBytes()
+            with open(self.getPath("descriptors.bin"), "r+b") as f:
+                f.truncate(self.header["n_rows"]*row_bytes)
+            with open(self.getPath("offsets.bin"), "r+b") as f:
+                f.truncate((self.header["n_structures"]+1)*8)
+    def writeHeader(self):
+        tmp = self.getPath("header.json.tmp")
+        with open(tmp, "w") as ofs:
+            json.dump(self.header, ofs, indent=1)
+            ofs.flush()
+            os.fsync(ofs.fileno())
+        os.replace(tmp, self.getPath("header.json"))
+    def getRowBytes(self):
+        if self.header["dim"] is None: return 0
+        return self.header["dim"]*np.dtype(self.header["dtype"]).itemsize
+    def __len__(self):
+        return self.header["n_structures"]
+    @property
+    def n_rows(self):
+        return self.header["n_rows"]
+    @property
+    def dim(self):
+        return self.header["dim"]
+    @property
+    def dtype(self):
+        return None if self.header["dtype"] is None else np.dtype(self.header["dtype"])
+    @property
+    def offsets(self):
+        return np.fromfile(self.getPath("offsets.bin"), dtype=np.int64,
+            count=self.header["n_structures"]+1)
+    def append(self, X_list):
+        # Appends and commits the descriptor matrices of a list of structures
+        if self.mode == "r":
+            raise IOError("Descriptor store opened read-only")
+        if len(X_list) == 0: return
+        if self.header["dim"] is None:
+            self.header["dim"] = int(X_list[0].shape[1])
+            self.header["dtype"] = np.dtype(X_list[0].dtype).str
+        dtype = np.dtype(self.header["dtype"])
+        n_rows = self.header["n_rows"]
+        offsets = []
+        with open(self.getPath("descriptors.bin"), "ab") as ofs:
+            for X in X_list:
+                X = np.asarray(X)
+                if X.ndim != 2 or X.shape[1] != self.header["dim"]:
+                    raise ValueError("Expected blocks with %d columns" % self.header["dim"])
+                ofs.write(np.ascontiguousarray(X, dtype=dtype).tobytes())
+                n_rows += X.shape[0]
+                offsets.append(n_rows)
+            ofs.flush()
+            os.fsync(ofs.fileno())
+        with open(self.getPath("offsets.bin"), "ab") as ofs:
+            ofs.write(np.array(offsets, dtype=np.int64).tobytes())
+            ofs.flush()
+            os.fsync(ofs.fileno())
+        self.header["n_structures"] += len(X_list)
+        self.header["n_rows"] = n_rows
+        self.writeHeader()
+    def featurize(self, calc, frames, procs=1, chunksize=64):
+        # Evaluates and appends the frames (an iterable or xyz file, see
+        # pool.stream) one chunk at a time. Frames stored already, e.g., by
+        # an interrupted run, are skipped.
+        if self.hypers is None:
+            self.hypers = get_hyperparameters(calc)
+        if self.header["hyperparameters"] is None:
+            self.header["hyperparameters"] = self.hypers
+        elif self.header["hyperparameters"] != get_hyperparameters(calc):
+            raise ValueError("Calculator differs from the one of the store at '%s'" % self.path)
+        if isinstance(frames, str):
+            # Stored frames are skipped via the byte-offset index, unparsed
+            from . import readwrite
+            frames = readwrite.iread(frames, index=slice(len(self), None) \
+                if len(self) > 0 else ':')
+        else:
+            frames = itertools.islice(frames, len(self), None)
+        block = []
+        for _, X in stream(calc, frames, procs=procs, chunksize=chunksize):
+            block.append(X)
+            if len(block) == chunksize:
+                self.append(block)
+                block = []
+        self.append(block)
+        return self
+    def matrix(self):
+        # All committed rows, memory-mapped
+        if self.header["n_rows"] == 0:
+            return np.zeros((0, self.header["dim"] or 0), dtype=self.dtype or np.float64)
+        return np.memmap(self.getPath("descriptors.bin"), dtype=self.dtype, mode="r",
+            shape=(self.header["n_rows"], self.header["dim"]))
+    def __getitem__(self, idx):
+        offsets = self.offsets
+        return self.matrix()[offsets[idx]:offsets[idx+1]]
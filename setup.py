@@ -1,3 +1,4 @@
+import os
 import sys
 import platform
 from setuptools import setup, find_packages, Extension
@@ -16,13 +17,30 @@ def make_cxx_extensions():
         "./gylm/cxx/ylm.cpp",
         "./gylm/cxx/bindings.cpp",
         "./gylm/cxx/gridsearch.cpp",
-        "./gylm/cxx/soapgto.cpp"]
+        "./gylm/cxx/neighbourlist.cpp",
+        "./gylm/cxx/radial.cpp",
+        "./gylm/cxx/linalg.cpp",
+        "./gylm/cxx/soapgto.cpp",
+        "./gylm/cxx/xyz.cpp"]
     incdirs = [
         "./gylm/cxx",
         get_pybind_include(),
         get_pybind_include(user=True)]
     cpp_extra_link_args = []
     cpp_extra_compile_args = ["-std=c++11", "-O3"]
+    # OpenMP drives the threaded centre loops (n_threads), the sources
+    # fall back to serial execution when compiled without it
+    if platform.system() != "Darwin":
+        cpp_extra_compile_args.append("-fopenmp")
+        cpp_extra_link_args.append("-fopenmp")
+    # Power-spectrum contractions use a built-in GEMM kernel, an external
+    # CBLAS can be linked instead, e.g. GYLM_CBLAS=openblas
+    define_macros = []
+    libraries = []
+    cblas = os.environ.get("GYLM_CBLAS", "")
+    if cblas != "":
+        define_macros.append(("GYLM_CBLAS", None))
+        libraries.append(cblas)
     c_extra_compile_args = ["-std=c99", "-O3"]
     return [
         Extension(
@@ -30,6 +48,8 @@ def make_cxx_extensions():
             srcs,
             include_dirs=incdirs,
             language='c++',
+            define_macros=define_macros,
+            libraries=libraries,
             extra_compile_args=cpp_extra_compile_args + ["-fvisibility=hidden"],  # the -fvisibility flag is needed by pybind11
             extra_link_args=cpp_extra_link_args,
         )
@@ -9,8 +9,8 @@ def assert_equal(z, target, eps=1e-5):
     if np.abs(z-target) > eps: raise ValueError(z)
     else: log << "+" << log.flush
 
-def get_calc(scale):
-    return gylm.GylmCalculator(
+def get_calc(scale, **kwargs):
+    args = dict(
         rcut=scale*3.5,
         rcut_width=scale*0.5,
         nmax=9,
@@ -24,6 +24,8 @@ def get_calc(scale):
         normalize=True,
         types="C,N,O,S,H,F,Cl,Br,I,B,P".split(","),
         periodic=False)
+    args.update(kwargs)
+    return gylm.GylmCalculator(**args)
 
 def test_gylm_scaleinv():
     log << log.mg << "<test_scaleinv>" << log.endl
@@ -100,8 +102,685 @@ def test_gylm_parity():
             assert_equal(diff, 0.0, 1e-10)
         log << log.endl
 
+def test_gylm_threads():
+    log << log.mg << "<test_threads>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    calc0 = get_calc(scale=1.)
+    calc1 = get_calc(scale=1.)
+    calc1.n_threads = 4
+    for cidx, config in enumerate(configs):
+        log << "Struct" << cidx << log.flush
+        x0 = calc0.evaluate(system=config)
+        x1 = calc1.evaluate(system=config)
+        assert_equal(np.max(np.abs(x0 - x1)), 0.0, 0.0)
+        log << log.endl
+
+def test_gylm_batch():
+    log << log.mg << "<test_batch>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    calc = get_calc(scale=1.)
+    pos = np.concatenate([ c.positions for c in configs ])
+    Z = np.concatenate([ c.get_atomic_numbers() for c in configs ])
+    n_atoms = [ len(c) for c in configs ]
+    X, offsets = calc.evaluate_batch(pos, Z, n_atoms)
+    for cidx, config in enumerate(configs):
+        log << "Struct" << cidx << log.flush
+        x0 = calc.evaluate(system=config)
+        x1 = X[offsets[cidx]:offsets[cidx+1]]
+        assert_equal(np.max(np.abs(x0 - x1)), 0.0, 0.0)
+        log << log.endl
+
+def test_gylm_pool():
+    log << log.mg << "<test_pool>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    calc = get_calc(scale=1.)
+    with gylm.DescriptorPool(calc, procs=2) as pool:
+        X_list = pool.evaluate(configs)
+    for cidx, config in enumerate(configs):
+        log << "Struct" << cidx << log.flush
+        x0 = calc.evaluate(system=config)
+        assert_equal(np.max(np.abs(x0 - X_list[cidx])), 0.0, 0.0)
+        log << log.endl
+    # Settings other than the calculator's are rejected, not ignored
+    for kwargs in [ dict(power=False), dict(normalize=False), dict(verbose=True) ]:
+        try:
+            calc.evaluate_mp(configs[0:1], **kwargs)
+            assert False
+        except ValueError:
+            pass
+
+def test_gylm_read():
+    log << log.mg << "<test_read>" << log.endl
+    # Bulk-parsed frames for any chunking of the input, extra columns and
+    # CRLF line ends
+    import io
+    text = b'2\r\nLattice="5 0 0 0 5 0 0 0 5" Properties=species:S:1:pos:R:3:forces:R:3 energy=-1.5\r\n' \
+        + b'C\t0.5 1e-3 -2.5E+1 0.1 0.2 0.3\r\n  H  1 2 3 4 5 6\r\n' \
+        + b'1\nname="a b" n=3 \nO -0.125 +7 1.00000000000000000001'
+    for chunk_bytes in [ 1, 7, 1<<20 ]:
+        log << "chunk" << chunk_bytes << log.flush
+        configs = list(gylm.io.iread_frames(io.BytesIO(text), chunk_bytes=chunk_bytes))
+        assert_equal(len(configs), 2, 0)
+        assert_equal(configs[0].symbols == [ "C", "H" ] and configs[1].symbols == [ "O" ], True, 0)
+        assert_equal(np.max(np.abs(configs[0].positions
+            - np.array([[0.5, 1e-3, -25.], [1., 2., 3.]]))), 0.0, 0.0)
+        assert_equal(np.max(np.abs(configs[1].positions - np.array([[-0.125, 7., 1.]]))), 0.0, 0.0)
+        assert_equal(configs[0].info == { "Lattice": "5 0 0 0 5 0 0 0 5", "energy": -1.5,
+            "Properties": "species:S:1:pos:R:3:forces:R:3" }, True, 0)
+        assert_equal(configs[1].info == { "name": "a b", "n": 3 }, True, 0)
+        log << log.endl
+    for text in [ b'2\n\nO 0 0 0\n', b'x\n\n', b'1\n\nO 0 0 a\n' ]:
+        try:
+            list(gylm.io.iread_frames(io.BytesIO(text)))
+            assert False
+        except ValueError:
+            pass
+    # Round trip through files: Positions are written with 4 decimals
+    import os, tempfile
+    configs = gylm.io.read('../test_data/structures.xyz')
+    for cidx, config in enumerate(configs):
+        config.info["energy"] = -0.5*cidx - 0.25
+        config.info["n"] = cidx
+    tmp = tempfile.NamedTemporaryFile(suffix=".xyz", delete=False)
+    tmp.close()
+    try:
+        gylm.io.write(tmp.name, configs)
+        with open(tmp.name, 'rb') as ifs:
+            frames = list(gylm.io.iread_frames(ifs))
+    finally:
+        os.remove(tmp.name)
+    assert_equal(len(frames), len(configs), 0)
+    for config, frame in zip(configs, frames):
+        assert_equal(frame.symbols == list(config.symbols), True, 0)
+        assert_equal(np.max(np.abs(frame.positions - config.positions)), 0.0, 0.5e-4+1e-12)
+        assert_equal(frame.info == config.info, True, 0)
+
+def test_gylm_frame():
+    log << log.mg << "<test_frame>" << log.endl
+    # Frames hold contiguous float64 positions and cached int32 numbers,
+    # which follow reassigned or in-place edited symbols
+    import pickle
+    configs = gylm.io.read('../test_data/structures.xyz')
+    for config in configs:
+        ref = np.array([ gylm.ptable.lookup[s].z for s in config.symbols ])
+        Z = config.get_atomic_numbers()
+        assert_equal(Z.dtype == np.int32 and config.positions.flags.c_contiguous, True, 0)
+        assert_equal(np.max(np.abs(Z - ref)), 0, 0)
+        assert_equal(config.get_atomic_numbers() is Z, True, 0)
+        copy = pickle.loads(pickle.dumps(config))
+        assert_equal(np.max(np.abs(copy.get_atomic_numbers() - Z)), 0, 0)
+        assert_equal(copy.info == config.info, True, 0)
+    config = gylm.io.ExtendedXyz(positions=[[0,0,0],[0,0,1.1]], symbols=np.array(["C", "O"]))
+    assert_equal(config.positions.shape == (2,3) and type(config.symbols[0]) is str, True, 0)
+    assert_equal(config.get_atomic_numbers()[1], 8, 0)
+    config.symbols = [ "C", "N" ]
+    assert_equal(config.get_atomic_numbers()[1], 7, 0)
+    symbols = [ "H", "O" ]
+    config = gylm.io.ExtendedXyz(positions=np.zeros((2,3)), symbols=symbols)
+    config.get_atomic_numbers()
+    symbols[0] = "N"
+    assert_equal(config.get_atomic_numbers()[0], 1, 0)
+    config.symbols[0] = "C"
+    assert_equal(config.get_atomic_numbers()[0], 6, 0)
+    config.get_chemical_symbols().append("F")
+    config.positions = np.zeros((3,3))
+    assert_equal(np.max(np.abs(config.get_atomic_numbers() - [ 6, 8, 9 ])), 0, 0)
+
+def test_gylm_read_index():
+    log << log.mg << "<test_read_index>" << log.endl
+    # Frames selected via the byte-offset index, serially and over workers
+    import os, tempfile
+    configs = gylm.io.read('../test_data/structures.xyz')
+    configs = [ configs[i % len(configs)] for i in range(11) ]
+    tmp = tempfile.NamedTemporaryFile(suffix=".xyz", delete=False)
+    tmp.close()
+    try:
+        gylm.io.write(tmp.name, configs)
+        frames = gylm.io.read(tmp.name)
+        offsets = gylm.io.get_index(tmp.name)
+        assert_equal(len(offsets), len(frames)+1, 0)
+        assert_equal(os.path.exists(tmp.name + ".idx.npz"), True, 0)
+        assert_equal(np.max(np.abs(gylm.io.get_index(tmp.name) - offsets)), 0, 0)
+        for index in [ "3", -2, "2:9:3", "::-1", [ 7, 0, 0, 10 ] ]:
+            for procs in [ 1, 2 ]:
+                log << str(index) << "procs" << procs << log.flush
+                selected = gylm.io.read(tmp.name, index, procs=procs)
+                if gylm.io.is_single_frame(index):
+                    selected = [ selected ]
+                ref = gylm.io.select_frames(index, len(frames))
+                assert_equal(len(selected), len(ref), 0)
+                for config, i in zip(selected, ref):
+                    assert_equal(config.symbols == frames[i].symbols, True, 0)
+                    assert_equal(np.max(np.abs(config.positions - frames[i].positions)), 0.0, 0.0)
+                log << log.endl
+    finally:
+        for path in [ tmp.name, tmp.name + ".idx.npz" ]:
+            if os.path.exists(path): os.remove(path)
+
+def test_gylm_binary():
+    log << log.mg << "<test_binary>" << log.endl
+    # Binary datasets hold positions at full precision, frame views evaluate
+    # as the frames they were written from, also in worker processes
+    import pickle, shutil, tempfile
+    configs = gylm.io.read('../test_data/structures.xyz')
+    for config in configs:
+        config.positions = config.positions + 1e-7*np.pi
+    configs[1].info["Lattice"] = "12 0 0 0 13 0 1 0 14"
+    path = tempfile.mkdtemp()
+    try:
+        gylm.io.write_binary(path, configs)
+        dataset = gylm.io.open_binary(path)
+        assert_equal(len(dataset), len(configs), 0)
+        calc = get_calc(scale=1.)
+        for config, frame in zip(configs, dataset):
+            assert_equal(np.max(np.abs(frame.get_positions() - config.positions)), 0.0, 0.0)
+            assert_equal(frame.symbols == list(config.symbols), True, 0)
+            assert_equal(frame.info == config.info, True, 0)
+            assert_equal(np.max(np.abs(calc.evaluate(frame) - calc.evaluate(config))), 0.0, 0.0)
+        assert_equal(np.max(np.abs(dataset[1].get_cell() - configs[1].get_cell())), 0.0, 0.0)
+        assert_equal(pickle.loads(pickle.dumps(dataset[-1])).dataset is dataset, True, 0)
+        X = calc.evaluate_mp(dataset[:], procs=2)
+        for x, config in zip(X, configs):
+            assert_equal(np.max(np.abs(x - calc.evaluate(config))), 0.0, 0.0)
+        log << "frames" << len(dataset) << "atoms" << dataset.positions.shape[0] << log.endl
+        del X, dataset
+    finally:
+        shutil.rmtree(path)
+
+def test_gylm_stream():
+    log << log.mg << "<test_stream>" << log.endl
+    # Lazily read frames featurized serially and in chunks over workers
+    import os, tempfile
+    configs = gylm.io.read('../test_data/structures.xyz')
+    calc = get_calc(scale=1.)
+    tmp = tempfile.NamedTemporaryFile(suffix=".xyz", delete=False)
+    tmp.close()
+    try:
+        gylm.io.write(tmp.name, configs)
+        frames = gylm.io.read(tmp.name)
+        for procs in [ 1, 2 ]:
+            log << "procs" << procs << log.flush
+            n_frames = 0
+            for fidx, X in calc.evaluate_stream(tmp.name, procs=procs, chunksize=3):
+                assert_equal(np.max(np.abs(X - calc.evaluate(frames[fidx]))), 0.0, 0.0)
+                n_frames += 1
+            assert_equal(n_frames, len(configs), 0)
+            log << log.endl
+    finally:
+        os.remove(tmp.name)
+
+def test_gylm_store():
+    log << log.mg << "<test_store>" << log.endl
+    # Featurize into a store in two runs, the second resuming the first,
+    # with a dangling uncommitted block from the interrupted run
+    import os, shutil, tempfile
+    configs = gylm.io.read('../test_data/structures.xyz')
+    calc = get_calc(scale=1.)
+    path = tempfile.mkdtemp()
+    try:
+        store = gylm.DescriptorStore(path, calc, mode="w")
+        store.featurize(calc, configs[0:4], chunksize=3)
+        with open(store.getPath("descriptors.bin"), "ab") as ofs:
+            ofs.write(b"\0"*100)
+        store = gylm.DescriptorStore(path, calc).featurize(calc, configs, chunksize=3)
+        assert_equal(len(store), len(configs), 0)
+        store = gylm.DescriptorStore(path, mode="r")
+        X_ref = [ calc.evaluate(config) for config in configs ]
+        X = store.matrix()
+        assert_equal(X.shape[0], sum(x.shape[0] for x in X_ref), 0)
+        assert_equal(np.max(np.abs(X - np.concatenate(X_ref))), 0.0, 0.0)
+        for i in range(len(configs)):
+            assert_equal(np.max(np.abs(store[i] - X_ref[i])), 0.0, 0.0)
+        log << "offsets" << store.offsets[0:4] << log.endl
+        # Resumed from an xyz file, starting at the first missing frame
+        store = gylm.DescriptorStore(os.path.join(path, "xyz"), calc)
+        store.featurize(calc, configs[0:2])
+        xyz = os.path.join(path, "structures.xyz")
+        shutil.copy('../test_data/structures.xyz', xyz)
+        store = gylm.DescriptorStore(os.path.join(path, "xyz"), calc)
+        store.featurize(calc, xyz, chunksize=3)
+        assert_equal(len(store), len(configs), 0)
+        assert_equal(np.max(np.abs(store.matrix() - np.concatenate(X_ref))), 0.0, 0.0)
+        # The same settings with a descriptor cache are accepted
+        gylm.DescriptorStore(path, get_calc(scale=1., cache=gylm.DescriptorCache()))
+        # Calculators with other settings are rejected
+        try:
+            gylm.DescriptorStore(path, get_calc(scale=0.5))
+            assert False
+        except ValueError:
+            pass
+        del X, store
+    finally:
+        shutil.rmtree(path)
+
+def test_gylm_cache():
+    log << log.mg << "<test_cache>" << log.endl
+    # Repeated evaluations are served from memory, then from disk after the
+    # memory tier is cleared, other settings or positions miss
+    import shutil, tempfile
+    configs = gylm.io.read('../test_data/structures.xyz')[0:6]
+    path = tempfile.mkdtemp()
+    try:
+        cache = gylm.DescriptorCache(path=path)
+        calc = get_calc(scale=1., cache=cache)
+        X_ref = [ get_calc(scale=1.).evaluate(config) for config in configs ]
+        for it in range(3):
+            if it == 2: cache.clear()
+            for i, config in enumerate(configs):
+                assert_equal(np.max(np.abs(calc.evaluate(config) - X_ref[i])), 0.0, 0.0)
+        log << "hits" << cache.n_hits << "misses" << cache.n_misses << log.endl
+        assert_equal(cache.n_misses, len(configs), 0)
+        assert_equal(cache.n_hits, 2*len(configs), 0)
+        get_calc(scale=0.5, cache=cache).evaluate(configs[0])
+        calc.evaluate(configs[0], positions=configs[0].positions[0:2])
+        assert_equal(cache.n_misses, len(configs)+2, 0)
+        # Byte budgets: Least recently used entries are dropped
+        size = X_ref[0].nbytes
+        cache = gylm.DescriptorCache(max_bytes=size, path=path, max_disk_bytes=3*size)
+        calc.cache = cache
+        for config in configs:
+            calc.evaluate(config)
+        assert_equal(len(cache), 1 if X_ref[-1].nbytes <= size else 0, 0)
+        assert_equal(cache.disk_bytes <= 3*size, True, 0)
+    finally:
+        shutil.rmtree(path)
+
+def test_gylm_gradients():
+    log << log.mg << "<test_gradients>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    config = configs[0]
+    h = 1e-5
+    # Analytic and tabulated radial basis, gradients of the descriptors
+    # the calculator evaluates in either case
+    for wconstant, radial_table in [ (True, False), (False, False), (True, True) ]:
+        calc = get_calc(scale=1., wconstant=wconstant, radial_table=radial_table)
+        X, dX, pairs = calc.evaluate_with_gradients(config)
+        assert_equal(np.max(np.abs(X - calc.evaluate(config))), 0.0, 1e-12)
+        pos_orig = np.copy(config.positions)
+        for atom in [ 0, 5 ]:
+            log << "Atom" << atom << log.flush
+            for a in range(3):
+                config.positions = np.copy(pos_orig)
+                config.positions[atom,a] += h
+                xp = calc.evaluate(config)
+                config.positions[atom,a] -= 2*h
+                xm = calc.evaluate(config)
+                dx = np.zeros_like(X)
+                sel = np.where(pairs[:,1] == atom)[0]
+                dx[pairs[sel,0]] = dX[sel,a]
+                assert_equal(np.max(np.abs((xp-xm)/(2*h) - dx)), 0.0, 1e-7)
+            log << log.endl
+        config.positions = pos_orig
+        # Subset of atoms as centres: rows and pairs of the full evaluation
+        centres = [ 0, 2 ]
+        Xc, dXc, pairs_c = calc.evaluate_with_gradients(config, centre_indices=centres)
+        assert_equal(np.max(np.abs(Xc - X[centres])), 0.0, 1e-12)
+        sel = np.where(np.isin(pairs[:,0], centres))[0]
+        assert_equal(len(sel), len(pairs_c), 0)
+        assert_equal(np.max(np.abs(np.searchsorted(centres, pairs[sel,0]) - pairs_c[:,0])), 0, 0)
+        assert_equal(np.max(np.abs(pairs[sel,1] - pairs_c[:,1])), 0, 0)
+        assert_equal(np.max(np.abs(dX[sel] - dXc)), 0.0, 1e-12)
+
+def test_gylm_radial_table():
+    log << log.mg << "<test_radial_table>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    for wconstant in [ True, False ]:
+        calc0 = get_calc(scale=1., wconstant=wconstant)
+        calc1 = get_calc(scale=1., wconstant=wconstant, 
+            radial_table=True, radial_tol=1e-8)
+        for cidx, config in enumerate(configs):
+            log << "Struct" << cidx << log.flush
+            x0 = calc0.evaluate(system=config)
+            x1 = calc1.evaluate(system=config)
+            assert_equal(np.max(np.abs(x0 - x1)), 0.0, 1e-6)
+            log << log.endl
+    # Tolerances below round-off are rejected rather than tabulated
+    try:
+        get_calc(scale=1., radial_table=True, radial_tol=1e-30)
+        assert False
+    except ValueError:
+        pass
+
+def test_gylm_power():
+    log << log.mg << "<test_power>" << log.endl
+    n_src, n_types, nmax, lmax = 3, 4, 5, 6
+    q = np.random.normal(size=(n_src, n_types, nmax, (lmax+1)**2))
+    X = np.zeros((n_src, n_types*(n_types+1)//2*nmax*nmax*(lmax+1)))
+    gylm._gylm.evaluate_power(X, q.flatten(), n_src, n_types, nmax, lmax)
+    X = X.reshape((n_src, -1, nmax, nmax, lmax+1))
+    tu = 0
+    for t in range(n_types):
+        for u in range(t, n_types):
+            for l in range(lmax+1):
+                ql = q[:,:,:,l*l:(l+1)*(l+1)]
+                x = np.einsum('inm,ikm->ink', ql[:,t], ql[:,u])/(2*l+1)**0.5
+                assert_equal(np.max(np.abs(X[:,tu,:,:,l] - x)), 0.0, 1e-10)
+            tu += 1
+    log << log.endl
+
+def test_gylm_channels():
+    log << log.mg << "<test_channels>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    calc0 = get_calc(scale=1., normalize=False)
+    channels = np.random.choice(calc0.getDim(), 200, replace=False)
+    calc1 = get_calc(scale=1., normalize=False, channels=channels)
+    assert_equal(calc1.getDim(), 200, 0)
+    for cidx, config in enumerate(configs):
+        log << "Struct" << cidx << log.flush
+        x0 = calc0.evaluate(system=config)
+        x1 = calc1.evaluate(system=config)
+        assert_equal(np.max(np.abs(x0[:,channels] - x1)), 0.0, 0.0)
+        log << log.endl
+
+def test_gylm_float32():
+    log << log.mg << "<test_float32>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    for power in [ True, False ]:
+        calc0 = get_calc(scale=1., power=power)
+        calc1 = get_calc(scale=1., power=power, dtype=np.float32)
+        for cidx, config in enumerate(configs):
+            log << "Struct" << cidx << log.flush
+            x0 = calc0.evaluate(system=config)
+            x1 = calc1.evaluate(system=config)
+            assert_equal(int(x1.dtype == np.float32), 1, 0)
+            assert_equal(np.max(np.abs(x0 - x1)), 0.0, 1e-5)
+            log << log.endl
+    X, offsets = calc1.evaluate_batch(configs[0].positions, 
+        configs[0].get_atomic_numbers(), [ len(configs[0]) ])
+    assert_equal(np.max(np.abs(X - calc1.evaluate(configs[0]))), 0.0, 0.0)
+
+def test_gylm_neighbour_list():
+    log << log.mg << "<test_neighbour_list>" << log.endl
+    configs = gylm.io.read('../test_data/structures.xyz')
+    calc0 = get_calc(scale=1.)
+    calc1 = gylm.SoapGtoCalculator(rcut=3.0, nmax=6, lmax=4, sigma=0.5,
+        types=calc0.types, normalize=True)
+    r_cut = max(calc0.getCutoff(), calc1.getCutoff()) + 1.0
+    for cidx, config in enumerate(configs):
+        log << "Struct" << cidx << log.flush
+        nl = gylm.connect.get_neighbour_list(config, r_cut)
+        assert_equal(nl.n_centres, len(config), 0)
+        for calc in [ calc0, calc1 ]:
+            x0 = calc.evaluate(system=config)
+            x1 = calc.evaluate(system=config, neighbours=nl)
+            assert_equal(np.max(np.abs(x0 - x1)), 0.0, 1e-10)
+        nl_small = nl.filter(calc0.getCutoff())
+        assert_equal(np.max(nl_small.distances), 0.0, calc0.getCutoff())
+        x1 = calc0.evaluate(system=config, neighbours=nl_small)
+        assert_equal(np.max(np.abs(calc0.evaluate(system=config) - x1)), 0.0, 1e-10)
+        log << log.endl
+
+def test_gylm_periodic():
+    log << log.mg << "<test_periodic>" << log.endl
+    # Periodic images vs. an explicitly replicated (non-periodic) cell
+    cell = np.array([[3.1,0.,0.],[1.2,2.8,0.],[0.7,-0.5,2.6]])
+    pos = np.random.uniform(-0.3, 1.3, size=(5,3)).dot(cell)
+    symbols = [ "C", "H", "O", "H", "C" ]
+    config = gylm.io.ExtendedXyz()
+    config.positions = pos
+    config.symbols = symbols
+    config.cell = cell
+    config.set_pbc([ True, True, True ])
+    calcs = [
+        get_calc(scale=1., normalize=False),
+        gylm.SoapGtoCalculator(rcut=3.0, nmax=6, lmax=4, sigma=0.5,
+            types="C,N,O,S,H,F,Cl,Br,I,B,P".split(",")) ]
+    for calc in calcs:
+        log << type(calc).__name__ << log.flush
+        heights = 1./np.linalg.norm(np.linalg.inv(cell), axis=0)
+        n = int(np.ceil(calc.getCutoff()/np.min(heights))) + 1
+        images = [ pos + np.array([i,j,k]).dot(cell) \
+            for i in range(-n, n+1) for j in range(-n, n+1) for k in range(-n, n+1) ]
+        replicated = gylm.io.ExtendedXyz()
+        replicated.positions = np.concatenate(images)
+        replicated.symbols = symbols*len(images)
+        x0 = calc.evaluate(system=replicated, positions=pos)
+        x1 = calc.evaluate(system=config)
+        assert_equal(np.max(np.abs(x0 - x1)), 0.0, 1e-10)
+        log << log.endl
+    nl = gylm.connect.get_neighbour_list(config, 4.)
+    centres = np.repeat(nl.centres, np.diff(nl.offsets), axis=0)
+    assert_equal(np.max(np.abs(pos[nl.indices] + nl.shifts - centres - nl.deltas)), 0.0, 1e-12)
+
+def test_gylm_grid_search():
+    log << log.mg << "<test_grid_search>" << log.endl
+    # Cell lists with (sub-)cutoff bins vs. brute force, open and periodic
+    from gylm._gylm import GridSearch
+    cell = np.array([[6.1,0.,0.],[2.2,5.8,0.],[1.7,-1.5,5.6]])
+    pos = np.random.uniform(-0.2, 1.2, size=(120,3)).dot(cell)
+    cutoff = 2.5
+    n = 2
+    shifts = np.array([ [i,j,k] for i in range(-n, n+1) \
+        for j in range(-n, n+1) for k in range(-n, n+1) ]).dot(cell)
+    for bins_per_cutoff in [ 1, 2, 3 ]:
+        log << "bins/cutoff" << bins_per_cutoff << log.flush
+        for periodic in [ False, True ]:
+            if periodic:
+                gs = GridSearch(pos, cutoff, cell, np.ones((3,), dtype=bool),
+                    bins_per_cutoff=bins_per_cutoff)
+            else:
+                gs = GridSearch(pos, cutoff, bins_per_cutoff=bins_per_cutoff)
+            for i in range(0, len(pos), 7):
+                res = gs.getNeighboursForIndex(i)
+                d = pos[None,:,:] - pos[i] + (shifts[:,None,:] if periodic else 0.)
+                d = np.sum(d**2, axis=2)**0.5
+                d[n*(2*n+1)**2 + n*(2*n+1) + n if periodic else 0, i] = np.inf
+                target = np.sort(d[d <= cutoff])
+                assert_equal(len(res.indices), len(target), 0)
+                assert_equal(np.max(np.abs(np.sort(res.distances) - target), initial=0.), 0.0, 1e-12)
+            # Bulk query: Same neighbours, half list with each pair once
+            offsets, indices, distances, deltas = gs.getNeighbours(n_threads=2)
+            for i in range(0, len(pos), 7):
+                res = gs.getNeighboursForIndex(i)
+                assert_equal(np.max(np.abs(np.sort(distances[offsets[i]:offsets[i+1]]) \
+                    - np.sort(res.distances)), initial=0.), 0.0, 1e-12)
+            assert_equal(np.max(np.abs(np.sum(deltas**2, axis=1)**0.5 - distances)), 0.0, 1e-12)
+            if not periodic:
+                src = np.repeat(np.arange(len(pos)), np.diff(offsets))
+                assert_equal(np.max(np.abs(pos[indices] - pos[src] - deltas)), 0.0, 1e-12)
+            half = gs.getNeighbours(half=True)
+            src = np.repeat(np.arange(len(pos)), np.diff(half[0]))
+            assert_equal(2*len(half[1]), len(indices), 0)
+            assert_equal(int(np.all(half[1] >= src)), 1, 0)
+        log << log.endl
+    # Clusters far apart: Hashed (sparse) bins
+    centres = np.random.uniform(100., 1e4-100., size=(10,3))
+    pos = (centres[:,None,:] + np.random.normal(scale=1., size=(10,8,3))).reshape((-1,3))
+    for periodic in [ False, True ]:
+        log << "sparse, periodic" << periodic << log.flush
+        if periodic:
+            gs = GridSearch(pos, cutoff, np.diag([ 1e4, 1e4, 1e4 ]),
+                np.array([ True, True, False ]))
+        else:
+            gs = GridSearch(pos, cutoff)
+        assert_equal(int(gs.isSparse()), 1, 0)
+        for i in range(len(pos)):
+            res = gs.getNeighboursForIndex(i)
+            d = np.sum((pos - pos[i])**2, axis=1)**0.5
+            d[i] = np.inf
+            target = np.sort(d[d <= cutoff])
+            assert_equal(len(res.indices), len(target), 0)
+            assert_equal(np.max(np.abs(np.sort(res.distances) - target), initial=0.), 0.0, 1e-12)
+        log << log.endl
+
+def test_gylm_bins_per_cutoff():
+    log << log.mg << "<test_bins_per_cutoff>" << log.endl
+    # Descriptors do not depend on the cell-list resolution, which is
+    # chosen from the density unless given
+    np.random.seed(11)
+    box = 5.5
+    config = gylm.io.ExtendedXyz()
+    config.positions = np.random.uniform(0., box, size=(400,3))
+    config.symbols = list(np.random.choice([ "C", "H", "O" ], size=400))
+    config.cell = box*np.identity(3)
+    config.set_pbc([ True, True, True ])
+    sparse = gylm.io.read('../test_data/structures.xyz')[0]
+    calcs = [
+        get_calc(scale=1.),
+        gylm.SoapGtoCalculator(rcut=3.0, nmax=6, lmax=4, sigma=0.5,
+            types="C,N,O,S,H,F,Cl,Br,I,B,P".split(","), normalize=True) ]
+    for calc in calcs:
+        log << type(calc).__name__ << log.flush
+        r_cut = calc.getCutoff()
+        assert_equal(gylm.connect.get_neighbour_list(config, r_cut).bins_per_cutoff, 2, 0)
+        assert_equal(gylm.connect.get_neighbour_list(sparse, r_cut).bins_per_cutoff, 1, 0)
+        x0 = calc.evaluate(config)
+        for bins_per_cutoff in [ 1, 2, 3 ]:
+            nl = gylm.connect.get_neighbour_list(config, r_cut,
+                bins_per_cutoff=bins_per_cutoff)
+            assert_equal(nl.bins_per_cutoff, bins_per_cutoff, 0)
+            x1 = calc.evaluate(config, neighbours=nl)
+            assert_equal(np.max(np.abs(x0 - x1)), 0.0, 1e-10)
+        log << log.endl
+
+def test_gylm_pooling():
+    log << log.mg << "<test_pooling>" << log.endl
+    # Pooled inside the engine vs. pooled rows of the full output
+    configs = gylm.io.read('../test_data/structures.xyz')
+    config = configs[1]
+    for pooling in [ "average", "sum" ]:
+        log << pooling << log.flush
+        for power in [ True, False ]:
+            calcs = [ get_calc(scale=1., power=power) ]
+            if power: calcs.append(gylm.SoapGtoCalculator(rcut=3.0, nmax=6, lmax=4,
+                sigma=0.5, normalize=True, types="C,N,O,S,H,F,Cl,Br,I,B,P".split(",")))
+            for calc in calcs:
+                X = calc.evaluate(config)
+                target = np.mean(X, axis=0) if pooling == "average" else np.sum(X, axis=0)
+                calc.pooling = pooling
+                calc._pooling = calc.setupPooling(pooling)
+                x = calc.evaluate(config)
+                assert_equal(x.shape[0], 1, 0)
+                assert_equal(np.max(np.abs(x[0] - target)), 0.0, 1e-10)
+                nl = gylm.connect.get_neighbour_list(config, calc.getCutoff())
+                x = calc.evaluate(config, neighbours=nl)
+                assert_equal(np.max(np.abs(x[0] - target)), 0.0, 1e-10)
+                # Batches hold one pooled row per structure
+                X, offsets = calc.evaluate_batch(np.concatenate([ c.positions for c in configs ]),
+                    np.concatenate([ c.get_atomic_numbers() for c in configs ]),
+                    [ len(c) for c in configs ])
+                assert_equal(np.max(np.abs(offsets - np.arange(len(configs)+1))), 0, 0)
+                for c, x in zip(configs, X):
+                    assert_equal(np.max(np.abs(x - calc.evaluate(c)[0])), 0.0, 1e-10)
+        log << log.endl
+    # Threaded pooling is reproducible and independent of the thread count
+    for pooling in [ "average", "sum" ]:
+        x0 = get_calc(scale=1., pooling=pooling).evaluate(config)
+        calc = get_calc(scale=1., pooling=pooling, n_threads=4)
+        for rep in range(10):
+            assert_equal(np.sum(calc.evaluate(config) != x0), 0, 0)
+
+def test_gylm_connectivity():
+    log << log.mg << "<test_connectivity>" << log.endl
+    # Sparse bonds and distances as from the dense matrices, open and with
+    # minimum images in a periodic box
+    from gylm import connectivity
+    configs = gylm.io.read('../test_data/structures.xyz')
+    for config in configs:
+        R = config.get_positions()
+        D = connectivity.calculate_dmat(R, R)
+        for cutoff in [ None, 2.0 ]:
+            L = connectivity.calculate_lmat(D, config.get_atomic_numbers(), cutoff=cutoff)
+            np.fill_diagonal(L, False)
+            L_sparse, D_sparse = connectivity.calculate_lmat_sparse(R,
+                config.get_chemical_symbols(), cutoff=cutoff, distances=True)
+            assert_equal(np.sum(L_sparse.toarray() != L), 0, 0)
+            assert_equal(np.max(np.abs(D_sparse.toarray() - D*L)), 0.0, 0.0)
+    np.random.seed(3)
+    box = 8.
+    R = np.random.uniform(0., box, size=(200,3))
+    Z = np.random.choice([ 1, 6, 8 ], size=200)
+    L_sparse, D_sparse = connectivity.calculate_lmat_sparse(R, Z,
+        cell=box*np.identity(3), pbc=[ True, True, True ], distances=True)
+    d = R[:,None,:] - R[None,:,:]
+    d = np.sum((d - box*np.round(d/box))**2, axis=2)**0.5
+    cr = connectivity.get_covalent_radii(Z)
+    L = (d < 1.15*np.add.outer(cr, cr))
+    np.fill_diagonal(L, False)
+    log << "bonds" << L_sparse.nnz//2 << log.endl
+    assert_equal(np.sum(L_sparse.toarray() != L), 0, 0)
+    assert_equal(np.max(np.abs(D_sparse.toarray() - d*L)), 0.0, 1e-12)
+    # Radii of COVRAD_TABLE, for symbols and atomic numbers: The O-F and N-O
+    # distances count as bonds only with the ptable radii
+    from gylm import ptable
+    symbols = [ "C", "O", "F", "N", "H" ]
+    R = np.array([ [ 0., 0., 0. ], [ 1.30, 0., 0. ], [ 2.80, 0., 0. ],
+        [ 1.30, 1.60, 0. ], [ -1.0, 0., 0. ] ])
+    table = np.array([ 0.76, 0.66, 0.57, 0.71, 0.31 ])
+    assert_equal(np.max(np.abs(connectivity.get_covalent_radii(symbols) - table)), 0.0, 0.0)
+    D = connectivity.calculate_dmat(R, R)
+    L = (D < 1.15*np.add.outer(table, table))
+    for types in [ symbols, ptable.symbols_to_z(symbols) ]:
+        assert_equal(np.sum(connectivity.calculate_lmat(D, types) != L), 0, 0)
+        L_sparse = connectivity.calculate_lmat_sparse(R, types).toarray()
+        assert_equal(np.sum(L_sparse != (L & ~np.identity(len(R), dtype=bool))), 0, 0)
+
+def test_gylm_trajectory():
+    log << log.mg << "<test_trajectory>" << log.endl
+    config = gylm.io.read('../test_data/structures.xyz')[0]
+    frames = []
+    pos = np.array(config.positions)
+    for f in range(20):
+        pos = pos + np.random.normal(scale=0.03, size=pos.shape)
+        frame = gylm.io.ExtendedXyz()
+        frame.positions = pos
+        frame.symbols = config.symbols
+        frames.append(frame)
+    calc = get_calc(scale=1.)
+    X = list(calc.evaluate_trajectory(frames, skin=0.5))
+    for fidx, frame in enumerate(frames):
+        log << "Frame" << fidx << log.flush
+        assert_equal(np.max(np.abs(X[fidx] - calc.evaluate(frame))), 0.0, 1e-10)
+        log << log.endl
+    verlet = gylm.connect.VerletList(calc.getCutoff(), skin=0.5)
+    for frame in frames: verlet.get(frame)
+    assert_equal(int(verlet.n_builds < len(frames)), 1, 0)
+
+def test_gylm_state():
+    log << log.mg << "<test_state>" << log.endl
+    config = gylm.io.read('../test_data/structures.xyz')[1]
+    calc = get_calc(scale=1.)
+    state = gylm.GylmState(calc, config, skin=1.0)
+    pos = np.array(config.positions)
+    for step in range(20):
+        log << "Step" << step << log.flush
+        idx = np.random.choice(len(pos), 2, replace=False)
+        pos[idx] += np.random.normal(scale=0.15, size=(2,3))
+        state.move_atoms(idx, pos[idx])
+        frame = gylm.io.ExtendedXyz()
+        frame.positions = np.copy(pos)
+        frame.symbols = config.symbols
+        assert_equal(np.max(np.abs(state.descriptors() - calc.evaluate(frame))), 0.0, 1e-10)
+        log << log.endl
+    # Empty move sets leave the state unchanged
+    X = state.descriptors()
+    state.move_atoms([], np.zeros((0,3)))
+    assert_equal(np.max(np.abs(state.descriptors() - X)), 0.0, 0.0)
+
 if __name__ == "__main__":
     test_gylm_rotinv()
     test_gylm_parity()
     test_gylm_scaleinv()
-
+    test_gylm_threads()
+    test_gylm_batch()
+    test_gylm_pool()
+    test_gylm_read()
+    test_gylm_frame()
+    test_gylm_read_index()
+    test_gylm_binary()
+    test_gylm_stream()
+    test_gylm_store()
+    test_gylm_cache()
+    test_gylm_gradients()
+    test_gylm_radial_table()
+    test_gylm_power()
+    test_gylm_channels()
+    test_gylm_float32()
+    test_gylm_neighbour_list()
+    test_gylm_periodic()
+    test_gylm_grid_search()
+    test_gylm_bins_per_cutoff()
+    test_gylm_pooling()
+    test_gylm_connectivity()
+    test_gylm_trajectory()
+    test_gylm_state()